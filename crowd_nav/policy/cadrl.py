@@ -163,9 +163,9 @@ class CADRL(Policy):
             assert self.phase != 'train'
             return self.select_greedy_action(state.self_state)
 
-        probability = np.random.random()
+        probability = self.rng.random()
         if self.phase == 'train' and probability < self.epsilon:
-            max_action = self.action_space[np.random.choice(len(self.action_space))]
+            max_action = self.action_space[self.rng.integers(len(self.action_space))]
         else:
             self.action_values = list()
             max_min_value = float('-inf')
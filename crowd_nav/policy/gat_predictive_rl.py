@@ -206,9 +206,9 @@ class GatPredictiveRL(Policy):
         if self.action_space is None:
             self.build_action_space(state.robot_state.v_pref)
 
-        probability = np.random.random()
+        probability = self.rng.random()
         if self.phase == 'train' and probability < self.epsilon:
-            max_action = self.action_space[np.random.choice(len(self.action_space))]
+            max_action = self.action_space[self.rng.integers(len(self.action_space))]
         else:
             max_action = None
             max_value = float('-inf')
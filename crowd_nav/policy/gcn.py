@@ -43,7 +43,8 @@ class ValueNetwork(nn.Module):
 
         self.value_net = mlp(final_state_dim, planning_dims)
 
-        # for visualization
+        # for visualization, only copied to numpy when recorded
+        self.record_attention = False
         self.A = None
 
     def compute_similarity_matrix(self, X):
@@ -99,7 +100,8 @@ class ValueNetwork(nn.Module):
 
         # compute matrix A
         normalized_A = self.compute_similarity_matrix(X)
-        self.A = normalized_A[0, :, :].data.cpu().numpy()
+        if self.record_attention:
+            self.A = normalized_A[0, :, :].data.cpu().numpy()
 
         # graph convolution
         if self.num_layer == 0:
@@ -7,6 +7,74 @@ from torch.nn import Parameter
 from crowd_nav.policy.helpers import mlp, GAT
 
 
+def compute_node_mask(state):
+    """ Mask of real nodes (robot first) of shape (batch_size, # of agents) when the state tuple carries a third
+    element with the mask of padded humans, None otherwise
+    """
+    if len(state) < 3 or state[2] is None:
+        return None
+    robot_mask = torch.ones(state[0].shape[:2], dtype=torch.bool, device=state[0].device)
+    return torch.cat([robot_mask, state[2].bool()], dim=1)
+
+
+def compute_knn_edges(human_positions, k, human_mask=None, humans_attend_robot=False):
+    """
+    Edge list (src, dst) over the flattened batch_size * (# of humans + 1) nodes, with the robot as first node
+    of each sample. The robot attends to itself and every observed human, each human attends to itself and
+    its k nearest humans, and also to the robot if humans_attend_robot. Padded humans only attend to themselves.
+    human_positions is of shape (batch_size, # of humans, 2), human_mask of shape (batch_size, # of humans)
+    """
+    batch_size, human_num = human_positions.shape[:2]
+    node_num = human_num + 1
+    device = human_positions.device
+    if human_mask is None:
+        human_mask = torch.ones((batch_size, human_num), dtype=torch.bool, device=device)
+    else:
+        human_mask = human_mask.bool()
+    offsets = (torch.arange(batch_size, device=device) * node_num).unsqueeze(1)
+    robot_nodes = offsets.expand(batch_size, node_num)
+    human_nodes = offsets + torch.arange(1, node_num, device=device)
+
+    # robot to itself and all observed humans, listed first so that sample 0 starts the edge list
+    robot_edge_mask = torch.cat([torch.ones((batch_size, 1), dtype=torch.bool, device=device), human_mask], dim=1)
+    src = [(offsets + torch.arange(node_num, device=device))[robot_edge_mask], human_nodes.reshape(-1)]
+    dst = [robot_nodes[robot_edge_mask], human_nodes.reshape(-1)]
+    if humans_attend_robot:
+        src.append(robot_nodes[:, 1:][human_mask])
+        dst.append(human_nodes[human_mask])
+
+    neighbor_num = min(k, human_num - 1)
+    if neighbor_num > 0:
+        # distances are only scalars, the attention itself is computed on the edges
+        positions = human_positions.detach()
+        distances = torch.cdist(positions, positions)
+        invalid = ~(human_mask.unsqueeze(1) & human_mask.unsqueeze(2))
+        invalid = invalid | torch.eye(human_num, dtype=torch.bool, device=device)
+        distances = distances.masked_fill(invalid, float('inf'))
+        neighbor_distances, neighbors = torch.topk(distances, neighbor_num, dim=2, largest=False)
+        valid = torch.isfinite(neighbor_distances)
+        src.append((neighbors + offsets.unsqueeze(2) + 1)[valid])
+        dst.append(human_nodes.unsqueeze(2).expand(-1, -1, neighbor_num)[valid])
+
+    return torch.cat(src), torch.cat(dst)
+
+
+def scatter_softmax(e, index, size):
+    """ Softmax of the edge scores e over the edges sharing the same index (destination node) """
+    e_max = e.new_full((size,), float('-inf')).scatter_reduce(0, index, e.detach(), reduce='amax')
+    exp_e = torch.exp(e - e_max[index])
+    denominator = e.new_zeros(size).index_add_(0, index, exp_e)
+    return exp_e / denominator[index]
+
+
+def robot_attention_weights(attention, src, dst, node_num):
+    """ Attention of the robot of the first sample over all of its nodes, for visualization """
+    robot_edges = dst == 0
+    weights = attention.new_zeros(node_num)
+    weights[src[robot_edges]] = attention[robot_edges]
+    return weights.data.float().cpu().numpy()
+
+
 class RGL(nn.Module):
     def __init__(self, config, robot_state_dim, human_state_dim):
         """ The current code might not be compatible with models trained with previous version
@@ -60,38 +128,58 @@ class RGL(nn.Module):
             else:
                 self.Ws.append(Parameter(torch.randn(embedding_dim, embedding_dim)))
 
-        # for visualization
+        # for visualization, attention weights are only copied to numpy when recorded
+        self.record_attention = False
         self.attention_weights = None
 
-    def compute_similarity_matrix(self, X):
+    @staticmethod
+    def masked_softmax(A, column_mask=None):
+        if column_mask is not None:
+            A = A.masked_fill(~column_mask, float('-inf'))
+        return softmax(A, dim=2)
+
+    def compute_similarity_matrix(self, X, node_mask=None):
+        """ node_mask of shape (batch_size, # of agents) removes padded nodes from every neighborhood """
+        # padded nodes get -inf before softmax and zero weight otherwise
+        column_mask = node_mask.unsqueeze(1) if node_mask is not None else None
+
         if self.similarity_function == 'embedded_gaussian':
             A = torch.matmul(torch.matmul(X, self.w_a), X.permute(0, 2, 1))
-            normalized_A = softmax(A, dim=2)
+            normalized_A = self.masked_softmax(A, column_mask)
         elif self.similarity_function == 'gaussian':
             A = torch.matmul(X, X.permute(0, 2, 1))
-            normalized_A = softmax(A, dim=2)
+            normalized_A = self.masked_softmax(A, column_mask)
         elif self.similarity_function == 'cosine':
             A = torch.matmul(X, X.permute(0, 2, 1))
+            if column_mask is not None:
+                A = A * column_mask
             magnitudes = torch.norm(A, dim=2, keepdim=True)
             norm_matrix = torch.matmul(magnitudes, magnitudes.permute(0, 2, 1))
             normalized_A = torch.div(A, norm_matrix)
         elif self.similarity_function == 'cosine_softmax':
             A = torch.matmul(X, X.permute(0, 2, 1))
+            if column_mask is not None:
+                A = A * column_mask
             magnitudes = torch.norm(A, dim=2, keepdim=True)
             norm_matrix = torch.matmul(magnitudes, magnitudes.permute(0, 2, 1))
-            normalized_A = softmax(torch.div(A, norm_matrix), dim=2)
+            normalized_A = self.masked_softmax(torch.div(A, norm_matrix), column_mask)
         elif self.similarity_function == 'concatenation':
             indices = [pair for pair in itertools.product(list(range(X.size(1))), repeat=2)]
             selected_features = torch.index_select(X, dim=1, index=torch.LongTensor(indices).reshape(-1))
             pairwise_features = selected_features.reshape((-1, X.size(1) * X.size(1), X.size(2) * 2))
             A = self.w_a(pairwise_features).reshape(-1, X.size(1), X.size(1))
-            normalized_A = softmax(A, dim=2)
+            normalized_A = self.masked_softmax(A, column_mask)
         elif self.similarity_function == 'squared':
             A = torch.matmul(X, X.permute(0, 2, 1))
             squared_A = A * A
+            if column_mask is not None:
+                squared_A = squared_A * column_mask
             normalized_A = squared_A / torch.sum(squared_A, dim=2, keepdim=True)
         elif self.similarity_function == 'equal_attention':
             normalized_A = (torch.ones(X.size(1), X.size(1)) / X.size(1)).expand(X.size(0), X.size(1), X.size(1))
+            if column_mask is not None:
+                normalized_A = column_mask.to(X.dtype).expand(X.size(0), X.size(1), X.size(1))
+                normalized_A = normalized_A / torch.sum(normalized_A, dim=2, keepdim=True)
         elif self.similarity_function == 'diagonal':
             normalized_A = (torch.eye(X.size(1), X.size(1))).expand(X.size(0), X.size(1), X.size(1))
         else:
@@ -103,10 +191,12 @@ class RGL(nn.Module):
         """
         Embed current state tensor pair (robot_state, human_states) into a latent space
         Each tensor is of shape (batch_size, # of agent, features)
+        An optional third element of shape (batch_size, # of humans) masks padded humans
         :param state:
         :return:
         """
-        robot_state, human_states = state
+        robot_state, human_states = state[:2]
+        node_mask = compute_node_mask(state)
 
         # compute feature matrix X
         robot_state_embedings = self.w_r(robot_state)
@@ -115,24 +205,74 @@ class RGL(nn.Module):
 
         # compute matrix A
         if not self.layerwise_graph:
-            normalized_A = self.compute_similarity_matrix(X)
+            normalized_A = self.compute_similarity_matrix(X, node_mask)
             value_X = self.w_v(X)
-            self.attention_weights = normalized_A[0, 0, :].data.cpu().numpy()
+            if self.record_attention:
+                self.attention_weights = normalized_A[0, 0, :].data.float().cpu().numpy()
 
         next_H = H = value_X
         for i in range(self.num_layer):
             if self.layerwise_graph:
-                A = self.compute_similarity_matrix(H)
+                A = self.compute_similarity_matrix(H, node_mask)
                 next_H = relu(torch.matmul(torch.matmul(A, H), self.Ws[i]))
             else:
                 next_H = relu(torch.matmul(torch.matmul(normalized_A, H), self.Ws[i]))
 
             if self.skip_connection:
-                next_H += H
+                next_H = next_H + H
             H = next_H
 
         return next_H
 
+
+class SparseRGL(RGL):
+    def __init__(self, config, robot_state_dim, human_state_dim):
+        """ RGL with the attention restricted to a k-nearest-neighbor graph of the humans (k = gcn.sparse_k),
+        the robot stays connected to every observed human. Parameters are the same as RGL
+        """
+        super().__init__(config, robot_state_dim, human_state_dim)
+        if self.similarity_function not in ['embedded_gaussian', 'gaussian', 'concatenation']:
+            raise NotImplementedError('Sparse attention needs a softmax similarity function')
+        self.k = config.gcn.sparse_k
+        logging.info('Sparse attention over {} nearest humans'.format(self.k))
+
+    def compute_edge_similarity(self, X, src, dst):
+        if self.similarity_function == 'embedded_gaussian':
+            e = torch.sum(torch.matmul(X[dst], self.w_a) * X[src], dim=1)
+        elif self.similarity_function == 'gaussian':
+            e = torch.sum(X[dst] * X[src], dim=1)
+        else:
+            e = self.w_a(torch.cat([X[dst], X[src]], dim=1)).squeeze(1)
+        return scatter_softmax(e, dst, X.size(0))
+
+    def forward(self, state):
+        robot_state, human_states = state[:2]
+        batch_size, node_num = robot_state.size(0), human_states.size(1) + 1
+        src, dst = compute_knn_edges(human_states[:, :, :2], self.k, state[2] if len(state) > 2 else None,
+                                     humans_attend_robot=True)
+
+        robot_state_embedings = self.w_r(robot_state)
+        human_state_embedings = self.w_h(human_states)
+        X = torch.cat([robot_state_embedings, human_state_embedings], dim=1).reshape(batch_size * node_num, -1)
+
+        if not self.layerwise_graph:
+            attention = self.compute_edge_similarity(X, src, dst)
+            if self.record_attention:
+                self.attention_weights = robot_attention_weights(attention, src, dst, node_num)
+
+        next_H = H = self.w_v(X)
+        for i in range(self.num_layer):
+            if self.layerwise_graph:
+                attention = self.compute_edge_similarity(H, src, dst)
+            aggregated_H = torch.zeros_like(H).index_add_(0, dst, attention.unsqueeze(1) * H[src])
+            next_H = relu(torch.matmul(aggregated_H, self.Ws[i]))
+
+            if self.skip_connection:
+                next_H = next_H + H
+            H = next_H
+
+        return next_H.reshape(batch_size, node_num, -1)
+
 class GAT_RL(nn.Module):
     def __init__(self, config, robot_state_dim, human_state_dim):
         """ The current code might not be compatible with models trained with previous version
@@ -168,7 +308,8 @@ class GAT_RL(nn.Module):
 
         self.w_r = mlp(robot_state_dim, wr_dims, last_relu=True)
         self.w_h = mlp(human_state_dim, wh_dims, last_relu=True)
-        # for visualization
+        # for visualization, attention weights are only copied to numpy when recorded
+        self.record_attention = False
         self.attention_weights = None
 
     def compute_adjectory_matrix(self, state):
@@ -177,29 +318,33 @@ class GAT_RL(nn.Module):
         robot_num = robot_state.size()[1]
         human_num = human_state.size()[1]
         Num = robot_num + human_num
-        adj = torch.ones((Num, Num))
+        adj = torch.ones((Num, Num), device=robot_state.device)
         for i in range(robot_num, robot_num+human_num):
             adj[i][0] = 0
         adj = adj.repeat(robot_state.size()[0], 1, 1)
+        node_mask = compute_node_mask(state)
+        if node_mask is not None:
+            # no node attends to padded humans
+            adj = adj * node_mask.unsqueeze(1)
         return adj
 
     def forward(self, state):
         """
         Embed current state tensor pair (robot_state, human_states) into a latent space
         Each tensor is of shape (batch_size, # of agent, features)
+        An optional third element of shape (batch_size, # of humans) masks padded humans
         :param state:
         :return:
         """
-        robot_state, human_states = state
+        robot_state, human_states = state[:2]
         adj = self.compute_adjectory_matrix(state)
         # compute feature matrix X
         robot_state_embedings = self.w_r(robot_state)
         human_state_embedings = self.w_h(human_states)
         X = torch.cat([robot_state_embedings, human_state_embedings], dim=1)
-        if robot_state.shape[0]==1:
-            H1, self.attention_weights = self.gat0(X, adj)
-        else:
-            H1, _ = self.gat0(X, adj)
+        H1, attention = self.gat0(X, adj)
+        if robot_state.shape[0] == 1 and self.record_attention:
+            self.attention_weights = attention[0, 0, :].data.float().cpu().numpy()
         H2, _ = self.gat1(H1, adj)
         if self.skip_connection:
             output = H1 + H2 + X
@@ -207,6 +352,36 @@ class GAT_RL(nn.Module):
             output = H2
         return output
 
+
+class SparseGAT_RL(GAT_RL):
+    def __init__(self, config, robot_state_dim, human_state_dim):
+        """ GAT_RL with the attention restricted to a k-nearest-neighbor graph of the humans (k = gcn.sparse_k),
+        the robot stays connected to every observed human. Parameters are the same as GAT_RL, so models can be
+        loaded into either of them
+        """
+        super().__init__(config, robot_state_dim, human_state_dim)
+        self.k = config.gcn.sparse_k
+        logging.info('Sparse attention over {} nearest humans'.format(self.k))
+
+    def forward(self, state):
+        robot_state, human_states = state[:2]
+        batch_size, node_num = robot_state.size(0), human_states.size(1) + 1
+        # as in the dense adjacency matrix, humans do not attend to the robot
+        src, dst = compute_knn_edges(human_states[:, :, :2], self.k, state[2] if len(state) > 2 else None)
+
+        robot_state_embedings = self.w_r(robot_state)
+        human_state_embedings = self.w_h(human_states)
+        X = torch.cat([robot_state_embedings, human_state_embedings], dim=1).reshape(batch_size * node_num, -1)
+        H1, attention = self.gat0.forward_edges(X, src, dst)
+        if batch_size == 1 and self.record_attention:
+            self.attention_weights = robot_attention_weights(attention, src, dst, node_num)
+        H2, _ = self.gat1.forward_edges(H1, src, dst)
+        if self.skip_connection:
+            output = H1 + H2 + X
+        else:
+            output = H2
+        return output.reshape(batch_size, node_num, -1)
+
 class GraphAttentionLayer(nn.Module):
     """
     Simple GAT layer, similar to https://arxiv.org/abs/1710.10903
@@ -233,7 +408,14 @@ class GraphAttentionLayer(nn.Module):
         attention = torch.where(adj > 0, e, zero_vec)
         attention = nn.functional.softmax(attention, dim=2)
         next_H = torch.matmul(attention, input)
-        return next_H, attention[0, 0, :].data.cpu().numpy()
+        return next_H, attention
+
+    def forward_edges(self, input, src, dst):
+        """ Same attention restricted to the edges src -> dst, input is of shape (# of nodes, feature_dims) """
+        e = self.leakyrelu(self.w_a(torch.cat([input[dst], input[src]], dim=1)).squeeze(1))
+        attention = scatter_softmax(e, dst, input.size(0))
+        next_H = torch.zeros_like(input).index_add_(0, dst, attention.unsqueeze(1) * input[src])
+        return next_H, attention
 
     def compute_similarity_matrix(self, X):
         indices = [pair for pair in itertools.product(list(range(X.size(1))), repeat=2)]
@@ -4,6 +4,7 @@ from torch.nn import Parameter
 import torch.nn.functional as F
 import torch.autograd as autograd
 import math
+import logging
 
 
 def mlp(input_dim, mlp_dims, last_relu=False):
@@ -125,6 +126,14 @@ class FactorizedNoisyLinear(nn.Module):
         self.epsilon_i = eps_i.sign() * (eps_i.abs()).sqrt()
         self.epsilon_j = eps_j.sign() * (eps_j.abs()).sqrt()
 
+    def to_linear(self):
+        """ Freeze the layer to its noise-free eval path, i.e. a plain linear layer with the mean weights
+        """
+        linear = nn.Linear(self.num_in, self.num_out)
+        linear.weight.data.copy_(self.mu_weight.data)
+        linear.bias.data.copy_(self.mu_bias.data)
+        return linear
+
 
 class NoisyDuelingDQN(nn.Module):
     def __init__(self, input_dim, output_dim):
@@ -275,4 +284,25 @@ class GAT(nn.Module):
         assert len(adj.shape) == 3
         x = torch.cat([att(x, adj) for att in self.attentions], dim=2)
         x = self.out_att(x)
-        return x
\ No newline at end of file
+        return x
+
+
+def freeze_noisy_layers(module):
+    """ Recursively replace every FactorizedNoisyLinear in module with the nn.Linear of its eval path
+    """
+    for name, child in module.named_children():
+        if isinstance(child, FactorizedNoisyLinear):
+            setattr(module, name, child.to_linear())
+        else:
+            freeze_noisy_layers(child)
+    return module
+
+
+def quantize_dynamic_linear(module):
+    """ Post-training dynamic INT8 quantization of all nn.Linear layers of module, in place.
+    Weights are quantized once, activations are quantized on the fly, so no calibration data is needed.
+    Quantized linear layers only run on cpu and can not be trained any more.
+    """
+    freeze_noisy_layers(module)
+    module.eval()
+    return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
@@ -5,10 +5,11 @@ from numpy.linalg import norm
 import itertools
 from crowd_sim.envs.policy.policy import Policy
 from crowd_sim.envs.utils.action import ActionRot, ActionXY
-from crowd_sim.envs.utils.state import tensor_to_joint_state
+from crowd_sim.envs.utils.state import tensor_to_joint_state, JointStateBuffer
 from crowd_nav.policy.reward_estimate import estimate_reward_on_predictor
 from crowd_nav.policy.value_estimator import ValueEstimator
 from crowd_nav.policy.state_predictor import StatePredictor, LinearStatePredictor_batch
+from crowd_nav.policy.state_predictor import robot_actions_to_tensor, propagate_robot_states
 from crowd_nav.policy.graph_model import RGL,GAT_RL
 
 
@@ -44,6 +45,7 @@ class ModelPredictiveRL(Policy):
         self.sparse_rotation_samples = 8
         self.action_group_index = []
         self.traj = None
+        self.state_buffer = JointStateBuffer(self.robot_state_dim, self.human_state_dim)
 
     def configure(self, config, device):
         self.set_common_parameters(config)
@@ -180,6 +182,8 @@ class ModelPredictiveRL(Policy):
         self.speeds = speeds
         self.rotations = rotations
         self.action_space = action_space
+        if self.state_predictor is not None:
+            self.state_predictor.set_action_space(action_space)
 
     def predict(self, state):
         """
@@ -197,59 +201,61 @@ class ModelPredictiveRL(Policy):
         if self.action_space is None:
             self.build_action_space(state.robot_state.v_pref)
 
-        probability = np.random.random()
+        probability = self.rng.random()
         if self.phase == 'train' and probability < self.epsilon:
-            max_action_index = np.random.choice(len(self.action_space))
+            max_action_index = self.rng.integers(len(self.action_space))
             max_action = self.action_space[max_action_index]
         else:
             max_action = None
             max_value = float('-inf')
             max_traj = None
 
-            if self.do_action_clip:
-                state_tensor = state.to_tensor(add_batch_size=True, device=self.device)
-                action_space_clipped = self.action_clip(state_tensor, self.action_space, self.planning_width)
-            else:
-                action_space_clipped = self.action_space
-            state_tensor = state.to_tensor(add_batch_size=True, device=self.device)
-            actions = []
-            actions.append(ActionXY(0, 0))
-            pre_next_state = self.state_predictor(state_tensor, actions)
-            next_robot_states = None
-            next_human_states = None
-            rewards = []
-            for action in action_space_clipped:
-                next_robot_state = self.compute_next_robot_state(state_tensor[0], action)
-                next_human_state = pre_next_state[1]
-                if next_robot_states is None and next_human_states is None:
-                    next_robot_states = next_robot_state
-                    next_human_states = next_human_state
+            with torch.inference_mode():
+                state_tensor = self.state_buffer.to_tensor(state, add_batch_size=True, device=self.device)
+                if self.do_action_clip:
+                    action_space_clipped = self.action_clip(state_tensor, self.action_space, self.planning_width)
                 else:
-                    next_robot_states = torch.cat((next_robot_states, next_robot_state), dim=0)
-                    next_human_states = torch.cat((next_human_states, next_human_state), dim=0)
-                next_state = tensor_to_joint_state((next_robot_state, next_human_state))
-                reward_est = estimate_reward_on_predictor(state, next_state)
-                # reward_est = self.estimate_reward(state, action)
-                rewards.append(reward_est)
-                # next_state = self.state_predictor(state_tensor, action)
-            rewards_tensor = torch.tensor(rewards).to(self.device)
-            next_state_batch = (next_robot_states, next_human_states)
-            next_value = self.value_estimator(next_state_batch).squeeze(1)
-            value = rewards_tensor + next_value * self.get_normalized_gamma()
-            max_action_index = value.argmax()
-            best_value = value[max_action_index]
-            if best_value > max_value:
-                max_action = action_space_clipped[max_action_index]
-
-                next_state = tensor_to_joint_state((next_robot_states[max_action_index], next_human_states[max_action_index]))
-                max_next_traj = [(next_state.to_tensor(), None, None)]
-                # max_next_return, max_next_traj = self.V_planning(next_state, self.planning_depth, self.planning_width)
-                # reward_est = self.estimate_reward(state, action)
-                # value = reward_est + self.get_normalized_gamma() * max_next_return
-                # if value > max_value:
-                #     max_value = value
-                #     max_action = action
-                max_traj = [(state_tensor, max_action, rewards[max_action_index])] + max_next_traj
+                    action_space_clipped = self.action_space
+                actions = []
+                actions.append(ActionXY(0, 0))
+                pre_next_state = self.state_predictor(state_tensor, actions)
+                next_robot_states = None
+                next_human_states = None
+                rewards = []
+                for action in action_space_clipped:
+                    next_robot_state = self.compute_next_robot_state(state_tensor[0], action)
+                    next_human_state = pre_next_state[1]
+                    if next_robot_states is None and next_human_states is None:
+                        next_robot_states = next_robot_state
+                        next_human_states = next_human_state
+                    else:
+                        next_robot_states = torch.cat((next_robot_states, next_robot_state), dim=0)
+                        next_human_states = torch.cat((next_human_states, next_human_state), dim=0)
+                    next_state = tensor_to_joint_state((next_robot_state, next_human_state))
+                    reward_est = estimate_reward_on_predictor(state, next_state)
+                    # reward_est = self.estimate_reward(state, action)
+                    rewards.append(reward_est)
+                    # next_state = self.state_predictor(state_tensor, action)
+                rewards_tensor = torch.tensor(rewards).to(self.device)
+                next_state_batch = (next_robot_states, next_human_states)
+                next_value = self.value_estimator(next_state_batch).squeeze(1)
+                value = rewards_tensor + next_value * self.get_normalized_gamma()
+                max_action_index = value.argmax()
+                best_value = value[max_action_index]
+                if best_value > max_value:
+                    max_action = action_space_clipped[max_action_index]
+
+                    next_state = tensor_to_joint_state((next_robot_states[max_action_index], next_human_states[max_action_index]))
+                    max_next_traj = [(next_state.to_tensor(), None, None)]
+                    # max_next_return, max_next_traj = self.V_planning(next_state, self.planning_depth, self.planning_width)
+                    # reward_est = self.estimate_reward(state, action)
+                    # value = reward_est + self.get_normalized_gamma() * max_next_return
+                    # if value > max_value:
+                    #     max_value = value
+                    #     max_action = action
+                    # state_tensor is a view of the reused state buffer
+                    root_state = (state_tensor[0].clone(), state_tensor[1].clone())
+                    max_traj = [(root_state, max_action, rewards[max_action_index])] + max_next_traj
             if max_action is None:
                 raise ValueError('Value network is not well trained.')
 
@@ -328,28 +334,12 @@ class ModelPredictiveRL(Policy):
         :param state:
         :return: tensor of shape (# of agent, len(state))
         """
-        robot_state_tensor = torch.Tensor([state.robot_state.to_tuple()]).to(self.device)
-        human_states_tensor = torch.Tensor([human_state.to_tuple() for human_state in state.human_states]). \
-            to(self.device)
-
-        return robot_state_tensor, human_states_tensor
+        return self.state_buffer.to_tensor(state, device=self.device, copy=True)
 
     def compute_next_robot_state(self, robot_state, action):
-        if robot_state.shape[0] != 1:
-            raise NotImplementedError
-        next_state = robot_state.clone().squeeze()
-        if self.kinematics == 'holonomic':
-            next_state[0] = next_state[0] + action.vx * self.time_step
-            next_state[1] = next_state[1] + action.vy * self.time_step
-            next_state[2] = action.vx
-            next_state[3] = action.vy
-        else:
-            next_state[7] = next_state[7] + action.r
-            next_state[0] = next_state[0] + np.cos(next_state[7]) * action.v * self.time_step
-            next_state[1] = next_state[1] + np.sin(next_state[7]) * action.v * self.time_step
-            next_state[2] = np.cos(next_state[7]) * action.v
-            next_state[3] = np.sin(next_state[7]) * action.v
-        return next_state.unsqueeze(0).unsqueeze(0)
+        """ Robot states (batch_size, 1, 9) after one action, or a tensor of actions, per state """
+        actions = robot_actions_to_tensor(action, robot_state.shape[0])
+        return propagate_robot_states(robot_state, actions, self.kinematics, self.time_step)
 
     def get_attention_weights(self):
         return self.value_estimator.graph_model.attention_weights
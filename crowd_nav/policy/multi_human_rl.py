@@ -10,6 +10,18 @@ from crowd_nav.policy.reward_estimate import estimate_reward_on_predictor
 class MultiHumanRL(CADRL):
     def __init__(self):
         super().__init__()
+        self.robot_state_dim = 9
+        self.unrotated_joint_state_dim = 14
+        self.input_buffer = None
+
+    def get_input_buffer(self, action_num, human_num):
+        """
+        Reused (# actions, # humans, robot state + human state) array holding the unrotated next joint states
+        """
+        size = action_num * human_num * self.unrotated_joint_state_dim
+        if self.input_buffer is None or self.input_buffer.size < size:
+            self.input_buffer = np.zeros(size, dtype=np.float32)
+        return self.input_buffer[:size].reshape(action_num, human_num, self.unrotated_joint_state_dim)
 
     def predict(self, state):
         """
@@ -33,18 +45,19 @@ class MultiHumanRL(CADRL):
             return self.select_greedy_action(state.robot_state)
         max_action_index = 0
         occupancy_maps = None
-        probability = np.random.random()
+        probability = self.rng.random()
         if self.phase == 'train' and probability < self.epsilon:
-            max_action_index = np.random.choice(len(self.action_space))
+            max_action_index = self.rng.integers(len(self.action_space))
             max_action = self.action_space[max_action_index]
         else:
             self.action_values = list()
             max_value = float('-inf')
             max_action = None
             rewards = []
-            action_index = 0
-            batch_input_tensor = None
-            for action in self.action_space:
+            action_num = len(self.action_space)
+            human_num = len(state.human_states)
+            joint_states = self.get_input_buffer(action_num, human_num)
+            for action_index, action in enumerate(self.action_space):
                 next_robot_state = self.propagate(state.robot_state, action)
                 if self.query_env:
                     next_human_states, reward, done, info = self.env.onestep_lookahead(action)
@@ -53,23 +66,23 @@ class MultiHumanRL(CADRL):
                                          for human_state in state.human_states]
                     next_state = JointState(next_robot_state, next_human_states)
                     reward = estimate_reward_on_predictor(state, next_state)
-                    rewards.append(reward)
-                batch_next_states = torch.cat([torch.Tensor([next_robot_state + next_human_state]).to(self.device)
-                                              for next_human_state in next_human_states], dim=0)
-                rotated_batch_input = self.rotate(batch_next_states).unsqueeze(0)
+                rewards.append(reward)
+                joint_states[action_index, :, :self.robot_state_dim] = next_robot_state.to_tuple()
+                for i, next_human_state in enumerate(next_human_states):
+                    joint_states[action_index, i, self.robot_state_dim:] = next_human_state.to_tuple()
+                if self.with_om and occupancy_maps is None:
+                    occupancy_maps = self.build_occupancy_maps(next_human_states)
+            with torch.inference_mode():
+                batch_next_states = torch.from_numpy(joint_states.reshape(-1, joint_states.shape[-1])).to(self.device)
+                batch_input_tensor = self.rotate(batch_next_states).view(action_num, human_num, -1)
                 if self.with_om:
-                    if occupancy_maps is None:
-                        occupancy_maps = self.build_occupancy_maps(next_human_states).unsqueeze(0)
-                    rotated_batch_input = torch.cat([rotated_batch_input, occupancy_maps], dim=2)
-                if batch_input_tensor is None:
-                    batch_input_tensor = rotated_batch_input
-                else:
-                    batch_input_tensor = torch.cat([batch_input_tensor, rotated_batch_input], dim=0)
-            next_value = self.model(batch_input_tensor).squeeze(1)
-            rewards_tensor = torch.tensor(rewards).to(self.device)
-            value = rewards_tensor + next_value * pow(self.gamma, self.time_step * state.robot_state.v_pref)
-            max_action_index = value.argmax()
-            best_value = value[max_action_index]
+                    occupancy_maps = occupancy_maps.unsqueeze(0).expand(action_num, -1, -1)
+                    batch_input_tensor = torch.cat([batch_input_tensor, occupancy_maps], dim=2)
+                next_value = self.model(batch_input_tensor).squeeze(1)
+                rewards_tensor = torch.tensor(rewards).to(self.device)
+                value = rewards_tensor + next_value * pow(self.gamma, self.time_step * state.robot_state.v_pref)
+                max_action_index = value.argmax()
+                best_value = value[max_action_index]
             if best_value > max_value:
                 max_action = self.action_space[max_action_index]
 
@@ -113,8 +126,9 @@ class MultiHumanRL(CADRL):
         :param state:
         :return: tensor of shape (# of humans, len(state))
         """
-        state_tensor = torch.cat([torch.Tensor([state.robot_state + human_state]).to(self.device)
-                                  for human_state in state.human_states], dim=0)
+        joint_states = np.array([state.robot_state + human_state for human_state in state.human_states],
+                                dtype=np.float32)
+        state_tensor = torch.from_numpy(joint_states).to(self.device)
         rotated_state_tensor = self.rotate(state_tensor)
         if self.with_om:
             occupancy_maps = self.build_occupancy_maps(state.human_states)
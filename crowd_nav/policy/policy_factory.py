@@ -13,4 +13,14 @@ policy_factory['lstm_rl'] = LstmRL
 policy_factory['sarl'] = SARL
 policy_factory['gcn'] = GCN
 policy_factory['model_predictive_rl'] = ModelPredictiveRL
-policy_factory['tree_search_rl'] = TreeSearchRL
\ No newline at end of file
+policy_factory['tree_search_rl'] = TreeSearchRL
+
+
+def configure_sensing(env, policy):
+    """ Check that policy supports the robot sensing of env, with knn sensing observations are padded up to k humans """
+    if env.robot_sensor_mode != 'knn':
+        return
+    if hasattr(policy, 'set_max_observed_humans'):
+        policy.set_max_observed_humans(env.robot_sensor_k)
+    elif policy.trainable:
+        raise ValueError('knn sensing is only supported by tree_search_rl among the trainable policies')
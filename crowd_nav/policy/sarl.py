@@ -23,6 +23,8 @@ class ValueNetwork(nn.Module):
         self.cell_num = cell_num
         mlp3_input_dim = mlp2_dims[-1] + self.self_state_dim
         self.mlp3 = mlp(mlp3_input_dim, mlp3_dims)
+        # for visualization, attention weights are only copied to numpy when recorded
+        self.record_attention = False
         self.attention_weights = None
         self.device = device
 
@@ -62,7 +64,8 @@ class ValueNetwork(nn.Module):
         masked_exps = exps * mask.float()
         masked_sums = masked_exps.sum(1, keepdim=True)
         weights = (masked_exps / masked_sums).unsqueeze(2)
-        self.attention_weights = weights[0, :, 0].data.cpu().numpy()
+        if self.record_attention:
+            self.attention_weights = weights[0, :, 0].data.cpu().numpy()
 
         # output feature is a linear combination of input features
         features = mlp2_output.view(size[0], size[1], -1)
@@ -98,4 +101,4 @@ class SARL(MultiHumanRL):
         logging.info('Policy: {} {} global state'.format(self.name, 'w/' if with_global_state else 'w/o'))
 
     def get_attention_weights(self):
-        return self.attention_weights
+        return self.model.attention_weights
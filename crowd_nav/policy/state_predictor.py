@@ -2,6 +2,47 @@ import torch
 import torch.nn as nn
 import numpy as np
 from crowd_nav.policy.helpers import mlp
+from crowd_sim.envs.utils.action import ActionXY, ActionRot
+
+
+def action_space_to_tensor(action_space):
+    """ Tensor of shape (# of actions, 2) with the (vx, vy) or (v, r) of every action """
+    return torch.tensor([tuple(action) for action in action_space], dtype=torch.float32)
+
+
+def robot_actions_to_tensor(actions, batch_size):
+    """
+    Robot actions as a tensor of shape (batch_size, 2), from a tensor, a list of ActionXY / ActionRot or a single
+    action that is applied to the whole batch
+    """
+    if not isinstance(actions, torch.Tensor):
+        if isinstance(actions, (ActionXY, ActionRot)):
+            actions = [actions]
+        actions = torch.tensor([tuple(action) for action in actions], dtype=torch.float32)
+    actions = actions.reshape(-1, 2)
+    if actions.shape[0] == 1:
+        actions = actions.expand(batch_size, 2)
+    if actions.shape[0] != batch_size:
+        raise ValueError('Got {} actions for a batch of {} robot states'.format(actions.shape[0], batch_size))
+    return actions
+
+
+def propagate_robot_states(robot_states, actions, kinematics, time_step):
+    """
+    Robot kinematics of a whole batch as tensor ops, differentiable and on the device of robot_states.
+    robot_states is of shape (batch_size, 1, 9), actions of shape (batch_size, 2) holds (vx, vy) for holonomic and
+    (v, r) for unicycle robots, as Agent.step the unicycle turns first and then moves along its new heading
+    """
+    # px, py, vx, vy, radius, gx, gy, v_pref, theta
+    actions = actions.to(robot_states).unsqueeze(1)
+    theta = robot_states[:, :, 8:9]
+    if kinematics == 'holonomic':
+        velocities = actions
+    else:
+        theta = torch.remainder(theta + actions[:, :, 1:2], 2 * np.pi)
+        velocities = actions[:, :, 0:1] * torch.cat([torch.cos(theta), torch.sin(theta)], dim=2)
+    positions = robot_states[:, :, 0:2] + velocities * time_step
+    return torch.cat([positions, velocities, robot_states[:, :, 4:8], theta], dim=2)
 
 
 class StatePredictor(nn.Module):
@@ -16,9 +57,12 @@ class StatePredictor(nn.Module):
         self.graph_model = graph_model
         self.human_motion_predictor = mlp(config.gcn.X_dim, config.model_predictive_rl.motion_predictor_dims)
         self.time_step = time_step
+        # (# of actions, 2) tensor of the robot action space, used by rollout
+        self.action_tensor = None
 
     def forward(self, state, action, detach=False):
         """ Predict the next state tensor given current state as input.
+        The state may carry a (batch_size, # of humans) mask of padded humans as third element.
 
         :return: tensor of shape (batch_size, # of agents, feature_size)
         """
@@ -26,6 +70,12 @@ class StatePredictor(nn.Module):
         assert len(state[1].shape) == 3
 
         state_embedding = self.graph_model(state)
+        return self.predict_from_embedding(state_embedding, state, action, detach)
+
+    def predict_from_embedding(self, state_embedding, state, action=None, detach=False):
+        """ Same as forward with the graph model embedding of state already computed, e.g. shared with the value
+        estimator in training
+        """
         if detach:
             state_embedding = state_embedding.detach()
         if action is None:
@@ -37,50 +87,44 @@ class StatePredictor(nn.Module):
             # else:
             next_robot_state = self.compute_next_states(state[0], action)
         next_human_states = self.human_motion_predictor(state_embedding)[:, 1:, :]
+        if len(state) > 2:
+            # padded humans stay padded
+            next_human_states = next_human_states * state[2].unsqueeze(2)
 
         next_observation = [next_robot_state, next_human_states]
         return next_observation
 
-    def compute_next_state(self, robot_state, action):
-        # currently it can not perform parallel computation
-        if robot_state.shape[0] != 1:
-            raise NotImplementedError
-
-        # px, py, vx, vy, radius, gx, gy, v_pref, theta
-        next_state = robot_state.clone().squeeze()
-        if self.kinematics == 'holonomic':
-            next_state[0] = next_state[0] + action.vx * self.time_step
-            next_state[1] = next_state[1] + action.vy * self.time_step
-            next_state[2] = action.vx
-            next_state[3] = action.vy
-        else:
-            next_state[7] = next_state[7] + action.r
-            next_state[0] = next_state[0] + np.cos(next_state[7]) * action.v * self.time_step
-            next_state[1] = next_state[1] + np.sin(next_state[7]) * action.v * self.time_step
-            next_state[2] = np.cos(next_state[7]) * action.v
-            next_state[3] = np.sin(next_state[7]) * action.v
+    def set_action_space(self, action_space):
+        self.action_tensor = action_space_to_tensor(action_space)
+
+    def rollout(self, state, action_idx_seq, detach=False):
+        """
+        Predict len(action_idx_seq) steps ahead, action_idx_seq of shape (T, batch_size) indexes the action space. The
+        robot follows its kinematics and the humans are predicted from the previously predicted state.
+        :return: robot states (T, batch_size, 1, 9) and human states (T, batch_size, # of humans, 5) after every step
+        """
+        if self.action_tensor is None:
+            raise AttributeError('Action space has to be set!')
+        actions = self.action_tensor.to(state[0].device)[action_idx_seq]
+        robot_states = []
+        human_states = []
+        for t in range(actions.shape[0]):
+            _, next_human_states = self.forward(state, None, detach)
+            next_robot_states = propagate_robot_states(state[0], actions[t], self.kinematics, self.time_step)
+            state = (next_robot_states, next_human_states) + tuple(state[2:])
+            robot_states.append(next_robot_states)
+            human_states.append(next_human_states)
+        return torch.stack(robot_states), torch.stack(human_states)
 
-        return next_state.unsqueeze(0).unsqueeze(0)
+    def compute_next_state(self, robot_state, action):
+        """ Same as compute_next_states, kept for the single state callers """
+        return self.compute_next_states(robot_state, action)
 
     def compute_next_states(self, robot_states, actions):
-        # currently it can not perform parallel computation
-        if robot_states.shape[0] != len(actions):
-            raise NotImplementedError
-        next_state = robot_states.clone()
-        for i in range(robot_states.shape[0]):
-            cur_action = actions[i]
-            if self.kinematics == 'holonomic':
-                next_state[i, :, 0] = next_state[i, :, 0] + cur_action.vx * self.time_step
-                next_state[i, :, 1] = next_state[i, :, 1] + cur_action.vy * self.time_step
-                next_state[i, :, 2] = cur_action.vx
-                next_state[i, :, 3] = cur_action.vy
-            else:
-                next_state[i, :, 7] = next_state[i, :, 7] + cur_action.r
-                next_state[i, :, 0] = next_state[i, :, 0] + np.cos(next_state[i, :, 7]) * cur_action.v * self.time_step
-                next_state[i, :, 1] = next_state[i, :, 1] + np.sin(next_state[i, :, 7]) * cur_action.v * self.time_step
-                next_state[i, :, 2] = np.cos(next_state[i, :, 7]) * cur_action.v
-                next_state[i, :, 3] = np.sin(next_state[i, :, 7]) * cur_action.v
-        return next_state.unsqueeze(0).unsqueeze(0)
+        """ Next robot states (batch_size, 1, 9) of robot_states (batch_size, 1, 9) for one action per state """
+        actions = robot_actions_to_tensor(actions, robot_states.shape[0])
+        return propagate_robot_states(robot_states, actions, self.kinematics, self.time_step)
+
 
 class LinearStatePredictor_batch(object):
     def __init__(self, config, time_step):
@@ -92,6 +136,7 @@ class LinearStatePredictor_batch(object):
         self.trainable = False
         self.kinematics = config.action_space.kinematics
         self.time_step = time_step
+        self.action_tensor = None
 
     def  __call__(self, state, action, detach=False):
         """ Predict the next state tensor given current state as input.
@@ -112,45 +157,30 @@ class LinearStatePredictor_batch(object):
         next_observation = [next_robot_state, next_human_states]
         return next_observation
 
+    def set_action_space(self, action_space):
+        self.action_tensor = action_space_to_tensor(action_space)
+
+    def rollout(self, state, action_idx_seq, detach=False):
+        """ Same as StatePredictor.rollout with linear human motion """
+        if self.action_tensor is None:
+            raise AttributeError('Action space has to be set!')
+        actions = self.action_tensor.to(state[0].device)[action_idx_seq]
+        robot_states = []
+        human_states = [state[1]]
+        for t in range(actions.shape[0]):
+            robot_states.append(propagate_robot_states(robot_states[-1] if robot_states else state[0], actions[t],
+                                                       self.kinematics, self.time_step))
+            human_states.append(self.linear_motion_approximator(human_states[-1]))
+        return torch.stack(robot_states), torch.stack(human_states[1:])
+
     def compute_next_state(self, robot_state, action):
-        # currently it can not perform parallel computation
-        if robot_state.shape[0] != 1:
-            raise NotImplementedError
-
-        # px, py, vx, vy, radius, gx, gy, v_pref, theta
-        next_state = robot_state.clone().squeeze()
-        if self.kinematics == 'holonomic':
-            next_state[0] = next_state[0] + action.vx * self.time_step
-            next_state[1] = next_state[1] + action.vy * self.time_step
-            next_state[2] = action.vx
-            next_state[3] = action.vy
-        else:
-            next_state[7] = next_state[7] + action.r
-            next_state[0] = next_state[0] + np.cos(next_state[7]) * action.v * self.time_step
-            next_state[1] = next_state[1] + np.sin(next_state[7]) * action.v * self.time_step
-            next_state[2] = np.cos(next_state[7]) * action.v
-            next_state[3] = np.sin(next_state[7]) * action.v
-        return next_state.unsqueeze(0).unsqueeze(0)
+        """ Same as compute_next_states, kept for the single state callers """
+        return self.compute_next_states(robot_state, action)
 
     def compute_next_states(self, robot_states, actions):
-        # currently it can not perform parallel computation
-        if robot_states.shape[0] != len(actions):
-            raise NotImplementedError
-        next_state = robot_states.clone()
-        for i in range(robot_states.shape[0]):
-            cur_action = actions[i]
-            if self.kinematics == 'holonomic':
-                next_state[i, :, 0] = next_state[i, :, 0] + cur_action.vx * self.time_step
-                next_state[i, :, 1] = next_state[i, :, 1] + cur_action.vy * self.time_step
-                next_state[i, :, 2] = cur_action.vx
-                next_state[i, :, 3] = cur_action.vy
-            else:
-                next_state[i, :, 7] = next_state[i, :, 7] + cur_action.r
-                next_state[i, :, 0] = next_state[i, :, 0] + np.cos(next_state[i, :, 7]) * cur_action.v * self.time_step
-                next_state[i, :, 1] = next_state[i, :, 1] + np.sin(next_state[i, :, 7]) * cur_action.v * self.time_step
-                next_state[i, :, 2] = np.cos(next_state[i, :, 7]) * cur_action.v
-                next_state[i, :, 3] = np.sin(next_state[i, :, 7]) * cur_action.v
-        return next_state
+        """ Next robot states (batch_size, 1, 9) of robot_states (batch_size, 1, 9) for one action per state """
+        actions = robot_actions_to_tensor(actions, robot_states.shape[0])
+        return propagate_robot_states(robot_states, actions, self.kinematics, self.time_step)
 
     @staticmethod
     def linear_motion_approximator(human_states):
@@ -190,27 +220,8 @@ class LinearStatePredictor(object):
         return next_observation
 
     def compute_next_state(self, robot_state, action):
-        # currently it can not perform parallel computation
-        if robot_state.shape[0] != 1:
-            # raise NotImplementedError
-            next_state = robot_state.clone().squeeze()
-            return next_state
-
-        # px, py, vx, vy, radius, gx, gy, v_pref, theta
-        next_state = robot_state.clone().squeeze()
-        if self.kinematics == 'holonomic':
-            next_state[0] = next_state[0] + action.vx * self.time_step
-            next_state[1] = next_state[1] + action.vy * self.time_step
-            next_state[2] = action.vx
-            next_state[3] = action.vy
-        else:
-            next_state[7] = next_state[7] + action.r
-            next_state[0] = next_state[0] + np.cos(next_state[7]) * action.v * self.time_step
-            next_state[1] = next_state[1] + np.sin(next_state[7]) * action.v * self.time_step
-            next_state[2] = np.cos(next_state[7]) * action.v
-            next_state[3] = np.sin(next_state[7]) * action.v
-
-        return next_state.unsqueeze(0).unsqueeze(0)
+        actions = robot_actions_to_tensor(action, robot_state.shape[0])
+        return propagate_robot_states(robot_state, actions, self.kinematics, self.time_step)
 
     @staticmethod
     def linear_motion_approximator(human_states):
@@ -1,16 +1,19 @@
 import logging
+import contextlib
 import torch
 import numpy as np
 from numpy.linalg import norm
 import itertools
 from crowd_sim.envs.policy.policy import Policy
 from crowd_sim.envs.utils.action import ActionRot, ActionXY
-from crowd_sim.envs.utils.state import tensor_to_joint_state
+from crowd_sim.envs.utils.state import tensor_to_joint_state, JointStateBuffer
 from crowd_sim.envs.utils.utils import point_to_segment_dist
 from crowd_nav.policy.state_predictor import StatePredictor, LinearStatePredictor_batch
-from crowd_nav.policy.graph_model import RGL,GAT_RL
+from crowd_nav.policy.state_predictor import robot_actions_to_tensor, propagate_robot_states, action_space_to_tensor
+from crowd_nav.policy.graph_model import RGL,GAT_RL,SparseRGL,SparseGAT_RL
 from crowd_nav.policy.value_estimator import DQNNetwork, Noisy_DQNNetwork
 from crowd_nav.policy.reward_estimate import estimate_reward_on_predictor
+from crowd_nav.policy.helpers import quantize_dynamic_linear
 
 
 class TreeSearchRL(Policy):
@@ -45,7 +48,15 @@ class TreeSearchRL(Policy):
         self.sparse_rotation_samples = 8
         self.action_group_index = []
         self.traj = None
+        self.plan = None
+        # (# of actions, 2) tensor of the action space for expanding the search tree in batch
+        self.action_tensor = None
         self.use_noisy_net = False
+        # 'fp32', 'int8' (dynamic quantization of linear layers) or 'bf16' (autocast)
+        self.inference_precision = 'fp32'
+        self.state_buffer = JointStateBuffer(self.robot_state_dim, self.human_state_dim)
+        # observations are padded to this number of humans when the robot only senses the k nearest humans
+        self.max_observed_humans = None
         self.count=0
 
     def configure(self, config, device):
@@ -59,23 +70,27 @@ class TreeSearchRL(Policy):
         self.linear_state_predictor = config.model_predictive_rl.linear_state_predictor
         # self.set_device(device)
         self.device = device
-
+        # attention over the k nearest humans instead of all pairs of agents for large crowds
+        if hasattr(config.gcn, 'sparse_k') and config.gcn.sparse_k is not None:
+            RGL_model, GAT_model = SparseRGL, SparseGAT_RL
+        else:
+            RGL_model, GAT_model = RGL, GAT_RL
 
         if self.linear_state_predictor:
             self.state_predictor = LinearStatePredictor_batch(config, self.time_step)
-            graph_model = RGL(config, self.robot_state_dim, self.human_state_dim)
+            graph_model = RGL_model(config, self.robot_state_dim, self.human_state_dim)
             self.value_estimator = DQNNetwork(config, graph_model)
             self.model = [graph_model, self.value_estimator.value_network]
         else:
             if self.share_graph_model:
-                graph_model = RGL(config, self.robot_state_dim, self.human_state_dim)
+                graph_model = RGL_model(config, self.robot_state_dim, self.human_state_dim)
                 self.value_estimator = DQNNetwork(config, graph_model)
                 self.state_predictor = StatePredictor(config, graph_model, self.time_step)
                 self.model = [graph_model, self.value_estimator.value_network, self.state_predictor.human_motion_predictor]
             else:
-                graph_model1 = GAT_RL(config, self.robot_state_dim, self.human_state_dim)
+                graph_model1 = GAT_model(config, self.robot_state_dim, self.human_state_dim)
                 self.value_estimator = DQNNetwork(config, graph_model1)
-                graph_model2 = GAT_RL(config, self.robot_state_dim, self.human_state_dim)
+                graph_model2 = GAT_model(config, self.robot_state_dim, self.human_state_dim)
                 self.state_predictor = StatePredictor(config, graph_model2, self.time_step)
                 self.model = [graph_model1, graph_model2, self.value_estimator.value_network,
                               self.state_predictor.human_motion_predictor]
@@ -106,6 +121,31 @@ class TreeSearchRL(Policy):
     def set_noisy_net(self, use_noisy_net):
         self.use_noisy_net = use_noisy_net
 
+    def set_max_observed_humans(self, human_num):
+        self.max_observed_humans = human_num
+
+    def set_inference_precision(self, precision):
+        """
+        Switch the networks used for planning to a reduced precision. 'int8' quantizes all linear layers in place,
+        so it should only be applied after the weights are loaded and can not be undone or trained any more.
+        """
+        if precision not in ['fp32', 'int8', 'bf16']:
+            raise NotImplementedError
+        if precision == 'int8':
+            if self.device is not None and self.device.type != 'cpu':
+                logging.warning('INT8 inference is only supported on cpu, keep using fp32 on {}'.format(self.device))
+                return
+            quantize_dynamic_linear(self.value_estimator)
+            if isinstance(self.state_predictor, torch.nn.Module):
+                quantize_dynamic_linear(self.state_predictor)
+        self.inference_precision = precision
+        logging.info('Inference precision: {}'.format(self.inference_precision))
+
+    def inference_context(self):
+        if self.inference_precision == 'bf16':
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
     def set_time_step(self, time_step):
         self.time_step = time_step
         self.state_predictor.time_step = time_step
@@ -138,8 +178,27 @@ class TreeSearchRL(Policy):
                 }
 
     def get_traj(self):
+        """ The planned trajectory of the last prediction is only built from the plan when it is asked for """
+        if self.traj is None and self.plan is not None:
+            self.traj = self.reconstruct_traj(self.plan)
         return self.traj
 
+    @staticmethod
+    def reconstruct_traj(plan, index=0):
+        """
+        Follow the back-pointers of a plan returned by V_planning from node index of its first depth, gives the list
+        of (state, action index, estimated reward) along the chosen branch, the action and reward of the leaf are None
+        """
+        traj = []
+        for state, actions, rewards, children in plan:
+            node_state = tuple(tensor[index].unsqueeze(0) for tensor in state)
+            if actions is None:
+                traj.append((node_state, None, None))
+                break
+            traj.append((node_state, int(actions[index]), float(rewards[index])))
+            index = int(children[index])
+        return traj
+
     def load_state_dict(self, state_dict):
         if self.state_predictor.trainable:
             if self.share_graph_model:
@@ -187,6 +246,9 @@ class TreeSearchRL(Policy):
         self.speeds = speeds
         self.rotations = rotations
         self.action_space = action_space
+        self.action_tensor = action_space_to_tensor(action_space)
+        if self.state_predictor is not None:
+            self.state_predictor.set_action_space(action_space)
 
     def predict(self, state):
         """
@@ -206,91 +268,93 @@ class TreeSearchRL(Policy):
             self.build_action_space(1.0)
         max_action = None
         origin_max_value = float('-inf')
-        state_tensor = state.to_tensor(add_batch_size=True, device=self.device)
-        probability = np.random.random()
+        probability = self.rng.random()
         if self.phase == 'train' and probability < self.epsilon and self.use_noisy_net is False:
-            max_action_index = np.random.choice(len(self.action_space))
+            max_action_index = self.rng.integers(len(self.action_space))
             max_action = self.action_space[max_action_index]
             self.last_state = self.transform(state)
+            self.plan = None
+            self.traj = None
             return max_action, max_action_index
         else:
-            max_value, max_action_index, max_traj = self.V_planning(state_tensor, self.planning_depth, self.planning_width)
+            # the planning input is a view of the reused state buffer
+            state_tensor = self.state_buffer.to_tensor(state, add_batch_size=True, device=self.device,
+                                                       pad_to=self.max_observed_humans)
+            with torch.inference_mode():
+                max_value, max_action_index, plan = self.V_planning(state_tensor, self.planning_depth,
+                                                                    self.planning_width)
             if max_value[0] > origin_max_value:
                 max_action = self.action_space[max_action_index[0]]
             if max_action is None:
                 raise ValueError('Value network is not well trained.')
 
-        if self.phase == 'train':
-            self.last_state = self.transform(state)
+        self.last_state = self.transform(state)
+        if self.phase != 'train':
+            # the root of the plan still points into the state buffer, keep a copy for rendering
+            root_state, root_actions, root_rewards, root_children = plan[0]
+            plan[0] = (tuple(tensor.clone() for tensor in root_state), root_actions, root_rewards, root_children)
+            self.plan = plan
         else:
-            self.last_state = self.transform(state)
-            self.traj = max_traj[0]
+            self.plan = None
+        self.traj = None
         return max_action, int(max_action_index[0])
 
     def V_planning(self, state, depth, width):
-        """ Plans n steps into future based on state action value function. Computes the value for the current state as well as the trajectories
-        defined as a list of (state, action, reward) triples
+        """ Plans n steps into future based on state action value function. Computes the value for the current state as well as
+        the plan, a list with one (state batch, chosen action indexes, their estimated rewards, chosen child indexes in the
+        next state batch) per depth, the last one having None for the actions, rewards and children
         """
         # current_state_value = self.value_estimator(state)
         robot_state_batch = state[0]
         human_state_batch = state[1]
         if depth == 0:
-            q_value = torch.Tensor(self.value_estimator(state))
+            with self.inference_context():
+                q_value = self.value_estimator(state)
+            q_value = q_value.float()
             max_action_value, max_action_indexes = torch.max(q_value, dim=1)
-            trajs = []
-            for i in range(robot_state_batch.shape[0]):
-                cur_state = (robot_state_batch[i, :, :].unsqueeze(0), human_state_batch[i, :, :].unsqueeze(0))
-                trajs.append([(cur_state, None, None)])
-            return max_action_value, max_action_indexes, trajs
+            return max_action_value, max_action_indexes, [(state, None, None, None)]
         else:
-            q_value = torch.Tensor(self.value_estimator(state))
+            with self.inference_context():
+                q_value = self.value_estimator(state)
+            q_value = q_value.float()
             max_action_value, max_action_indexes = torch.topk(q_value, width, dim=1)
-        action_stay = []
-        for i in range(robot_state_batch.shape[0]):
-            action_stay.append(ActionXY(0, 0))
-        _, pre_next_state = self.state_predictor(state, action_stay)
-        next_robot_state_batch = None
-        next_human_state_batch = None
+        # only the humans are predicted here, the robot state follows from every expanded action
+        with self.inference_context():
+            _, pre_next_state = self.state_predictor(state, None)
+        pre_next_state = pre_next_state.float()
+        # expand every node with its width best actions at once, the children of node i are i * width + j
+        expanded_actions = self.action_tensor.to(robot_state_batch.device)[max_action_indexes.reshape(-1)]
+        next_robot_state_batch = self.compute_next_robot_state(robot_state_batch.repeat_interleave(width, dim=0),
+                                                               expanded_actions)
+        next_human_state_batch = pre_next_state.repeat_interleave(width, dim=0)
         reward_est = torch.zeros(state[0].shape[0], width) * float('inf')
 
         for i in range(robot_state_batch.shape[0]):
-            cur_state = (robot_state_batch[i, :, :].unsqueeze(0), human_state_batch[i, :, :].unsqueeze(0))
+            # padded states carry the mask of real humans as third element
+            cur_state = (robot_state_batch[i, :, :].unsqueeze(0), human_state_batch[i, :, :].unsqueeze(0)) + \
+                tuple(human_mask[i].unsqueeze(0) for human_mask in state[2:])
             next_human_state = pre_next_state[i, :, :].unsqueeze(0)
             for j in range(width):
-                cur_action = self.action_space[max_action_indexes[i][j]]
-                next_robot_state = self.compute_next_robot_state(cur_state[0], cur_action)
-                if next_robot_state_batch is None:
-                    next_robot_state_batch = next_robot_state
-                    next_human_state_batch = next_human_state
-                else:
-                    next_robot_state_batch = torch.cat((next_robot_state_batch, next_robot_state), dim=0)
-                    next_human_state_batch = torch.cat((next_human_state_batch, next_human_state), dim=0)
+                next_robot_state = next_robot_state_batch[i * width + j].unsqueeze(0)
                 reward_est[i][j] = estimate_reward_on_predictor(
-                    tensor_to_joint_state(cur_state), tensor_to_joint_state((next_robot_state, next_human_state)))
-        next_state_batch = (next_robot_state_batch, next_human_state_batch)
+                    tensor_to_joint_state(cur_state),
+                    tensor_to_joint_state((next_robot_state, next_human_state) + cur_state[2:]))
+        next_state_batch = (next_robot_state_batch, next_human_state_batch) + \
+            tuple(human_mask.repeat_interleave(width, dim=0) for human_mask in state[2:])
         if self.planning_depth - depth >= 2 and self.planning_depth > 2:
             cur_width = 1
         else:
             cur_width = int(self.planning_width/2)
-        next_values, next_action_indexes, next_trajs = self.V_planning(next_state_batch, depth-1, cur_width)
+        next_values, next_action_indexes, next_plan = self.V_planning(next_state_batch, depth-1, cur_width)
         next_values = next_values.view(state[0].shape[0], width)
         returns = (reward_est + self.get_normalized_gamma()*next_values + max_action_value) / 2
 
         max_action_return, max_action_index = torch.max(returns, dim=1)
-        trajs = []
-        max_returns = []
-        max_actions = []
-        for i in range(robot_state_batch.shape[0]):
-            cur_state = (robot_state_batch[i, :, :].unsqueeze(0), human_state_batch[i, :, :].unsqueeze(0))
-            action_id = max_action_index[i]
-            trajs_id = i * width + action_id
-            action = max_action_indexes[i][action_id]
-            next_traj = next_trajs[trajs_id]
-            trajs.append([(cur_state, action, reward_est)] + next_traj)
-            max_returns.append(max_action_return[i].data)
-            max_actions.append(action)
-        max_returns = torch.tensor(max_returns)
-        return max_returns, max_actions, trajs
+        # back-pointers to the chosen branch, the children of node i are i * width, ..., i * width + width - 1
+        max_actions = max_action_indexes.gather(1, max_action_index.unsqueeze(1)).squeeze(1)
+        max_rewards = reward_est.gather(1, max_action_index.unsqueeze(1)).squeeze(1)
+        children = torch.arange(robot_state_batch.shape[0]) * width + max_action_index
+        return max_action_return, max_actions, [(state, max_actions, max_rewards, children)] + next_plan
 
 
     def transform(self, state):
@@ -300,27 +364,12 @@ class TreeSearchRL(Policy):
         :param state:
         :return: tensor of shape (# of agent, len(state))
         """
-        robot_state_tensor = torch.Tensor([state.robot_state.to_tuple()]).to(self.device)
-        human_states_tensor = torch.Tensor([human_state.to_tuple() for human_state in state.human_states]). \
-            to(self.device)
-
-        return robot_state_tensor, human_states_tensor
+        return self.state_buffer.to_tensor(state, device=self.device, copy=True)
 
     def compute_next_robot_state(self, robot_state, action):
-        if robot_state.shape[0] != 1:
-            raise NotImplementedError
-        next_state = robot_state.clone().squeeze()
-        if self.kinematics == 'holonomic':
-            next_state[0] = next_state[0] + action.vx * self.time_step
-            next_state[1] = next_state[1] + action.vy * self.time_step
-            next_state[2] = action.vx
-            next_state[3] = action.vy
-        else:
-            next_state[7] = next_state[7] + action.r
-            next_state[0] = next_state[0] + np.cos(next_state[7]) * action.v * self.time_step
-            next_state[1] = next_state[1] + np.sin(next_state[7]) * action.v * self.time_step
-            next_state[2] = np.cos(next_state[7]) * action.v
-            next_state[3] = np.sin(next_state[7]) * action.v
-        return next_state.unsqueeze(0).unsqueeze(0)
+        """ Robot states (batch_size, 1, 9) after one action, or a tensor of actions, per state """
+        actions = robot_actions_to_tensor(action, robot_state.shape[0])
+        return propagate_robot_states(robot_state, actions, self.kinematics, self.time_step)
+
     def get_attention_weights(self):
         return self.value_estimator.graph_model.attention_weights
\ No newline at end of file
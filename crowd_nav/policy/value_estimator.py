@@ -71,7 +71,8 @@ class ValueEstimator(nn.Module):
                 new_human_state = cur_human_state
             else:
                 new_human_state = torch.cat((new_human_state, cur_human_state), dim=1)
-        new_state = (new_robot_state, new_human_state)
+        # keep the mask of padded humans if there is one
+        new_state = (new_robot_state, new_human_state) + tuple(state[2:])
         return new_state
 
     def trans_no_rotation(self, state):
@@ -105,21 +106,10 @@ class ValueEstimator(nn.Module):
         v_pref = robot_state[:, :, 7].unsqueeze(1)
         theta = robot_state[:, :, 8].unsqueeze(1)
         new_robot_state = torch.cat((theta, theta, vx, vy, radius_r, dg, rot, v_pref, theta), dim=2)
-        new_human_state = None
-        for i in range(human_num):
-            dx1 = human_state[:, i, 0].unsqueeze(1) - robot_state[:, :, 0]
-            dy1 = human_state[:, i, 1].unsqueeze(1) - robot_state[:, :, 1]
-            dx1 = dx1.unsqueeze(1).reshape((batch, 1, -1))
-            dy1 = dy1.unsqueeze(1).reshape((batch, 1, -1))
-            vx1 = (human_state[:, i, 2].unsqueeze(1).unsqueeze(2)).reshape((batch, 1, -1))
-            vy1 = (human_state[:, i, 3].unsqueeze(1).unsqueeze(2)).reshape((batch, 1, -1))
-            radius_h = human_state[:, i, 4].unsqueeze(1).unsqueeze(2)
-            cur_human_state = torch.cat((dx1, dy1, vx1, vy1, radius_h), dim=2)
-            if new_human_state is None:
-                new_human_state = cur_human_state
-            else:
-                new_human_state = torch.cat((new_human_state, cur_human_state), dim=1)
-        new_state = (new_robot_state, new_human_state)
+        # positions relative to the robot, velocities and radii unchanged, for all humans at once
+        new_human_state = torch.cat((human_state[:, :, 0:2] - robot_state[:, :, 0:2], human_state[:, :, 2:5]), dim=2)
+        # keep the mask of padded humans if there is one
+        new_state = (new_robot_state, new_human_state) + tuple(state[2:])
         return new_state
 
 class DQNNetwork(nn.Module):
@@ -198,7 +188,8 @@ class DQNNetwork(nn.Module):
                 new_human_state = cur_human_state
             else:
                 new_human_state = torch.cat((new_human_state, cur_human_state), dim=1)
-        new_state = (new_robot_state, new_human_state)
+        # keep the mask of padded humans if there is one
+        new_state = (new_robot_state, new_human_state) + tuple(state[2:])
         return new_state
 
     def trans_no_rotation(self, state):
@@ -234,21 +225,10 @@ class DQNNetwork(nn.Module):
         py_r = torch.zeros_like(v_pref)
         theta = robot_state[:, :, 8].unsqueeze(1)
         new_robot_state = torch.cat((px_r, py_r, vx, vy, radius_r, dg, rot, v_pref, theta), dim=2)
-        new_human_state = None
-        for i in range(human_num):
-            dx1 = human_state[:, i, 0].unsqueeze(1) - robot_state[:, :, 0]
-            dy1 = human_state[:, i, 1].unsqueeze(1) - robot_state[:, :, 1]
-            dx1 = dx1.unsqueeze(1).reshape((batch, 1, -1))
-            dy1 = dy1.unsqueeze(1).reshape((batch, 1, -1))
-            vx1 = (human_state[:, i, 2].unsqueeze(1).unsqueeze(2)).reshape((batch, 1, -1))
-            vy1 = (human_state[:, i, 3].unsqueeze(1).unsqueeze(2)).reshape((batch, 1, -1))
-            radius_h = human_state[:, i, 4].unsqueeze(1).unsqueeze(2)
-            cur_human_state = torch.cat((dx1, dy1, vx1, vy1, radius_h), dim=2)
-            if new_human_state is None:
-                new_human_state = cur_human_state
-            else:
-                new_human_state = torch.cat((new_human_state, cur_human_state), dim=1)
-        new_state = (new_robot_state, new_human_state)
+        # positions relative to the robot, velocities and radii unchanged, for all humans at once
+        new_human_state = torch.cat((human_state[:, :, 0:2] - robot_state[:, :, 0:2], human_state[:, :, 2:5]), dim=2)
+        # keep the mask of padded humans if there is one
+        new_state = (new_robot_state, new_human_state) + tuple(state[2:])
         return new_state
 
 class Noisy_DQNNetwork(nn.Module):
@@ -320,7 +300,8 @@ class Noisy_DQNNetwork(nn.Module):
                 new_human_state = cur_human_state
             else:
                 new_human_state = torch.cat((new_human_state, cur_human_state), dim=1)
-        new_state = (new_robot_state, new_human_state)
+        # keep the mask of padded humans if there is one
+        new_state = (new_robot_state, new_human_state) + tuple(state[2:])
         return new_state
 
     def trans_no_rotation(self, state):
@@ -354,19 +335,8 @@ class Noisy_DQNNetwork(nn.Module):
         v_pref = robot_state[:, :, 7].unsqueeze(1)
         theta = robot_state[:, :, 8].unsqueeze(1)
         new_robot_state = torch.cat((theta, theta, vx, vy, radius_r, dg, rot, v_pref, theta), dim=2)
-        new_human_state = None
-        for i in range(human_num):
-            dx1 = human_state[:, i, 0].unsqueeze(1) - robot_state[:, :, 0]
-            dy1 = human_state[:, i, 1].unsqueeze(1) - robot_state[:, :, 1]
-            dx1 = dx1.unsqueeze(1).reshape((batch, 1, -1))
-            dy1 = dy1.unsqueeze(1).reshape((batch, 1, -1))
-            vx1 = (human_state[:, i, 2].unsqueeze(1).unsqueeze(2)).reshape((batch, 1, -1))
-            vy1 = (human_state[:, i, 3].unsqueeze(1).unsqueeze(2)).reshape((batch, 1, -1))
-            radius_h = human_state[:, i, 4].unsqueeze(1).unsqueeze(2)
-            cur_human_state = torch.cat((dx1, dy1, vx1, vy1, radius_h), dim=2)
-            if new_human_state is None:
-                new_human_state = cur_human_state
-            else:
-                new_human_state = torch.cat((new_human_state, cur_human_state), dim=1)
-        new_state = (new_robot_state, new_human_state)
+        # positions relative to the robot, velocities and radii unchanged, for all humans at once
+        new_human_state = torch.cat((human_state[:, :, 0:2] - robot_state[:, :, 0:2], human_state[:, :, 2:5]), dim=2)
+        # keep the mask of padded humans if there is one
+        new_state = (new_robot_state, new_human_state) + tuple(state[2:])
         return new_state
\ No newline at end of file
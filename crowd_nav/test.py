@@ -7,8 +7,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 import gym
 from crowd_nav.utils.explorer import Explorer
-from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.utils.statistics import EpisodeRecorder
+from crowd_nav.policy.policy_factory import policy_factory, configure_sensing
 from crowd_sim.envs.utils.robot import Robot
+from crowd_sim.envs.utils.scenario_bank import build_scenario_bank
 from crowd_sim.envs.policy.orca import ORCA
 
 
@@ -19,6 +21,9 @@ def main(args):
                         datefmt="%Y-%m-%d %H:%M:%S")
     device = torch.device("cuda:0" if torch.cuda.is_available() and args.gpu else "cpu")
     logging.info('Using device: %s', device)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    logging.info('Using %d intra-op threads', torch.get_num_threads())
 
     if args.model_dir is not None:
         if args.config is not None:
@@ -84,6 +89,7 @@ def main(args):
     robot = Robot(env_config, 'robot')
     env.set_robot(robot)
     robot.time_step = env.time_step
+    configure_sensing(env, policy)
     robot.set_policy(policy)
     explorer = Explorer(env, robot, device, None, gamma=0.9)
 
@@ -104,8 +110,23 @@ def main(args):
 
     policy.set_env(env)
     robot.print_info()
+    if args.scenario_bank is not None:
+        env.set_scenario_bank(args.phase, build_scenario_bank(env, args.phase, args.scenario_bank))
+
+    reference_statistics = None
+    if args.inference_precision != 'fp32':
+        if not hasattr(policy, 'set_inference_precision'):
+            parser.error('Policy {} does not support reduced inference precision'.format(policy_config.name))
+        if args.check_precision and not args.visualize:
+            # replay the same test cases in full precision as the reference for the accuracy check
+            logging.info('Run the test cases in fp32 as reference')
+            reference_statistics = explorer.run_k_episodes(env.case_size[args.phase], args.phase)
+            env.case_counter[args.phase] = 0
+        policy.set_inference_precision(args.inference_precision)
 
     if args.visualize:
+        # rendering needs the states and attention of the episode
+        env.record[args.phase] = 'full'
         if robot.policy.name in ['tree_search_rl']:
             policy.model[2].eval()
         rewards = []
@@ -138,7 +159,14 @@ def main(args):
             human_times = env.get_human_times()
             logging.info('Average time for humans to reach goal: %.2f', sum(human_times) / len(human_times))
     else:
-        explorer.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+        if args.episode_log is not None:
+            explorer.set_recorder(EpisodeRecorder(args.episode_log))
+        statistics = explorer.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+        if reference_statistics is not None:
+            logging.info('{} vs fp32: success rate {:.3f} vs {:.3f} ({:+.3f}), collision rate {:.3f} vs {:.3f} ({:+.3f})'.
+                         format(args.inference_precision, statistics[0], reference_statistics[0],
+                                statistics[0] - reference_statistics[0], statistics[1], reference_statistics[1],
+                                statistics[1] - reference_statistics[1]))
         if args.plot_test_scenarios_hist:
             test_angle_seeds = np.array(env.test_scene_seeds)
             b = [i * 0.01 for i in range(101)]
@@ -171,6 +199,14 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--planning_depth', type=int, default=None)
     parser.add_argument('-w', '--planning_width', type=int, default=None)
     parser.add_argument('--sparse_search', default=False, action='store_true')
+    parser.add_argument('--inference_precision', type=str, default='fp32', choices=['fp32', 'int8', 'bf16'])
+    parser.add_argument('--check_precision', default=False, action='store_true')
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--scenario_bank', type=str, default=None)
+    # per episode records, written as CSV for a .csv file and as JSON lines otherwise
+    parser.add_argument('--episode_log', type=str, default=None)
 
     sys_args = parser.parse_args()
+    if sys_args.check_precision and sys_args.inference_precision == 'fp32':
+        parser.error('--check_precision compares against fp32, it needs --inference_precision int8 or bf16')
     main(sys_args)
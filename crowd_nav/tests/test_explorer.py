@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+import numpy as np
+import torch
+from crowd_nav.utils.explorer import Explorer, discounted_returns
+from crowd_nav.utils.memory import ReplayMemory
+from crowd_sim.envs.utils.info import ReachGoal, Nothing
+
+EPISODE_LENGTHS = [3, 5, 1, 2, 4]
+
+
+class StubEnv(object):
+    """ Episodes of fixed lengths, the observation is the global step counter """
+    def __init__(self):
+        self.time_limit = 25
+        self.global_time = 0
+        self.random_seed = 0
+        self.episode = -1
+        self.step_num = 0
+        self.counter = 0
+
+    def reset(self, phase):
+        self.episode += 1
+        self.random_seed = self.episode
+        self.step_num = 0
+        return self.counter
+
+    def step(self, action):
+        self.step_num += 1
+        self.counter += 1
+        self.global_time = self.step_num * 0.25
+        done = self.step_num == EPISODE_LENGTHS[self.episode % len(EPISODE_LENGTHS)]
+        return self.counter, float(self.counter), done, ReachGoal() if done else Nothing()
+
+
+class StubRobot(object):
+    def __init__(self):
+        self.time_step = 0.25
+        self.v_pref = 1
+        self.policy = SimpleNamespace(name='stub', last_state=None, set_phase=lambda phase: None)
+
+    def act(self, ob):
+        # the number of humans changes along the episodes
+        self.policy.last_state = (torch.full((1, 9), float(ob)), torch.full((ob % 3 + 1, 5), float(ob)))
+        return None, ob % 7
+
+
+def get_explorer():
+    return Explorer(StubEnv(), StubRobot(), torch.device('cpu'), None, ReplayMemory(7), 0.9,
+                    target_policy=SimpleNamespace(name='TreeSearchRL'))
+
+
+def items_equal(items, other_items):
+    return len(items) == len(other_items) and all(
+        all(torch.equal(torch.as_tensor(x), torch.as_tensor(y)) for x, y in zip(item, other_item))
+        for item, other_item in zip(items, other_items))
+
+
+def test_generate_transitions():
+    chunk_size = 4
+    chunks = list(get_explorer().generate_transitions('train', chunk_size, k=len(EPISODE_LENGTHS)))
+
+    explorer = get_explorer()
+    items = []
+    sizes = []
+    for episode in explorer.generate_episodes('train', len(EPISODE_LENGTHS), keep_trajectory=True):
+        episode_items, episode_sizes = explorer.build_transitions(episode.states, episode.actions, episode.rewards)
+        items.extend(episode_items)
+        sizes.extend(episode_sizes)
+        explorer.update_memory(episode.states, episode.actions, episode.rewards)
+
+    # chunks span episode boundaries and only the last one is shorter
+    transition_num = sum(length - 1 for length in EPISODE_LENGTHS)
+    assert [len(chunk_items) for chunk_items, _ in chunks] == \
+        [chunk_size] * (transition_num // chunk_size) + [transition_num % chunk_size]
+    assert items_equal([item for chunk_items, _ in chunks for item in chunk_items], items)
+    assert [size for _, chunk_sizes in chunks for size in chunk_sizes] == sizes
+
+    # pushing the chunks fills the memory as pushing the episodes
+    memory = ReplayMemory(7)
+    for chunk_items, chunk_sizes in chunks:
+        memory.push_many(chunk_items, chunk_sizes)
+    assert items_equal(memory.memory, explorer.memory.memory)
+    assert memory.sizes == explorer.memory.sizes
+    assert memory.position == explorer.memory.position
+
+
+def test_discounted_returns():
+    rewards = np.random.default_rng(0).normal(0, 1, 40).tolist()
+    discount = 0.9 ** (0.25 * 1)
+    returns = [sum([pow(discount, t) * reward for t, reward in enumerate(rewards[step:])])
+               for step in range(len(rewards))]
+    assert np.allclose(discounted_returns(rewards, discount), returns)
+    assert len(discounted_returns([], discount)) == 0
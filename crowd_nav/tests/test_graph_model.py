@@ -0,0 +1,42 @@
+import torch
+from crowd_nav.configs.icra_benchmark.config import BasePolicyConfig
+from crowd_nav.policy.graph_model import RGL, SparseRGL, GAT_RL, SparseGAT_RL
+
+HUMAN_NUM = 6
+
+
+def get_inputs():
+    torch.manual_seed(0)
+    robot_states = torch.randn(3, 1, 9)
+    human_states = torch.randn(3, HUMAN_NUM, 5)
+    human_mask = torch.ones(3, HUMAN_NUM, dtype=torch.bool)
+    human_mask[1, 4:] = False
+    human_mask[2, 1:] = False
+    return robot_states, human_states, human_mask
+
+
+def check_sparse_matches_dense(dense_model_class, sparse_model_class):
+    config = BasePolicyConfig()
+    config.gcn.layerwise_graph = False
+    # every human has all other humans as neighbors
+    config.gcn.sparse_k = HUMAN_NUM - 1
+    dense_model = dense_model_class(config, 9, 5)
+    sparse_model = sparse_model_class(config, 9, 5)
+    sparse_model.load_state_dict(dense_model.state_dict())
+
+    robot_states, human_states, human_mask = get_inputs()
+    assert torch.allclose(dense_model((robot_states, human_states)), sparse_model((robot_states, human_states)),
+                          atol=1e-6)
+    # outputs of padded humans are meaningless
+    node_mask = torch.cat([torch.ones(3, 1, dtype=torch.bool), human_mask], dim=1)
+    dense_output = dense_model((robot_states, human_states, human_mask))
+    sparse_output = sparse_model((robot_states, human_states, human_mask))
+    assert torch.allclose(dense_output[node_mask], sparse_output[node_mask], atol=1e-6)
+
+
+def test_sparse_rgl():
+    check_sparse_matches_dense(RGL, SparseRGL)
+
+
+def test_sparse_gat_rl():
+    check_sparse_matches_dense(GAT_RL, SparseGAT_RL)
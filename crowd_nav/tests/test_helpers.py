@@ -0,0 +1,53 @@
+import warnings
+import torch
+import torch.nn as nn
+from crowd_nav.policy.helpers import mlp, DuelingDQN, FactorizedNoisyLinear, NoisyDuelingDQN, freeze_noisy_layers, \
+    quantize_dynamic_linear
+
+
+def check_quantized_close(model, input_dim):
+    torch.manual_seed(0)
+    model.eval()
+    inputs = torch.randn(64, input_dim)
+    with torch.no_grad():
+        expected = model(inputs)
+        with warnings.catch_warnings():
+            # the eager mode quantization api is deprecated in favour of torchao
+            warnings.simplefilter('ignore')
+            quantize_dynamic_linear(model)
+        outputs = model(inputs)
+    # every linear layer is replaced by its quantized version
+    assert not any(type(module) is nn.Linear for module in model.modules())
+    assert (outputs - expected).abs().max() < 0.05 * expected.abs().max()
+
+
+def test_quantize_dueling_dqn():
+    torch.manual_seed(0)
+    check_quantized_close(DuelingDQN(32, 81), 32)
+
+
+def test_quantize_mlp():
+    torch.manual_seed(0)
+    check_quantized_close(mlp(32, [150, 100, 100, 1]), 32)
+
+
+def test_frozen_noisy_layer():
+    torch.manual_seed(0)
+    layer = FactorizedNoisyLinear(16, 8)
+    linear = layer.to_linear()
+    inputs = torch.randn(4, 16)
+    assert torch.equal(linear.weight, layer.mu_weight) and torch.equal(linear.bias, layer.mu_bias)
+    layer.eval()
+    assert torch.allclose(linear(inputs), layer(inputs))
+
+
+def test_freeze_noisy_layers():
+    torch.manual_seed(0)
+    model = NoisyDuelingDQN(32, 81).eval()
+    inputs = torch.randn(4, 32)
+    with torch.no_grad():
+        expected = model(inputs)
+        freeze_noisy_layers(model)
+        outputs = model(inputs)
+    assert not any(isinstance(module, FactorizedNoisyLinear) for module in model.modules())
+    assert torch.allclose(outputs, expected)
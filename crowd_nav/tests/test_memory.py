@@ -0,0 +1,17 @@
+from crowd_nav.utils.memory import ReplayMemory
+
+
+def test_push_many_matches_push():
+    for capacity in [1, 5, 7]:
+        for chunk in [1, 3, 4, 12]:
+            memory = ReplayMemory(capacity)
+            reference = ReplayMemory(capacity)
+            for start in range(0, 30, chunk):
+                items = [(i,) for i in range(start, start + chunk)]
+                sizes = [i % 4 for i in range(start, start + chunk)]
+                memory.push_many(items, sizes)
+                for item, size in zip(items, sizes):
+                    reference.push(item, size)
+                assert memory.memory == reference.memory
+                assert memory.sizes == reference.sizes
+                assert memory.position == reference.position
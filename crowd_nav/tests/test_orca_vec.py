@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+# the crowd_sim package imports rvo2 as well
+rvo2 = pytest.importorskip('rvo2')
+from crowd_sim.envs.policy.orca_vec import compute_orca_velocities
+
+TIME_STEP = 0.25
+NEIGHBOR_DIST = 10
+MAX_NEIGHBORS = 10
+TIME_HORIZON = 5
+# rvo2 computes in float32
+TOLERANCE = 1e-4
+
+
+def random_scene(rng, agent_num, spread):
+    # inputs are rounded to float32 so that both solvers see the same scene
+    positions = rng.uniform(-spread, spread, (agent_num, 2)).astype(np.float32).astype(float)
+    velocities = rng.normal(0, 0.7, (agent_num, 2)).astype(np.float32).astype(float)
+    pref_velocities = rng.normal(0, 1, (agent_num, 2)).astype(np.float32).astype(float)
+    radii = rng.uniform(0.2, 0.5, agent_num).astype(np.float32).astype(float)
+    max_speeds = rng.uniform(0.5, 1.5, agent_num).astype(np.float32).astype(float)
+    return positions, velocities, pref_velocities, radii, max_speeds
+
+
+def rvo2_velocities(positions, velocities, pref_velocities, radii, max_speeds):
+    sim = rvo2.PyRVOSimulator(TIME_STEP, NEIGHBOR_DIST, MAX_NEIGHBORS, TIME_HORIZON, TIME_HORIZON, 0.3, 1)
+    for position, velocity, radius, max_speed in zip(positions, velocities, radii, max_speeds):
+        sim.addAgent(tuple(position), NEIGHBOR_DIST, MAX_NEIGHBORS, TIME_HORIZON, TIME_HORIZON, radius, max_speed,
+                     tuple(velocity))
+    for i, pref_velocity in enumerate(pref_velocities):
+        sim.setAgentPrefVelocity(i, tuple(pref_velocity))
+    sim.doStep()
+    return np.array([sim.getAgentVelocity(i) for i in range(len(positions))])
+
+
+def test_orca_vec_matches_rvo2():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        scene = random_scene(rng, rng.integers(2, 20), rng.choice([1.0, 3.0, 8.0]))
+        expected = rvo2_velocities(*scene)
+        velocities = compute_orca_velocities(*scene, TIME_STEP, NEIGHBOR_DIST, MAX_NEIGHBORS, TIME_HORIZON)
+        assert np.allclose(velocities, expected, rtol=0, atol=TOLERANCE)
+
+
+def test_orca_vec_batch_matches_single():
+    rng = np.random.default_rng(1)
+    scenes = [random_scene(rng, agent_num, 4.0) for agent_num in [5, 9, 1, 3]]
+    max_agent_num = max(len(scene[0]) for scene in scenes)
+    batch = [np.zeros((len(scenes), max_agent_num, 2)) for _ in range(3)] + \
+            [np.ones((len(scenes), max_agent_num)) for _ in range(2)]
+    agent_mask = np.zeros((len(scenes), max_agent_num), dtype=bool)
+    for i, scene in enumerate(scenes):
+        agent_num = len(scene[0])
+        for array, value in zip(batch, scene):
+            array[i, :agent_num] = value
+        agent_mask[i, :agent_num] = True
+
+    velocities = compute_orca_velocities(*batch, TIME_STEP, NEIGHBOR_DIST, MAX_NEIGHBORS, TIME_HORIZON, agent_mask)
+    for i, scene in enumerate(scenes):
+        expected = compute_orca_velocities(*scene, TIME_STEP, NEIGHBOR_DIST, MAX_NEIGHBORS, TIME_HORIZON)
+        assert np.allclose(velocities[i, :len(scene[0])], expected, rtol=0, atol=1e-12)
+    assert not velocities[~agent_mask].any()
@@ -0,0 +1,49 @@
+import itertools
+from types import SimpleNamespace
+import numpy as np
+from crowd_sim.envs.utils.scenario_bank import generate_scenarios, build_scenario_bank
+
+DISCOMFORT_DIST = 0.2
+ROBOT_RADIUS = 0.3
+CIRCLE_RADIUS = 4
+SQUARE_WIDTH = 10
+
+
+def test_generate_scenarios_keeps_distance():
+    for scenario, human_num, randomize_attributes in [('circle_crossing', 5, False), ('circle_crossing', 8, True),
+                                                       ('square_crossing', 6, True)]:
+        scenarios = generate_scenarios(scenario, human_num, 50, 0, CIRCLE_RADIUS, SQUARE_WIDTH, DISCOMFORT_DIST,
+                                       ROBOT_RADIUS, 0.3, 1, randomize_attributes)
+        # the robot is placed first
+        positions = np.concatenate([np.tile([[[0, -CIRCLE_RADIUS]]], (50, 1, 1)), scenarios['positions']], axis=1)
+        goals = np.concatenate([np.tile([[[0, CIRCLE_RADIUS]]], (50, 1, 1)), scenarios['goals']], axis=1)
+        radii = np.concatenate([np.full((50, 1), ROBOT_RADIUS), scenarios['radii']], axis=1)
+        for i, j in itertools.combinations(range(human_num + 1), 2):
+            min_dists = radii[:, i] + radii[:, j] + DISCOMFORT_DIST - 1e-9
+            assert np.all(np.linalg.norm(positions[:, i] - positions[:, j], axis=1) >= min_dists)
+            assert np.all(np.linalg.norm(goals[:, i] - goals[:, j], axis=1) >= min_dists)
+            if scenario == 'circle_crossing' and j <= 5:
+                # starts on the circle also keep away from the goals placed before them
+                assert np.all(np.linalg.norm(positions[:, j] - goals[:, i], axis=1) >= min_dists)
+
+
+def get_env(randomize_attributes=False):
+    return SimpleNamespace(test_scenario='circle_crossing', human_num=5, case_size={'test': 20},
+                           get_base_seed=lambda phase: 1000, circle_radius=CIRCLE_RADIUS, square_width=SQUARE_WIDTH,
+                           discomfort_dist=DISCOMFORT_DIST, robot=SimpleNamespace(radius=ROBOT_RADIUS),
+                           config=SimpleNamespace(humans=SimpleNamespace(radius=0.3, v_pref=1)),
+                           randomize_attributes=randomize_attributes)
+
+
+def test_scenario_bank_reload(tmp_path):
+    bank = build_scenario_bank(get_env(), 'test', str(tmp_path))
+    reloaded = build_scenario_bank(get_env(), 'test', str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    assert bank.keys() == reloaded.keys()
+    for key in bank:
+        assert np.array_equal(bank[key], reloaded[key])
+    assert reloaded['scenario'] == 'circle_crossing' and reloaded['human_num'] == 5
+
+    # a different generation parameter is a different bank
+    build_scenario_bank(get_env(randomize_attributes=True), 'test', str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('socialforce')
+# the crowd_sim package imports rvo2 as well
+pytest.importorskip('rvo2')
+from crowd_sim.envs.policy.socialforce import CentralizedSocialForce
+from crowd_sim.envs.policy.socialforce_vec import CentralizedSocialForceVec
+from crowd_sim.envs.utils.state import FullState
+
+TIME_STEP = 0.25
+
+
+def random_crowd(rng, agent_num, spread):
+    positions = rng.uniform(-spread, spread, (agent_num, 2))
+    velocities = rng.normal(0, 0.5, (agent_num, 2))
+    goals = rng.uniform(-spread, spread, (agent_num, 2))
+    return [FullState(px, py, vx, vy, 0.3, gx, gy, 1, 0)
+            for (px, py), (vx, vy), (gx, gy) in zip(positions, velocities, goals)]
+
+
+def get_policies():
+    policy = CentralizedSocialForce()
+    policy.time_step = TIME_STEP
+    vec_policy = CentralizedSocialForceVec()
+    vec_policy.time_step = TIME_STEP
+    return policy, vec_policy
+
+
+def velocities(actions):
+    return np.array([(action.vx, action.vy) for action in actions])
+
+
+def test_socialforce_vec_matches_socialforce():
+    rng = np.random.default_rng(0)
+    policy, vec_policy = get_policies()
+    for _ in range(50):
+        crowd = random_crowd(rng, rng.integers(2, 15), rng.choice([1.0, 3.0, 6.0]))
+        expected = velocities(policy.predict(crowd))
+        assert np.allclose(velocities(vec_policy.predict(crowd)), expected, rtol=0, atol=1e-6)
+
+
+def test_socialforce_vec_padded_batch():
+    rng = np.random.default_rng(1)
+    policy, vec_policy = get_policies()
+    crowds = [random_crowd(rng, agent_num, 3.0) for agent_num in [6, 2, 9, 1]]
+    batch_actions = vec_policy.predict_batch(crowds)
+    for crowd, actions in zip(crowds, batch_actions):
+        assert len(actions) == len(crowd)
+        assert np.allclose(velocities(actions), velocities(policy.predict(crowd)), rtol=0, atol=1e-6)
@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+from crowd_nav.configs.icra_benchmark.config import BaseEnvConfig
+from crowd_nav.configs.icra_benchmark.ts_separate import PolicyConfig
+from crowd_nav.policy.graph_model import GAT_RL
+from crowd_nav.policy.state_predictor import StatePredictor, LinearStatePredictor_batch, propagate_robot_states
+from crowd_sim.envs.utils.action import ActionXY, ActionRot
+from crowd_sim.envs.utils.robot import Robot
+
+TIME_STEP = 0.25
+
+
+def random_robots(rng, batch_size):
+    robots = []
+    for _ in range(batch_size):
+        robot = Robot(BaseEnvConfig(), 'robot')
+        robot.time_step = TIME_STEP
+        px, py, gx, gy, vx, vy = rng.uniform(-4, 4, 6)
+        # headings close to 2 pi wrap around with a positive rotation
+        robot.set(px, py, gx, gy, vx, vy, rng.uniform(0, 2 * np.pi), v_pref=rng.uniform(0.5, 1.5))
+        robots.append(robot)
+    return robots
+
+
+def check_propagate_robot_states(kinematics, actions):
+    rng = np.random.default_rng(0)
+    robots = random_robots(rng, len(actions))
+    robot_states = torch.tensor([[robot.get_full_state().to_tuple()] for robot in robots], dtype=torch.float64)
+    next_robot_states = propagate_robot_states(robot_states, torch.tensor([tuple(action) for action in actions]),
+                                               kinematics, TIME_STEP)
+    for robot, action in zip(robots, actions):
+        robot.kinematics = kinematics
+        robot.step(action)
+    expected = torch.tensor([[robot.get_full_state().to_tuple()] for robot in robots], dtype=torch.float64)
+    assert torch.allclose(next_robot_states, expected, atol=1e-6)
+
+
+def test_propagate_holonomic():
+    rng = np.random.default_rng(1)
+    check_propagate_robot_states('holonomic', [ActionXY(*rng.uniform(-1, 1, 2)) for _ in range(20)])
+
+
+def test_propagate_unicycle():
+    rng = np.random.default_rng(2)
+    actions = [ActionRot(rng.uniform(0, 1), rng.uniform(-np.pi / 3, np.pi / 3)) for _ in range(20)]
+    # wrap around 2 pi in both directions
+    actions += [ActionRot(0.5, 2 * np.pi - 0.1), ActionRot(0.5, -2 * np.pi + 0.1)]
+    check_propagate_robot_states('unicycle', actions)
+
+
+def test_propagate_gradient():
+    torch.manual_seed(0)
+    robot_states = torch.rand(4, 1, 9, dtype=torch.float64)
+    actions = torch.rand(4, 2, dtype=torch.float64)
+    for kinematics in ['holonomic', 'unicycle']:
+        assert torch.autograd.gradcheck(lambda states, actions: propagate_robot_states(
+            states, actions, kinematics, TIME_STEP), (robot_states.requires_grad_(), actions.requires_grad_()))
+
+
+def get_rollout_inputs(horizon):
+    torch.manual_seed(0)
+    robot_states = torch.randn(3, 1, 9)
+    human_masks = torch.ones(3, 4, dtype=torch.bool)
+    human_masks[1, 2:] = False
+    human_masks[2, 1:] = False
+    human_states = torch.randn(3, 4, 5) * human_masks.unsqueeze(2)
+    action_space = [ActionXY(vx, vy) for vx in [-0.5, 0, 0.5] for vy in [-0.5, 0, 0.5]]
+    action_idx_seq = torch.randint(0, len(action_space), (horizon, 3))
+    return (robot_states, human_states, human_masks), action_space, action_idx_seq
+
+
+def check_rollout(state_predictor, predict_humans):
+    horizon = 4
+    state, action_space, action_idx_seq = get_rollout_inputs(horizon)
+    state_predictor.set_action_space(action_space)
+    robot_states, human_states = state_predictor.rollout(state, action_idx_seq)
+    assert robot_states.shape == (horizon, 3, 1, 9)
+    assert human_states.shape == (horizon, 3, 4, 5)
+
+    # T chained single steps
+    actions = torch.tensor([tuple(action) for action in action_space])[action_idx_seq]
+    for t in range(horizon):
+        next_robot_states = propagate_robot_states(state[0], actions[t], state_predictor.kinematics, TIME_STEP)
+        next_human_states = predict_humans(state)
+        assert torch.allclose(robot_states[t], next_robot_states, atol=1e-6)
+        assert torch.allclose(human_states[t], next_human_states, atol=1e-6)
+        state = (next_robot_states, next_human_states, state[2])
+    # padded humans stay zero
+    assert not human_states[:, ~state[2]].any()
+
+
+def test_rollout():
+    config = PolicyConfig()
+    state_predictor = StatePredictor(config, GAT_RL(config, 9, 5), TIME_STEP)
+    with torch.no_grad():
+        check_rollout(state_predictor, lambda state: state_predictor(state, None)[1])
+
+
+def test_linear_rollout():
+    state_predictor = LinearStatePredictor_batch(PolicyConfig(), TIME_STEP)
+    check_rollout(state_predictor, lambda state: state_predictor.linear_motion_approximator(state[1]))
@@ -0,0 +1,38 @@
+import numpy as np
+from crowd_nav.utils.statistics import StreamingQuantile, DiscountedReturn
+
+
+def test_streaming_quantile_error():
+    rng = np.random.default_rng(0)
+    values = rng.normal(10, 2, 5000)
+    for q in [0.5, 0.9]:
+        quantile = StreamingQuantile(q)
+        for value in values:
+            quantile.push(value)
+        assert abs(quantile.value - np.quantile(values, q)) < 0.05
+
+
+def test_streaming_quantile_exact():
+    values = [3.0, 1.0, 4.0, 1.5, 5.0]
+    for n in range(1, len(values) + 1):
+        quantile = StreamingQuantile(0.5)
+        for value in values[:n]:
+            quantile.push(value)
+        assert quantile.value == sorted(values[:n])[int(round((n - 1) * 0.5))]
+    assert StreamingQuantile(0.9).value == 0
+
+
+def test_discounted_return():
+    rng = np.random.default_rng(0)
+    rewards = rng.normal(0, 1, 50)
+    discount = 0.9
+    episode_return = DiscountedReturn(discount)
+    for reward in rewards:
+        episode_return.push(reward)
+
+    returns = [sum(discount ** (t - i) * rewards[t] for t in range(i, len(rewards))) for i in range(len(rewards))]
+    assert np.isclose(episode_return.value, returns[0])
+    assert np.isclose(episode_return.average, np.mean(returns))
+    assert np.isclose(episode_return.total, rewards.sum())
+    assert episode_return.steps == len(rewards)
+    assert DiscountedReturn(discount).average == 0
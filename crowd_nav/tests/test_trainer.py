@@ -0,0 +1,72 @@
+import torch
+from crowd_nav.configs.icra_benchmark.ts_separate import PolicyConfig
+from crowd_nav.policy.tree_searchrl import TreeSearchRL
+from crowd_nav.utils.memory import ReplayMemory
+from crowd_nav.utils.trainer import TSRLTrainer, pad_human_batch, padded_state
+
+
+def get_trainer(share_graph_model):
+    torch.manual_seed(0)
+    config = PolicyConfig()
+    config.model_predictive_rl.share_graph_model = share_graph_model
+    policy = TreeSearchRL()
+    policy.configure(config, torch.device('cpu'))
+    trainer = TSRLTrainer(policy.value_estimator, policy.state_predictor, ReplayMemory(100), torch.device('cpu'),
+                          policy, None, 4, 'Adam', 5, False, False, False, share_graph_model)
+    trainer.update_target_model(policy.value_estimator)
+    # a target model different from the online one
+    with torch.no_grad():
+        for param in trainer.target_model.parameters():
+            param.add_(0.1 * torch.randn_like(param))
+    trainer.target_model.value_network.eval()
+    trainer.value_estimator.value_network.eval()
+    return trainer
+
+
+def get_batch(human_nums):
+    """ human_nums holds the numbers of humans of the state and the next state of every experience """
+    torch.manual_seed(1)
+    batch = [(torch.randn(1, 9), torch.randn(human_num, 5), int(torch.randint(0, 81, ())), torch.zeros(1),
+              torch.randn(1), torch.randn(1, 9), torch.randn(next_human_num, 5))
+             for human_num, next_human_num in human_nums]
+    robot_states, human_states, actions, _, rewards, next_robot_states, next_human_states, \
+        human_masks, next_human_masks = pad_human_batch(batch)
+    return padded_state(robot_states, human_states, human_masks), actions, rewards, \
+        padded_state(next_robot_states, next_human_states, next_human_masks)
+
+
+def check_value_targets(share_graph_model, human_nums):
+    trainer = get_trainer(share_graph_model)
+    states, actions, rewards, next_states = get_batch(human_nums)
+    assert (len(states) == 3) == (len(set(sum(human_nums, ()))) > 1)
+    predictor_states = states if share_graph_model else None
+    outputs, target_values, predictor_embeddings = trainer.compute_value_targets(states, next_states, actions,
+                                                                                 rewards, predictor_states)
+
+    # separate forward passes of the online and the target models
+    expected_outputs = trainer.value_estimator(states).gather(1, actions.unsqueeze(1))
+    max_next_Q_index = torch.max(trainer.value_estimator(next_states), dim=1)[1]
+    next_Q_value = trainer.target_model(next_states).gather(1, max_next_Q_index.unsqueeze(1))
+    expected_target_values = rewards + next_Q_value * pow(trainer.gamma, trainer.time_step * trainer.v_pref)
+    assert torch.allclose(outputs, expected_outputs, atol=1e-6)
+    assert torch.allclose(target_values, expected_target_values, atol=1e-6)
+
+    if share_graph_model:
+        _, next_human_states_est = trainer.state_predictor.predict_from_embedding(predictor_embeddings, states)
+        _, expected_next_human_states = trainer.state_predictor(states, None)
+        assert torch.allclose(next_human_states_est, expected_next_human_states, atol=1e-6)
+    else:
+        assert predictor_embeddings is None
+
+
+def test_value_targets():
+    check_value_targets(False, [(5, 5)] * 4)
+
+
+def test_value_targets_masked():
+    check_value_targets(False, [(5, 4), (3, 3), (1, 0), (4, 5)])
+
+
+def test_value_targets_shared_graph_model():
+    check_value_targets(True, [(5, 5)] * 4)
+    check_value_targets(True, [(5, 4), (3, 3), (1, 0), (4, 5)])
@@ -5,16 +5,20 @@ import os
 import shutil
 import importlib.util
 import torch
+import torch.distributed as dist
 import gym
 import copy
 import git
 import re
 from tensorboardX import SummaryWriter
 from crowd_sim.envs.utils.robot import Robot
-from crowd_nav.utils.trainer import VNRLTrainer, MPRLTrainer, TSRLTrainer
+from crowd_sim.envs.utils.scenario_bank import build_scenario_bank
+from crowd_nav.utils.trainer import VNRLTrainer, MPRLTrainer, TSRLTrainer, broadcast_state_dict
 from crowd_nav.utils.memory import ReplayMemory
 from crowd_nav.utils.explorer import Explorer
-from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.utils.actor_learner import ActorPool
+from crowd_nav.utils.statistics import EpisodeRecorder
+from crowd_nav.policy.policy_factory import policy_factory, configure_sensing
 
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import plot, savefig
@@ -29,11 +33,22 @@ def set_random_seeds(seed):
     return None
 
 
+def crossed(previous, current, interval):
+    """ Whether a multiple of interval lies in (previous, current] """
+    return current // interval > previous // interval
+
+
 def main(args):
-    set_random_seeds(args.randomseed)
+    rank, world_size = 0, 1
+    if args.distributed:
+        # replicas average their gradients over gloo, rank 0 writes the output directory, logs and checkpoints
+        dist.init_process_group('gloo', init_method=args.dist_url, rank=args.rank, world_size=args.world_size)
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    is_main_process = rank == 0
+    set_random_seeds(args.randomseed + rank)
     # configure paths
-    make_new_dir = True
-    if os.path.exists(args.output_dir):
+    make_new_dir = is_main_process
+    if is_main_process and os.path.exists(args.output_dir):
         if args.overwrite:
             shutil.rmtree(args.output_dir)
         else:
@@ -61,7 +76,8 @@ def main(args):
         # with open(os.path.join(args.output_dir, 'config.py'), 'w') as fo:
         #     fo.write(config_text)
 
-    args.config = os.path.join(args.output_dir, 'config.py')
+    if is_main_process:
+        args.config = os.path.join(args.output_dir, 'config.py')
     log_file = os.path.join(args.output_dir, 'output.log')
     in_weight_file = os.path.join(args.output_dir, 'in_model.pth')
     il_weight_file = os.path.join(args.output_dir, 'il_model.pth')
@@ -75,10 +91,14 @@ def main(args):
 
     # configure logging
     mode = 'a' if args.resume else 'w'
-    file_handler = logging.FileHandler(log_file, mode=mode)
     stdout_handler = logging.StreamHandler(sys.stdout)
+    handlers = [stdout_handler]
+    if is_main_process:
+        handlers.append(logging.FileHandler(log_file, mode=mode))
     level = logging.INFO if not args.debug else logging.DEBUG
-    logging.basicConfig(level=level, handlers=[stdout_handler, file_handler],
+    if not is_main_process:
+        level = logging.WARNING
+    logging.basicConfig(level=level, handlers=handlers,
                         format='%(asctime)s, %(levelname)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
     repo = git.Repo(search_parent_directories=True)
     logging.info('Current git head hash code: {}'.format(repo.head.object.hexsha))
@@ -86,7 +106,10 @@ def main(args):
     logging.info('Current config content is :{}'.format(config))
     device = torch.device("cuda:0" if torch.cuda.is_available() and args.gpu else "cpu")
     logging.info('Using device: %s', device)
-    writer = SummaryWriter(log_dir=args.output_dir)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    logging.info('Using %d intra-op threads', torch.get_num_threads())
+    writer = SummaryWriter(log_dir=args.output_dir) if is_main_process else None
 
     # configure policy
     policy_config = config.PolicyConfig()
@@ -103,6 +126,9 @@ def main(args):
     robot = Robot(env_config, 'robot')
     robot.time_step = env.time_step
     env.set_robot(robot)
+    # every replica explores its own training cases and fills its own replay memory
+    env.case_counter['train'] = rank * env.case_size['train'] // world_size
+    configure_sensing(env, policy)
 
     # read training parameters
     train_config = config.TrainConfig(args.debug)
@@ -123,32 +149,41 @@ def main(args):
     model = policy.get_model()
     batch_size = train_config.trainer.batch_size
     optimizer = train_config.trainer.optimizer
+    # with polyak averaging the target model follows the model after every update
+    target_update_tau = train_config.train.target_update_tau if hasattr(train_config.train, 'target_update_tau') else None
     print(policy_config.name)
     if policy_config.name == 'model_predictive_rl':
         trainer = MPRLTrainer(model, policy.state_predictor, memory, device, policy, writer, batch_size, optimizer, env.human_num,
                               reduce_sp_update_frequency=train_config.train.reduce_sp_update_frequency,
                               freeze_state_predictor=train_config.train.freeze_state_predictor,
                               detach_state_predictor=train_config.train.detach_state_predictor,
-                              share_graph_model=policy_config.model_predictive_rl.share_graph_model)
+                              share_graph_model=policy_config.model_predictive_rl.share_graph_model,
+                              target_update_tau=target_update_tau)
     elif policy_config.name == 'tree_search_rl':
+        bucket_width = train_config.trainer.bucket_width if hasattr(train_config.trainer, 'bucket_width') else None
         trainer = TSRLTrainer(model, policy.state_predictor, memory, device, policy, writer, batch_size, optimizer, env.human_num,
                               reduce_sp_update_frequency=train_config.train.reduce_sp_update_frequency,
                               freeze_state_predictor=train_config.train.freeze_state_predictor,
                               detach_state_predictor=train_config.train.detach_state_predictor,
-                              share_graph_model=policy_config.model_predictive_rl.share_graph_model)
+                              share_graph_model=policy_config.model_predictive_rl.share_graph_model,
+                              bucket_width=bucket_width, target_update_tau=target_update_tau)
 
     elif policy_config.name == 'gat_predictive_rl':
         trainer = MPRLTrainer(model, policy.state_predictor, memory, device, policy, writer, batch_size, optimizer, env.human_num,
                               reduce_sp_update_frequency=train_config.train.reduce_sp_update_frequency,
                               freeze_state_predictor=train_config.train.freeze_state_predictor,
                               detach_state_predictor=train_config.train.detach_state_predictor,
-                              share_graph_model=policy_config.model_predictive_rl.share_graph_model)
+                              share_graph_model=policy_config.model_predictive_rl.share_graph_model,
+                              target_update_tau=target_update_tau)
     else:
         trainer = VNRLTrainer(model, memory, device, policy, batch_size, optimizer, writer)
     explorer = Explorer(env, robot, device, writer, memory, policy.gamma, target_policy=policy)
-    policy.save_model(in_weight_file)
+    if args.episode_log is not None and is_main_process:
+        explorer.set_recorder(EpisodeRecorder(args.episode_log, writer))
+    if is_main_process:
+        policy.save_model(in_weight_file)
     # imitation learning
-    if args.resume:
+    if args.resume and is_main_process:
         if not os.path.exists(rl_weight_file):
             logging.error('RL weights does not exist')
         policy.load_state_dict(torch.load(rl_weight_file))
@@ -181,12 +216,18 @@ def main(args):
     #     logging.info('Experience set size: %d/%d', len(memory), memory.capacity)
 
 
+    # all replicas start from the weights of rank 0
+    broadcast_state_dict(policy.get_state_dict())
     trainer.update_target_model(model)
 
     # reinforcement learning
     policy.set_env(env)
     robot.set_policy(policy)
     robot.print_info()
+    if args.scenario_bank is not None and is_main_process:
+        # the same precomputed val and test cases for every evaluation
+        for phase in ['val', 'test']:
+            env.set_scenario_bank(phase, build_scenario_bank(env, phase, args.scenario_bank))
     trainer.set_rl_learning_rate(rl_learning_rate)
     # fill the memory pool with some RL experience
     if args.resume:
@@ -198,7 +239,7 @@ def main(args):
     best_val_model = None
     # evaluate the model after imitation learning
 
-    if episode % evaluation_interval == 0:
+    if is_main_process and episode % evaluation_interval == 0:
         logging.info('Evaluate the model instantly after imitation learning on the validation cases')
         explorer.run_k_episodes(env.case_size['val'], 'val', episode=episode)
         explorer.log('val', episode // evaluation_interval)
@@ -219,8 +260,15 @@ def main(args):
     discom_time_in_last_interval = 0
     total_time_in_last_interval = 0
     eps_count = 0
-    fw = open(sys_args.output_dir + '/data.txt', 'w')
-    print("%f %f %f %f %f" % (0,0,0,0,0), file=fw)
+    fw = open(sys_args.output_dir + '/data.txt', 'w') if is_main_process else None
+    actor_pool = None
+    if args.num_actors > 0:
+        actor_pool = ActorPool(args.config, args.num_actors, policy, args.randomseed, args.debug, rank, world_size)
+        actor_pool.start(policy, epsilon_end if args.resume else epsilon_start)
+    # in actor mode episode counts the episodes received from the actors, the learner optimizes once per round
+    learner_round = 0
+    if is_main_process:
+        print("%f %f %f %f %f" % (0,0,0,0,0), file=fw)
     while episode < train_episodes:
         if args.resume:
             epsilon = epsilon_end
@@ -232,49 +280,71 @@ def main(args):
         robot.policy.set_epsilon(epsilon)
 
         # sample k episodes into memory and optimize over the generated memory
-        _, _, nav_time, sum_reward, ave_return, discom_time, total_time = \
-            explorer.run_k_episodes(sample_episodes, 'train', update_memory=True, episode=episode)
-        eps_count = eps_count + 1
-        reward_in_last_interval = reward_in_last_interval + sum_reward
-        return_in_last_interval = return_in_last_interval + ave_return
-        nav_time__in_last_interval = nav_time__in_last_interval + nav_time
-        discom_time_in_last_interval = discom_time_in_last_interval + discom_time
-        total_time_in_last_interval = total_time_in_last_interval + total_time
-        interval = 100
-        if eps_count % interval == 0:
-            reward_rec.append(reward_in_last_interval/100.0)
-            return_rec.append(return_in_last_interval/100.0)
-            discom_tim_rec.append(discom_time_in_last_interval/100.0)
-            nav_time_rec.append(nav_time__in_last_interval/100.0)
-            total_time_rec.append(total_time_in_last_interval/100.0)
-            logging.info('Train in episode %d reward in last 100 episodes %f %f %f %f %f', eps_count, reward_rec[-1],
-                         return_rec[-1], discom_tim_rec[-1], nav_time_rec[-1], total_time_rec[-1])
-            print("%f %f %f %f %f" % (reward_rec[-1], return_rec[-1], discom_tim_rec[-1], nav_time_rec[-1],
-                                     total_time_rec[-1]), file=fw)
-            reward_in_last_interval = 0
-            return_in_last_interval = 0
-            nav_time__in_last_interval = 0
-            discom_time_in_last_interval = 0
-            total_time_in_last_interval = 0
-            min_reward = -10
-            max_reward = 10
-            pos = np.array(range(1, len(reward_rec)+1)) * interval
-            plt.plot(pos, reward_rec, color='r', marker='.', linestyle='dashed')
-            plt.axis([0, eps_count, min_reward, max_reward])
-            savefig(args.output_dir + "/reward_record.jpg")
-        explorer.log('train', episode)
+        if actor_pool is None:
+            train_statistics = [explorer.run_k_episodes(sample_episodes, 'train', update_memory=True, episode=episode)]
+        else:
+            # the actors keep exploring while the learner optimizes, only wait for them when the memory is too small
+            if learner_round % args.actor_sync_interval == 0:
+                actor_pool.publish(policy, epsilon)
+            train_statistics = actor_pool.collect(memory, device, min_episodes=0 if len(memory) >= batch_size else 1)
+        if actor_pool is None:
+            new_episodes = 1
+        elif args.distributed:
+            # every rank counts the episodes received by all ranks, so that they stop and sync at the same round
+            new_episodes = torch.tensor(len(train_statistics))
+            dist.all_reduce(new_episodes)
+            new_episodes = int(new_episodes)
+        else:
+            new_episodes = len(train_statistics)
+        if not is_main_process:
+            # only rank 0 logs the training episodes
+            train_statistics = []
+        for _, _, nav_time, sum_reward, ave_return, discom_time, total_time in train_statistics:
+            eps_count = eps_count + 1
+            reward_in_last_interval = reward_in_last_interval + sum_reward
+            return_in_last_interval = return_in_last_interval + ave_return
+            nav_time__in_last_interval = nav_time__in_last_interval + nav_time
+            discom_time_in_last_interval = discom_time_in_last_interval + discom_time
+            total_time_in_last_interval = total_time_in_last_interval + total_time
+            interval = 100
+            if eps_count % interval == 0:
+                reward_rec.append(reward_in_last_interval/100.0)
+                return_rec.append(return_in_last_interval/100.0)
+                discom_tim_rec.append(discom_time_in_last_interval/100.0)
+                nav_time_rec.append(nav_time__in_last_interval/100.0)
+                total_time_rec.append(total_time_in_last_interval/100.0)
+                logging.info('Train in episode %d reward in last 100 episodes %f %f %f %f %f', eps_count, reward_rec[-1],
+                             return_rec[-1], discom_tim_rec[-1], nav_time_rec[-1], total_time_rec[-1])
+                print("%f %f %f %f %f" % (reward_rec[-1], return_rec[-1], discom_tim_rec[-1], nav_time_rec[-1],
+                                         total_time_rec[-1]), file=fw)
+                reward_in_last_interval = 0
+                return_in_last_interval = 0
+                nav_time__in_last_interval = 0
+                discom_time_in_last_interval = 0
+                total_time_in_last_interval = 0
+                min_reward = -10
+                max_reward = 10
+                pos = np.array(range(1, len(reward_rec)+1)) * interval
+                plt.plot(pos, reward_rec, color='r', marker='.', linestyle='dashed')
+                plt.axis([0, eps_count, min_reward, max_reward])
+                savefig(args.output_dir + "/reward_record.jpg")
+        if train_statistics:
+            explorer.statistics = train_statistics[-1]
+            explorer.log('train', episode)
 
         trainer.optimize_batch(train_batches, episode)
-        episode += 1
+        learner_round += 1
+        previous_episode = episode
+        episode += new_episodes
 
-        if episode % target_update_interval == 0:
+        if target_update_tau is None and crossed(previous_episode, episode, target_update_interval):
             trainer.update_target_model(model)
         # evaluate the model
-        if episode % evaluation_interval == 0:
+        if is_main_process and crossed(previous_episode, episode, evaluation_interval):
             _, _, _, reward, _, _, _ = explorer.run_k_episodes(env.case_size['val'], 'val', episode=episode)
             explorer.log('val', episode // evaluation_interval)
 
-            if episode % checkpoint_interval == 0:
+            if crossed(previous_episode, episode, checkpoint_interval):
                 best_val_reward = reward
                 best_val_model = copy.deepcopy(policy.get_state_dict())
         # test after every evaluation to check how the generalization performance evolves
@@ -282,18 +352,26 @@ def main(args):
                 explorer.run_k_episodes(env.case_size['test'], 'test', episode=episode, print_failure=True)
                 explorer.log('test', episode // evaluation_interval)
 
-        if episode != 0 and episode % checkpoint_interval == 0:
+        if is_main_process and crossed(previous_episode, episode, checkpoint_interval):
             current_checkpoint = episode // checkpoint_interval - 1
             save_every_checkpoint_rl_weight_file = rl_weight_file.split('.')[0] + '_' + str(current_checkpoint) + '.pth'
             policy.save_model(save_every_checkpoint_rl_weight_file)
 
     # # test with the best val model
+    if actor_pool is not None:
+        actor_pool.stop()
+    if args.distributed:
+        dist.destroy_process_group()
+    if not is_main_process:
+        return
     fw.close()
     if best_val_model is not None:
         policy.load_state_dict(best_val_model)
         torch.save(best_val_model, os.path.join(args.output_dir, 'best_val.pth'))
         logging.info('Save the best val model with the reward: {}'.format(best_val_reward))
     explorer.run_k_episodes(env.case_size['test'], 'test', episode=episode, print_failure=True)
+    if explorer.recorder is not None:
+        explorer.recorder.close()
 
 
 if __name__ == '__main__':
@@ -308,6 +386,19 @@ if __name__ == '__main__':
     parser.add_argument('--debug', default=False, action='store_true')
     parser.add_argument('--test_after_every_eval', default=False, action='store_true')
     parser.add_argument('--randomseed', type=int, default=7)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--scenario_bank', type=str, default=None)
+    # per episode records, written as CSV for a .csv file and as JSON lines otherwise
+    parser.add_argument('--episode_log', type=str, default=None)
+    # number of actor processes collecting experience in parallel with the learner, 0 alternates in one process
+    parser.add_argument('--num_actors', type=int, default=0)
+    # learner rounds between two weight publications, the episode based schedules count the received episodes
+    parser.add_argument('--actor_sync_interval', type=int, default=1)
+    # data parallel training over gloo, e.g. launched with torchrun --nproc_per_node N (--nnodes M for several nodes)
+    parser.add_argument('--distributed', default=False, action='store_true')
+    parser.add_argument('--dist_url', type=str, default='env://')
+    parser.add_argument('--rank', type=int, default=-1)
+    parser.add_argument('--world_size', type=int, default=-1)
 
     # arguments for GCN
     # parser.add_argument('--X_dim', type=int, default=32)
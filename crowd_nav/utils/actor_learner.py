@@ -0,0 +1,179 @@
+import queue
+import logging
+import importlib.util
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import gym
+from crowd_sim.envs.utils.robot import Robot
+from crowd_nav.utils.explorer import Explorer
+from crowd_nav.policy.policy_factory import policy_factory, configure_sensing
+
+
+def share_state_dict(state_dict):
+    """ Copy of a (nested) state dict with every tensor moved to shared memory """
+    if isinstance(state_dict, dict):
+        return {key: share_state_dict(value) for key, value in state_dict.items()}
+    return state_dict.detach().cpu().clone().share_memory_()
+
+
+def copy_state_dict(target, source):
+    """ Copy the tensors of the (nested) state dict source into target in place """
+    for key, value in source.items():
+        if isinstance(value, dict):
+            copy_state_dict(target[key], value)
+        else:
+            target[key].copy_(value)
+
+
+def to_numpy(item):
+    return item.numpy() if torch.is_tensor(item) else item
+
+
+def from_numpy(item, device):
+    return torch.from_numpy(item).to(device) if isinstance(item, np.ndarray) else item
+
+
+class SharedWeights(object):
+    def __init__(self, policy, context):
+        """
+        Weights of the learner policy in shared memory, published by the learner and pulled by the actors together
+        with the exploration epsilon. The version counter tells the actors whether there is anything new to load
+        """
+        self.state_dict = share_state_dict(policy.get_state_dict())
+        self.lock = context.Lock()
+        self.version = context.Value('i', 0)
+        self.epsilon = context.Value('d', 1.0)
+
+    def publish(self, policy, epsilon):
+        with self.lock:
+            copy_state_dict(self.state_dict, policy.get_state_dict())
+            self.epsilon.value = epsilon
+            self.version.value += 1
+
+    def pull(self, policy, version):
+        """ Load the weights into policy if they are newer than version, returns the loaded version """
+        if self.version.value == version:
+            return version
+        with self.lock:
+            policy.load_state_dict(self.state_dict)
+            policy.set_epsilon(self.epsilon.value)
+            return self.version.value
+
+
+class ActorMemory(object):
+    def __init__(self):
+        """ Collect the experiences of an episode on the actor side, they are sent to the learner all at once """
+        self.memory = list()
+
+    def push_many(self, items, sizes):
+        # numpy arrays are pickled through the queue instead of holding a shared memory handle per tensor
+        self.memory.extend((tuple(to_numpy(x) for x in item), size) for item, size in zip(items, sizes))
+
+    def flush(self):
+        memory = self.memory
+        self.memory = list()
+        return memory
+
+
+def run_actor(actor_id, actor_num, config_file, debug, seed, shared_weights, experience_queue, stop_event,
+              rank=0, world_size=1):
+    """
+    Actor process, runs training episodes of its own CrowdSim with the latest published weights and puts
+    (experiences, statistics) of every episode into experience_queue until stop_event is set. actor_id is the
+    index of the actor within the pool of the learner of the given rank
+    """
+    # experiences still buffered at shutdown are dropped instead of blocking the exit
+    experience_queue.cancel_join_thread()
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    spec = importlib.util.spec_from_file_location('config', config_file)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+
+    device = torch.device('cpu')
+    policy_config = config.PolicyConfig()
+    policy = policy_factory[policy_config.name]()
+    policy.configure(policy_config, device)
+    policy.set_device(device)
+    env_config = config.EnvConfig(debug)
+    env = gym.make('CrowdSim-v0')
+    env.configure(env_config)
+    robot = Robot(env_config, 'robot')
+    robot.time_step = env.time_step
+    env.set_robot(robot)
+    configure_sensing(env, policy)
+    policy.set_env(env)
+    robot.set_policy(policy)
+    # actors of all replicas start from different training cases
+    env.case_counter['train'] = (rank * actor_num + actor_id) * env.case_size['train'] // (world_size * actor_num)
+
+    memory = ActorMemory()
+    explorer = Explorer(env, robot, device, None, memory, policy.gamma, target_policy=policy)
+    version = 0
+    while not stop_event.is_set():
+        version = shared_weights.pull(policy, version)
+        statistics = explorer.run_k_episodes(1, 'train', update_memory=True)
+        experiences = memory.flush()
+        while not stop_event.is_set():
+            try:
+                experience_queue.put((experiences, statistics), timeout=1)
+                break
+            except queue.Full:
+                continue
+
+
+class ActorPool(object):
+    def __init__(self, config_file, actor_num, policy, seed, debug=False, rank=0, world_size=1):
+        """
+        Ape-X style experience collection, actor_num processes explore with periodically published copies of the
+        learner policy while the learner keeps optimizing. With data parallel training every rank has its own
+        pool, the learners use the seeds seed to seed + world_size - 1 and the actors the following ones
+        """
+        context = mp.get_context('spawn')
+        self.shared_weights = SharedWeights(policy, context)
+        self.experience_queue = context.Queue(maxsize=4 * actor_num)
+        self.stop_event = context.Event()
+        self.actors = [context.Process(target=run_actor, daemon=True,
+                                       args=(i, actor_num, config_file, debug, seed + world_size + rank * actor_num + i,
+                                             self.shared_weights, self.experience_queue, self.stop_event, rank,
+                                             world_size))
+                       for i in range(actor_num)]
+
+    def start(self, policy, epsilon):
+        self.publish(policy, epsilon)
+        for actor in self.actors:
+            actor.start()
+        logging.info('Started %d actors', len(self.actors))
+
+    def publish(self, policy, epsilon):
+        self.shared_weights.publish(policy, epsilon)
+
+    def collect(self, memory, device, min_episodes=1):
+        """
+        Move the experiences sent by the actors into memory on the learner device, waits for at least min_episodes
+        episodes. Returns the statistics of the received episodes
+        """
+        statistics = []
+        while True:
+            try:
+                block = len(statistics) < min_episodes
+                experiences, episode_statistics = self.experience_queue.get(block=block, timeout=1)
+            except queue.Empty:
+                if not block:
+                    break
+                if not any(actor.is_alive() for actor in self.actors):
+                    raise RuntimeError('All actors have exited')
+                continue
+            memory.push_many([tuple(from_numpy(x, device) for x in item) for item, _ in experiences],
+                             [size for _, size in experiences])
+            statistics.append(episode_statistics)
+        return statistics
+
+    def stop(self):
+        self.stop_event.set()
+        for actor in self.actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
@@ -1,9 +1,21 @@
 import os
 import logging
 import copy
+import numpy as np
 import torch
 from tqdm import tqdm
 from crowd_sim.envs.utils.info import *
+from crowd_nav.utils.statistics import EpisodeStatistics
+
+class Episode(object):
+    def __init__(self, record, info, states, actions, rewards):
+        """ A finished episode, its record, end signal and the trajectory if it was kept """
+        self.record = record
+        self.info = info
+        self.states = states
+        self.actions = actions
+        self.rewards = rewards
+
 
 class Explorer(object):
     def __init__(self, env, robot, device, writer, memory=None, gamma=None, target_policy=None):
@@ -16,140 +28,152 @@ class Explorer(object):
         self.target_policy = target_policy
         self.statistics = None
         self.use_noisy_net = False
+        self.recorder = None
 
-    # @profile
-    def run_k_episodes(self, k, phase, update_memory=False, imitation_learning=False, episode=None, epoch=None,
-                       print_failure=False):
+    def set_recorder(self, recorder):
+        """ Write a record of every episode with an EpisodeRecorder """
+        self.recorder = recorder
+
+    def generate_episodes(self, phase, k=None, keep_trajectory=False, statistics=None):
+        """
+        Run episodes of phase and yield every Episode as soon as it is finished, k of them or endlessly if k is
+        None. The next episode is only simulated when the consumer asks for it, which may stop at any time
+        """
         self.robot.policy.set_phase(phase)
-        success_times = []
-        collision_times = []
-        timeout_times = []
-        success = 0
-        collision = 0
-        timeout = 0
-        discomfort = 0
-        min_dist = []
-        cumulative_rewards = []
-        average_returns = []
-        collision_cases = []
-        timeout_cases = []
-        if phase in ['test', 'val'] or imitation_learning:
-            pbar = tqdm(total=k)
-        else:
-            pbar = None
+        if statistics is None:
+            statistics = EpisodeStatistics(phase, pow(self.gamma, self.robot.time_step * self.robot.v_pref),
+                                           self.env.time_limit)
         if self.robot.policy.name in ['model_predictive_rl', 'tree_search_rl']:
             if phase in ['test', 'val'] and self.use_noisy_net:
                 self.robot.policy.model[2].eval()
             else:
                 self.robot.policy.model[2].train()
 
-        for i in range(k):
+        i = 0
+        while k is None or i < k:
             ob = self.env.reset(phase)
             done = False
+            # the trajectory is only kept if asked for, the statistics are accumulated step by step
             states = []
             actions = []
             rewards = []
+            statistics.start_episode()
             while not done:
                 action, action_index = self.robot.act(ob)
                 ob, reward, done, info = self.env.step(action)
-                states.append(self.robot.policy.last_state)
-                actions.append(action_index)
-                rewards.append(reward)
-
-                if isinstance(info, Discomfort):
-                    discomfort += 1
-                    min_dist.append(info.min_dist)
-
-            if isinstance(info, ReachGoal):
-                success += 1
-                success_times.append(self.env.global_time)
-            elif isinstance(info, Collision):
-                collision += 1
-                collision_cases.append(i)
-                collision_times.append(self.env.global_time)
-                if phase in ['test']:
-                    print('collision happen %f', self.env.global_time)
-            elif isinstance(info, Timeout):
-                timeout += 1
-                timeout_cases.append(i)
-                timeout_times.append(self.env.time_limit)
-            else:
-                raise ValueError('Invalid end signal from environment')
+                if keep_trajectory:
+                    states.append(self.robot.policy.last_state)
+                    actions.append(action_index)
+                    rewards.append(reward)
+                statistics.push_step(reward, info)
+
+            record = statistics.end_episode(i, info, self.env.global_time, seed=self.env.random_seed)
+            if isinstance(info, Collision) and phase in ['test']:
+                print('collision happen %f', self.env.global_time)
+            if self.recorder is not None:
+                self.recorder.write(record)
+            yield Episode(record, info, states, actions, rewards)
+            i += 1
+
+    def generate_transitions(self, phase, chunk_size, k=None, imitation_learning=False):
+        """
+        Yield the transitions of the episodes of phase in chunks of chunk_size as (items, sizes), ready for
+        ReplayMemory.push_many. Chunks span episode boundaries, only the last one of k episodes may be shorter
+        """
+        items = []
+        sizes = []
+        for episode in self.generate_episodes(phase, k, keep_trajectory=True):
+            episode_items, episode_sizes = self.build_transitions(episode.states, episode.actions, episode.rewards,
+                                                                  imitation_learning)
+            items.extend(episode_items)
+            sizes.extend(episode_sizes)
+            while len(items) >= chunk_size:
+                yield items[:chunk_size], sizes[:chunk_size]
+                items = items[chunk_size:]
+                sizes = sizes[chunk_size:]
+        if items:
+            yield items, sizes
 
+    # @profile
+    def run_k_episodes(self, k, phase, update_memory=False, imitation_learning=False, episode=None, epoch=None,
+                       print_failure=False):
+        discount = pow(self.gamma, self.robot.time_step * self.robot.v_pref)
+        statistics = EpisodeStatistics(phase, discount, self.env.time_limit, episode)
+        if phase in ['test', 'val'] or imitation_learning:
+            pbar = tqdm(total=k)
+        else:
+            pbar = None
+
+        for finished_episode in self.generate_episodes(phase, k, keep_trajectory=update_memory, statistics=statistics):
             if update_memory:
                 # if isinstance(info, ReachGoal) or isinstance(info, Collision):
                     # only add positive(success) or negative(collision) experience in experience set
-                self.update_memory(states, actions, rewards, imitation_learning)
-
-            # cumulative_rewards.append(sum([pow(self.gamma, t * self.robot.time_step * self.robot.v_pref)
-            #                                * reward for t, reward in enumerate(rewards)]))
-            cumulative_rewards.append(sum(rewards))
-            returns = []
-            for step in range(len(rewards)):
-                step_return = sum([pow(self.gamma, t * self.robot.time_step * self.robot.v_pref)
-                                   * reward for t, reward in enumerate(rewards[step:])])
-                returns.append(step_return)
-            average_returns.append(average(returns))
+                self.update_memory(finished_episode.states, finished_episode.actions, finished_episode.rewards,
+                                   imitation_learning)
 
             if pbar:
                 pbar.update(1)
 
-
-
-        success_rate = success / k
-        collision_rate = collision / k
-        assert success + collision + timeout == k
-        avg_nav_time = sum(success_times) / len(success_times) if success_times else self.env.time_limit
+        assert statistics.episode_num == k
+        success_rate = statistics.success / k
+        collision_rate = statistics.collision / k
+        avg_nav_time = statistics.avg_nav_time
 
         extra_info = '' if episode is None else 'in episode {} '.format(episode)
         extra_info = extra_info + '' if epoch is None else extra_info + ' in epoch {} '.format(epoch)
         logging.info('{:<5} {}has success rate: {:.3f}, collision rate: {:.3f}, nav time: {:.3f}, total reward: {:.4f},'
                      ' average return: {:.4f}'. format(phase.upper(), extra_info, success_rate, collision_rate,
-                                                       avg_nav_time, sum(cumulative_rewards),
-                                                       average(average_returns)))
+                                                       avg_nav_time, statistics.reward.total,
+                                                       statistics.average_return.mean))
         # if phase in ['val', 'test'] or imitation_learning:
-        total_time = sum(success_times + collision_times + timeout_times) / self.robot.time_step
+        total_time = statistics.total_time / self.robot.time_step
         logging.info('Frequency of being in danger: %.3f and average min separate distance in danger: %.2f',
-                    discomfort / total_time, average(min_dist))
+                    statistics.discomfort / total_time, statistics.min_dist.mean)
+        logging.info('Nav time std: %.3f, median: %.3f, 90th percentile: %.3f, average return std: %.4f',
+                     statistics.nav_time.std, statistics.nav_time_quantiles[0].value,
+                     statistics.nav_time_quantiles[1].value, statistics.average_return.std)
+        logging.info('Min separate distance in danger median: %.2f, 90th percentile: %.2f',
+                     statistics.min_dist_quantiles[0].value, statistics.min_dist_quantiles[1].value)
 
         if print_failure:
-            logging.info('Collision cases: ' + ' '.join([str(x) for x in collision_cases]))
-            logging.info('Timeout cases: ' + ' '.join([str(x) for x in timeout_cases]))
+            logging.info('Collision cases: ' + ' '.join([str(x) for x in statistics.collision_cases]))
+            logging.info('Timeout cases: ' + ' '.join([str(x) for x in statistics.timeout_cases]))
 
-        self.statistics = success_rate, collision_rate, avg_nav_time, sum(cumulative_rewards), average(average_returns), discomfort, total_time
+        self.statistics = success_rate, collision_rate, avg_nav_time, statistics.reward.total, \
+            statistics.average_return.mean, statistics.discomfort, total_time
 
         return self.statistics
 
     def update_memory(self, states, actions, rewards, imitation_learning=False):
         if self.memory is None or self.gamma is None:
             raise ValueError('Memory or gamma value is not set!')
-        
-        for i, state in enumerate(states[:-1]):
-            reward = rewards[i]
-
-            # VALUE UPDATE
-            if imitation_learning:
-                # define the value of states in IL as cumulative discounted rewards, which is the same in RL
-                state = self.target_policy.transform(state)
-                action = actions[i]
-                next_state = self.target_policy.transform(states[i+1])
-                value = sum([pow(self.gamma, (t - i) * self.robot.time_step * self.robot.v_pref) * reward *
-                             (1 if t >= i else 0) for t, reward in enumerate(rewards)])
-            else:
-                next_state = states[i+1]
-                action = actions[i]
-                if i == len(states) - 1:
-                    # terminal state
-                    value = reward
-                else:
-                    value = 0
-            value = torch.Tensor([value]).to(self.device)
-            reward = torch.Tensor([rewards[i]]).to(self.device)
-
-            if self.target_policy.name == 'ModelPredictiveRL' or self.target_policy.name == 'TreeSearchRL':
-                self.memory.push((state[0], state[1], action, value, reward, next_state[0], next_state[1]))
-            else:
-                self.memory.push((state, value, reward, next_state))
+        self.memory.push_many(*self.build_transitions(states, actions, rewards, imitation_learning))
+
+    def build_transitions(self, states, actions, rewards, imitation_learning=False):
+        """ Memory items of the transitions of an episode and their numbers of humans """
+        if self.gamma is None:
+            raise ValueError('Gamma value is not set!')
+
+        # the transitions of the whole episode are built at once
+        transition_num = len(states) - 1
+        if imitation_learning:
+            # define the value of states in IL as cumulative discounted rewards, which is the same in RL
+            states = [self.target_policy.transform(state) for state in states]
+            values = discounted_returns(rewards, pow(self.gamma, self.robot.time_step * self.robot.v_pref))
+        else:
+            # the last state is never pushed, so none of the pushed states is terminal
+            values = np.zeros(len(rewards))
+        values = torch.Tensor(values[:transition_num]).to(self.device).unsqueeze(1)
+        rewards = torch.Tensor(rewards[:transition_num]).to(self.device).unsqueeze(1)
+
+        if self.target_policy.name == 'ModelPredictiveRL' or self.target_policy.name == 'TreeSearchRL':
+            items = [(states[i][0], states[i][1], actions[i], values[i], rewards[i], states[i + 1][0],
+                      states[i + 1][1]) for i in range(transition_num)]
+            sizes = [max(states[i][1].shape[0], states[i + 1][1].shape[0]) for i in range(transition_num)]
+        else:
+            items = [(states[i], values[i], rewards[i], states[i + 1]) for i in range(transition_num)]
+            sizes = [max(states[i].shape[0], states[i + 1].shape[0]) for i in range(transition_num)]
+        return items, sizes
 
     def log(self, tag_prefix, global_step):
         sr, cr, time, reward, avg_return,_,_ = self.statistics
@@ -165,3 +189,9 @@ def average(input_list):
         return sum(input_list) / len(input_list)
     else:
         return 0
+
+
+def discounted_returns(rewards, discount):
+    """ Return from every step on, sum of discount ** (t - i) * rewards[t] over t >= i, as one reversed cumsum """
+    discounts = np.power(discount, np.arange(len(rewards)))
+    return np.cumsum((np.array(rewards, dtype=float) * discounts)[::-1])[::-1] / discounts
@@ -1,20 +1,42 @@
-from torch.utils.data import Dataset
+import random
+from torch.utils.data import Dataset, Sampler
 
 
 class ReplayMemory(Dataset):
     def __init__(self, capacity):
         self.capacity = capacity
         self.memory = list()
+        # number of humans in each experience, used to bucket experiences of similar crowd sizes
+        self.sizes = list()
         self.position = 0
 
-    def push(self, item):
+    def push(self, item, size=0):
         # replace old experience with new experience
         if len(self.memory) < self.position + 1:
             self.memory.append(item)
+            self.sizes.append(size)
         else:
             self.memory[self.position] = item
+            self.sizes[self.position] = size
         self.position = (self.position + 1) % self.capacity
 
+    def push_many(self, items, sizes):
+        """ Push the experiences of a whole episode, the slots are written one slice at a time """
+        items = list(items)
+        sizes = list(sizes)
+        while items:
+            if len(self.memory) < self.capacity:
+                count = min(len(items), self.capacity - len(self.memory))
+                self.memory.extend(items[:count])
+                self.sizes.extend(sizes[:count])
+            else:
+                count = min(len(items), self.capacity - self.position)
+                self.memory[self.position:self.position + count] = items[:count]
+                self.sizes[self.position:self.position + count] = sizes[:count]
+            self.position = (self.position + count) % self.capacity
+            items = items[count:]
+            sizes = sizes[count:]
+
     def is_full(self):
         return len(self.memory) == self.capacity
 
@@ -26,3 +48,38 @@ class ReplayMemory(Dataset):
 
     def clear(self):
         self.memory = list()
+        self.sizes = list()
+        self.position = 0
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, memory, batch_size, bucket_width):
+        """
+        Yield shuffled batches of indices whose experiences fall in the same size bucket, where bucket k holds
+        sizes in ((k - 1) * bucket_width, k * bucket_width], so that a batch only pads up to its bucket bound
+        """
+        super().__init__()
+        self.memory = memory
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+
+    def bucket_bound(self, size):
+        return -(-size // self.bucket_width) * self.bucket_width
+
+    def __iter__(self):
+        buckets = dict()
+        for index, size in enumerate(self.memory.sizes):
+            buckets.setdefault(self.bucket_bound(size), []).append(index)
+        batches = []
+        for indices in buckets.values():
+            random.shuffle(indices)
+            batches.extend(indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size))
+        random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        counts = dict()
+        for size in self.memory.sizes:
+            bound = self.bucket_bound(size)
+            counts[bound] = counts.get(bound, 0) + 1
+        return sum(-(-count // self.batch_size) for count in counts.values())
@@ -0,0 +1,241 @@
+import os
+import csv
+import json
+import math
+from crowd_sim.envs.utils.info import *
+
+QUANTILES = (0.5, 0.9)
+RECORD_FIELDS = ['phase', 'episode', 'case', 'seed', 'result', 'time', 'reward', 'discounted_return',
+                 'average_return', 'discomfort', 'min_dist']
+
+
+class RunningStatistics(object):
+    def __init__(self):
+        """ Welford mean and variance of a stream of values, O(1) per value """
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def push(self, value):
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class StreamingQuantile(object):
+    def __init__(self, quantile):
+        """
+        P-square estimate of a quantile (Jain and Chlamtac, 1985), five markers are moved along the stream
+        instead of keeping the values. Exact for up to five values
+        """
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def push(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = next(i for i in range(4) if heights[i] <= value < heights[i + 1])
+        for i in range(k + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # move the middle markers towards their desired positions, by at most one position each
+        for i in range(1, 4):
+            d = self.desired[i] - self.positions[i]
+            if (d >= 1 and self.positions[i + 1] - self.positions[i] > 1) or \
+                    (d <= -1 and self.positions[i - 1] - self.positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.linear(i, d)
+                heights[i] = height
+                self.positions[i] += d
+
+    def parabolic(self, i, d):
+        h, n = self.heights, self.positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+                                                   (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+
+    def linear(self, i, d):
+        h, n = self.heights, self.positions
+        return h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+
+    @property
+    def value(self):
+        if not self.heights:
+            return 0
+        if len(self.heights) < 5:
+            return self.heights[int(round((len(self.heights) - 1) * self.quantile))]
+        return self.heights[2]
+
+
+class DiscountedReturn(object):
+    def __init__(self, discount):
+        """
+        Returns of an episode from its rewards, O(1) per step. The return from step i is
+        sum of discount ** (t - i) * reward_t over t >= i, so the sum of the returns of all steps is
+        sum of reward_t * (1 + discount + ... + discount ** t)
+        """
+        self.discount = discount
+        self.steps = 0
+        self.total = 0.0
+        self.value = 0.0
+        self.returns_sum = 0.0
+        self.discount_power = 1.0
+        self.discount_sum = 0.0
+
+    def push(self, reward):
+        self.discount_sum += self.discount_power
+        self.value += self.discount_power * reward
+        self.returns_sum += self.discount_sum * reward
+        self.total += reward
+        self.discount_power *= self.discount
+        self.steps += 1
+
+    @property
+    def average(self):
+        """ Average of the returns from every step of the episode """
+        return self.returns_sum / self.steps if self.steps else 0
+
+
+class EpisodeStatistics(object):
+    def __init__(self, phase, discount, time_limit, episode=None):
+        """
+        Statistics of run_k_episodes accumulated step by step in constant memory, only the indices of the
+        failed cases are kept
+        """
+        self.phase = phase
+        self.discount = discount
+        self.time_limit = time_limit
+        self.episode = episode
+        self.success = 0
+        self.collision = 0
+        self.timeout = 0
+        self.discomfort = 0
+        self.total_time = 0
+        self.nav_time = RunningStatistics()
+        self.nav_time_quantiles = [StreamingQuantile(q) for q in QUANTILES]
+        self.min_dist = RunningStatistics()
+        self.min_dist_quantiles = [StreamingQuantile(q) for q in QUANTILES]
+        self.reward = RunningStatistics()
+        self.average_return = RunningStatistics()
+        self.collision_cases = []
+        self.timeout_cases = []
+        self.episode_return = None
+        self.episode_discomfort = 0
+        self.episode_min_dist = None
+
+    def start_episode(self):
+        self.episode_return = DiscountedReturn(self.discount)
+        self.episode_discomfort = 0
+        self.episode_min_dist = None
+
+    def push_step(self, reward, info):
+        self.episode_return.push(reward)
+        if isinstance(info, Discomfort):
+            self.discomfort += 1
+            self.episode_discomfort += 1
+            self.min_dist.push(info.min_dist)
+            for quantile in self.min_dist_quantiles:
+                quantile.push(info.min_dist)
+            if self.episode_min_dist is None or info.min_dist < self.episode_min_dist:
+                self.episode_min_dist = info.min_dist
+
+    def end_episode(self, case, info, global_time, seed=None):
+        """ Count the end signal of the episode and return its record """
+        if isinstance(info, ReachGoal):
+            self.success += 1
+            self.nav_time.push(global_time)
+            for quantile in self.nav_time_quantiles:
+                quantile.push(global_time)
+            result = 'success'
+        elif isinstance(info, Collision):
+            self.collision += 1
+            self.collision_cases.append(case)
+            result = 'collision'
+        elif isinstance(info, Timeout):
+            self.timeout += 1
+            self.timeout_cases.append(case)
+            global_time = self.time_limit
+            result = 'timeout'
+        else:
+            raise ValueError('Invalid end signal from environment')
+        self.total_time += global_time
+        self.reward.push(self.episode_return.total)
+        self.average_return.push(self.episode_return.average)
+
+        min_dist = None if self.episode_min_dist is None else float(self.episode_min_dist)
+        return {'phase': self.phase, 'episode': self.episode, 'case': case, 'seed': seed, 'result': result,
+                'time': float(global_time), 'reward': float(self.episode_return.total),
+                'discounted_return': float(self.episode_return.value),
+                'average_return': float(self.episode_return.average), 'discomfort': self.episode_discomfort,
+                'min_dist': min_dist}
+
+    @property
+    def episode_num(self):
+        return self.success + self.collision + self.timeout
+
+    @property
+    def avg_nav_time(self):
+        return self.nav_time.mean if self.nav_time.count else self.time_limit
+
+
+class EpisodeRecorder(object):
+    def __init__(self, file, writer=None):
+        """
+        Write one record per episode to file, as CSV if it ends with .csv and as JSON lines otherwise, and to
+        TensorBoard if a writer is given
+        """
+        self.file = file
+        self.writer = writer
+        self.use_csv = os.path.splitext(file)[1] == '.csv'
+        write_header = self.use_csv and not (os.path.exists(file) and os.path.getsize(file) > 0)
+        self.stream = open(file, 'a', newline='')
+        self.csv_writer = csv.DictWriter(self.stream, RECORD_FIELDS) if self.use_csv else None
+        if write_header:
+            self.csv_writer.writeheader()
+        # number of recorded episodes of each phase, the global step of the per episode scalars
+        self.counts = dict()
+
+    def write(self, record):
+        if self.use_csv:
+            self.csv_writer.writerow(record)
+        else:
+            self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+        if self.writer is not None:
+            phase = record['phase']
+            step = self.counts.get(phase, 0)
+            self.counts[phase] = step + 1
+            for key in ['time', 'reward', 'average_return']:
+                self.writer.add_scalar('{}_episodes/{}'.format(phase, key), record[key], step)
+
+    def close(self):
+        self.stream.close()
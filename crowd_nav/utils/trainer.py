@@ -4,15 +4,24 @@ import copy
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+from itertools import islice
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 from crowd_sim.envs.utils.action import ActionXY
+from crowd_nav.utils.memory import BucketBatchSampler
 
 
 class TSRLTrainer(object):
     def __init__(self, value_estimator, state_predictor, memory, device, policy, writer, batch_size, optimizer_str, human_num,
-                 reduce_sp_update_frequency, freeze_state_predictor, detach_state_predictor, share_graph_model):
+                 reduce_sp_update_frequency, freeze_state_predictor, detach_state_predictor, share_graph_model,
+                 bucket_width=None, target_update_tau=None):
         """
         Train the trainable model of a policy
+        Experiences with different numbers of humans are padded and masked, and with bucket_width set
+        batches are drawn from experiences of similar crowd sizes.
+        With target_update_tau set the target model follows the value estimator by polyak averaging after every
+        update instead of being synchronized by update_target_model
         """
         self.value_estimator = value_estimator
         self.state_predictor = state_predictor
@@ -30,6 +39,8 @@ class TSRLTrainer(object):
         self.freeze_state_predictor = freeze_state_predictor
         self.detach_state_predictor = detach_state_predictor
         self.share_graph_model = share_graph_model
+        self.bucket_width = bucket_width
+        self.target_update_tau = target_update_tau
         self.v_optimizer = None
         self.s_optimizer = None
 
@@ -39,7 +50,25 @@ class TSRLTrainer(object):
         self.v_pref = 1
 
     def update_target_model(self, target_model):
-        self.target_model = copy.deepcopy(target_model)
+        # the target model is created once and then synchronized in place
+        if self.target_model is None:
+            self.target_model = copy.deepcopy(target_model)
+        else:
+            sync_target_model(self.target_model, target_model)
+
+    def build_data_loader(self):
+        if self.bucket_width is None:
+            return DataLoader(self.memory, self.batch_size, shuffle=True, collate_fn=pad_human_batch)
+        batch_sampler = BucketBatchSampler(self.memory, self.batch_size, self.bucket_width)
+        return DataLoader(self.memory, batch_sampler=batch_sampler,
+                          collate_fn=lambda batch: pad_human_batch(batch, self.bucket_width))
+
+    def state_predictor_loss(self, next_human_states_est, next_human_states, human_masks):
+        if human_masks is None:
+            return self.criterion(next_human_states_est, next_human_states)
+        # only real humans count in the loss
+        human_masks = human_masks.unsqueeze(2).expand_as(next_human_states)
+        return self.criterion(next_human_states_est[human_masks], next_human_states[human_masks])
 
     def set_learning_rate(self, learning_rate):
         if self.optimizer_str == 'Adam':
@@ -85,7 +114,7 @@ class TSRLTrainer(object):
         if self.v_optimizer is None:
             raise ValueError('Learning rate is not set!')
         if self.data_loader is None:
-            self.data_loader = DataLoader(self.memory, self.batch_size, shuffle=True)
+            self.data_loader = self.build_data_loader()
         for epoch in range(num_epochs):
             epoch_v_loss = 0
             epoch_s_loss = 0
@@ -93,12 +122,15 @@ class TSRLTrainer(object):
 
             update_counter = 0
             for data in self.data_loader:
-                robot_states, human_states, actions, values, _, next_robot_state, next_human_states = data
+                robot_states, human_states, actions, values, _, next_robot_state, next_human_states, \
+                    human_masks, next_human_masks = data
+                states = padded_state(robot_states, human_states, human_masks)
+                predictor_masks = merge_masks(human_masks, next_human_masks)
 
                 # optimize value estimator
                 self.v_optimizer.zero_grad()
                 actions = actions.to(self.device)
-                outputs = self.value_estimator((robot_states, human_states)).gather(1, actions.unsqueeze(1))
+                outputs = self.value_estimator(states).gather(1, actions.unsqueeze(1))
                 values = values.to(self.device)
                 loss = self.criterion(outputs, values)
                 loss.backward()
@@ -113,15 +145,15 @@ class TSRLTrainer(object):
 
                     if update_state_predictor:
                         self.s_optimizer.zero_grad()
-                        _, next_human_states_est = self.state_predictor((robot_states, human_states), None)
-                        loss = self.criterion(next_human_states_est, next_human_states)
+                        _, next_human_states_est = self.state_predictor(states, None)
+                        loss = self.state_predictor_loss(next_human_states_est, next_human_states, predictor_masks)
                         loss.backward()
                         self.s_optimizer.step()
                         epoch_s_loss += loss.data.item()
                     update_counter += 1
                 else:
-                    _, next_human_states_est = self.state_predictor((robot_states, human_states), ActionXY(0, 0))
-                    loss = self.criterion(next_human_states_est, next_human_states)
+                    _, next_human_states_est = self.state_predictor(states, ActionXY(0, 0))
+                    loss = self.state_predictor_loss(next_human_states_est, next_human_states, predictor_masks)
                     epoch_s_loss += loss.data.item()
 
             logging.debug('{}-th epoch ends'.format(epoch))
@@ -131,80 +163,118 @@ class TSRLTrainer(object):
                          epoch_s_loss / len(self.memory))
         return
 
+    def compute_value_targets(self, states, next_states, actions, rewards, predictor_states=None):
+        """
+        Q values of the taken actions and their double dqn targets from one pass of the online graph model over
+        states and next states. The graph model embeddings of predictor_states, if given, come from the same pass
+        and are returned for the state predictor (None otherwise)
+        """
+        batch_size = states[0].shape[0]
+        graph_input = self.value_estimator.trans_no_rotation(concat_states(states, next_states))
+        if predictor_states is not None:
+            graph_input = concat_states(graph_input, predictor_states)
+        node_embeddings = self.value_estimator.graph_model(graph_input)
+        robot_embeddings = node_embeddings[:, 0, :]
+
+        actions = actions.to(self.device)
+        outputs = self.value_estimator.value_network(robot_embeddings[:batch_size]).gather(1, actions.unsqueeze(1))
+        gamma_bar = pow(self.gamma, self.time_step * self.v_pref)
+        with torch.no_grad():
+            # double dqn, the online network picks the next action and the target network evaluates it
+            next_Q = self.value_estimator.value_network(robot_embeddings[batch_size:2 * batch_size])
+            max_next_Q_index = torch.max(next_Q, dim=1)[1]
+            next_Q_value = self.target_model(next_states).gather(1, max_next_Q_index.unsqueeze(1))
+        target_values = rewards + next_Q_value * gamma_bar
+        predictor_embeddings = node_embeddings[2 * batch_size:] if predictor_states is not None else None
+        return outputs, target_values, predictor_embeddings
+
     def optimize_batch(self, num_batches, episode):
         if self.v_optimizer is None:
             raise ValueError('Learning rate is not set!')
         if self.data_loader is None:
-            self.data_loader = DataLoader(self.memory, self.batch_size, shuffle=True)
+            self.data_loader = self.build_data_loader()
         v_losses = 0
         s_losses = 0
         batch_count = 0
         self.target_model.value_network.eval()
         self.value_estimator.value_network.eval()
-        for data in self.data_loader:
-            batch_num = int(self.data_loader.sampler.num_samples // self.batch_size)
-            robot_states, human_states, actions, _, rewards, next_robot_states, next_human_states = data
-
-            # optimize value estimator
-            self.v_optimizer.zero_grad()
-            actions = actions.to(self.device)
-            # outputs = self.value_estimator((robot_states, human_states))
-            outputs = self.value_estimator((robot_states, human_states)).gather(1, actions.unsqueeze(1))
-            gamma_bar = pow(self.gamma, self.time_step * self.v_pref)
-            max_next_Q_index = torch.max(self.value_estimator((next_robot_states, next_human_states)), dim=1)[1]
-            next_Q_value = self.target_model((next_robot_states, next_human_states)).gather(1, max_next_Q_index.unsqueeze(1))
-            # for dqn
-            # max_next_Q = torch.max(self.target_model((next_robot_states, next_human_states)), dim=1)[0]
-            # next_Q_value= max_next_Q.unsqueeze(dim=1)
-            target_values = rewards + next_Q_value * gamma_bar
-            # target_values = rewards + gamma_bar * self.target_model((next_robot_states, next_human_states))
-
-            # values = values.to(self.device)
-            loss = self.criterion(outputs, target_values)
-            loss.backward()
-            self.v_optimizer.step()
-            v_losses += loss.data.item()
-
-            # optimize state predictor
+        num_updates = count_updates(num_batches, len(self.data_loader), len(self.memory) // self.batch_size)
+        for data in islice(self.data_loader, num_updates):
+            robot_states, human_states, actions, _, rewards, next_robot_states, next_human_states, \
+                human_masks, next_human_masks = data
+            states = padded_state(robot_states, human_states, human_masks)
+            next_states = padded_state(next_robot_states, next_human_states, next_human_masks)
+            predictor_masks = merge_masks(human_masks, next_human_masks)
+
+            update_state_predictor = False
             if self.state_predictor.trainable:
                 update_state_predictor = True
                 if self.freeze_state_predictor:
                     update_state_predictor = False
                 elif self.reduce_sp_update_frequency and batch_count % self.state_predictor_update_interval == 0:
                     update_state_predictor = False
+            # with a shared graph model the state predictor takes its embedding from the same forward pass
+            reuse_embedding = self.share_graph_model and update_state_predictor
 
+            # optimize value estimator
+            outputs, target_values, predictor_embeddings = self.compute_value_targets(
+                states, next_states, actions, rewards, states if reuse_embedding else None)
+            loss = self.criterion(outputs, target_values)
+            v_losses += loss.data.item()
+
+            if reuse_embedding:
+                _, next_human_states_est = self.state_predictor.predict_from_embedding(
+                    predictor_embeddings, states, detach=self.detach_state_predictor)
+                s_loss = self.state_predictor_loss(next_human_states_est, next_human_states, predictor_masks)
+                # both gradients are taken before any step, each optimizer then steps with the gradient of its loss
+                v_gradients = compute_gradients(self.v_optimizer, loss, retain_graph=True)
+                s_gradients = compute_gradients(self.s_optimizer, s_loss)
+                step_with_gradients(self.v_optimizer, v_gradients)
+                step_with_gradients(self.s_optimizer, s_gradients)
+                s_losses += s_loss.data.item()
+            else:
+                self.v_optimizer.zero_grad()
+                loss.backward()
+                average_gradients(self.v_optimizer)
+                self.v_optimizer.step()
+
+                # optimize state predictor
                 if update_state_predictor:
                     self.s_optimizer.zero_grad()
-                    _, next_human_states_est = self.state_predictor((robot_states, human_states), None,
+                    _, next_human_states_est = self.state_predictor(states, None,
                                                                     detach=self.detach_state_predictor)
-                    loss = self.criterion(next_human_states_est, next_human_states)
+                    loss = self.state_predictor_loss(next_human_states_est, next_human_states, predictor_masks)
                     loss.backward()
+                    average_gradients(self.s_optimizer)
                     self.s_optimizer.step()
                     s_losses += loss.data.item()
-            else:
-                _, next_human_states_est = self.state_predictor((robot_states, human_states), None,
-                                                                detach=self.detach_state_predictor)
-                loss = self.criterion(next_human_states_est, next_human_states)
-                s_losses += loss.data.item()
-
+                elif not self.state_predictor.trainable:
+                    with torch.no_grad():
+                        _, next_human_states_est = self.state_predictor(states, None,
+                                                                        detach=self.detach_state_predictor)
+                    loss = self.state_predictor_loss(next_human_states_est, next_human_states, predictor_masks)
+                    s_losses += loss.data.item()
 
+            if self.target_update_tau is not None:
+                sync_target_model(self.target_model, self.value_estimator, self.target_update_tau)
             batch_count += 1
-            if batch_count > num_batches or batch_count == batch_num:
-                break
 
         average_v_loss = v_losses / num_batches
         average_s_loss = s_losses / num_batches
         logging.info('Average loss : %.2E, %.2E', average_v_loss, average_s_loss)
-        self.writer.add_scalar('RL/average_v_loss', average_v_loss, episode)
-        self.writer.add_scalar('RL/average_s_loss', average_s_loss, episode)
+        if self.writer is not None:
+            self.writer.add_scalar('RL/average_v_loss', average_v_loss, episode)
+            self.writer.add_scalar('RL/average_s_loss', average_s_loss, episode)
         self.value_estimator.value_network.train()
         return average_v_loss, average_s_loss
 
 class MPRLTrainer(object):
     def __init__(self, value_estimator, state_predictor, memory, device, policy, writer, batch_size, optimizer_str, human_num,
-                 reduce_sp_update_frequency, freeze_state_predictor, detach_state_predictor, share_graph_model):
+                 reduce_sp_update_frequency, freeze_state_predictor, detach_state_predictor, share_graph_model,
+                 target_update_tau=None):
         """
         Train the trainable model of a policy
+        With target_update_tau set the target model follows the value estimator by polyak averaging after every update
         """
         self.value_estimator = value_estimator
         self.state_predictor = state_predictor
@@ -222,6 +292,7 @@ class MPRLTrainer(object):
         self.freeze_state_predictor = freeze_state_predictor
         self.detach_state_predictor = detach_state_predictor
         self.share_graph_model = share_graph_model
+        self.target_update_tau = target_update_tau
         self.v_optimizer = None
         self.s_optimizer = None
 
@@ -231,7 +302,11 @@ class MPRLTrainer(object):
         self.v_pref = 1
 
     def update_target_model(self, target_model):
-        self.target_model = copy.deepcopy(target_model)
+        # the target model is created once and then synchronized in place
+        if self.target_model is None:
+            self.target_model = copy.deepcopy(target_model)
+        else:
+            sync_target_model(self.target_model, target_model)
 
     def set_learning_rate(self, learning_rate):
         if self.optimizer_str == 'Adam':
@@ -334,8 +409,9 @@ class MPRLTrainer(object):
         batch_count = 0
         self.target_model.value_network.eval()
         self.value_estimator.value_network.eval()
-        for data in self.data_loader:
-            batch_num = int(self.data_loader.sampler.num_samples // self.batch_size)
+        num_updates = count_updates(num_batches, len(self.data_loader),
+                                    self.data_loader.sampler.num_samples // self.batch_size)
+        for data in islice(self.data_loader, num_updates):
             robot_states, human_states, actions, _, rewards, next_robot_states, next_human_states = data
 
             # optimize value estimator
@@ -349,6 +425,7 @@ class MPRLTrainer(object):
             # values = values.to(self.device)
             loss = self.criterion(outputs, target_values)
             loss.backward()
+            average_gradients(self.v_optimizer)
             self.v_optimizer.step()
             v_losses += loss.data.item()
 
@@ -366,6 +443,7 @@ class MPRLTrainer(object):
                                                                     detach=self.detach_state_predictor)
                     loss = self.criterion(next_human_states_est, next_human_states)
                     loss.backward()
+                    average_gradients(self.s_optimizer)
                     self.s_optimizer.step()
                     s_losses += loss.data.item()
             else:
@@ -373,15 +451,16 @@ class MPRLTrainer(object):
                                                                 detach=self.detach_state_predictor)
                 loss = self.criterion(next_human_states_est, next_human_states)
                 s_losses += loss.data.item()
+            if self.target_update_tau is not None:
+                sync_target_model(self.target_model, self.value_estimator, self.target_update_tau)
             batch_count += 1
-            if batch_count > num_batches or batch_count == batch_num:
-                break
 
         average_v_loss = v_losses / num_batches
         average_s_loss = s_losses / num_batches
         logging.info('Average loss : %.2E, %.2E', average_v_loss, average_s_loss)
-        self.writer.add_scalar('RL/average_v_loss', average_v_loss, episode)
-        self.writer.add_scalar('RL/average_s_loss', average_s_loss, episode)
+        if self.writer is not None:
+            self.writer.add_scalar('RL/average_v_loss', average_v_loss, episode)
+            self.writer.add_scalar('RL/average_s_loss', average_s_loss, episode)
         self.value_estimator.value_network.train()
         return average_v_loss, average_s_loss
 
@@ -451,8 +530,8 @@ class VNRLTrainer(object):
         if self.data_loader is None:
             self.data_loader = DataLoader(self.memory, self.batch_size, shuffle=True, collate_fn=pad_batch)
         losses = 0
-        batch_count = 0
-        for data in self.data_loader:
+        num_updates = count_updates(num_batches, len(self.data_loader))
+        for data in islice(self.data_loader, num_updates):
             inputs, _, rewards, next_states = data
             self.optimizer.zero_grad()
             outputs = self.model(inputs)
@@ -462,11 +541,9 @@ class VNRLTrainer(object):
 
             loss = self.criterion(outputs, target_values)
             loss.backward()
+            average_gradients(self.optimizer)
             self.optimizer.step()
             losses += loss.data.item()
-            batch_count += 1
-            if batch_count > num_batches:
-                break
 
         average_loss = losses / num_batches
         logging.info('Average loss : %.2E', average_loss)
@@ -494,3 +571,126 @@ def pad_batch(batch):
     next_states = sort_states(3)
 
     return states, values, rewards, next_states
+
+
+def pad_human_batch(batch, bucket_width=None):
+    """
+    args:
+        batch - list of (robot_state, human_states, action, value, reward, next_robot_state, next_human_states)
+        bucket_width - if set, the number of humans is padded up to a multiple of it
+    return:
+        the collated batch followed by the masks of real humans in human_states and next_human_states,
+        masks are None when no experience in the batch needed padding
+    """
+    # keep at least one (padded) human for observations with nobody in sight
+    human_num = max(1, max(max(x[1].shape[0], x[6].shape[0]) for x in batch))
+    if bucket_width is not None:
+        human_num = -(-human_num // bucket_width) * bucket_width
+    if all(x[1].shape[0] == human_num and x[6].shape[0] == human_num for x in batch):
+        return tuple(default_collate(batch)) + (None, None)
+
+    def pad_states(position):
+        states = batch[0][position].new_zeros((len(batch), human_num, batch[0][position].shape[1]))
+        masks = torch.zeros((len(batch), human_num), dtype=torch.bool, device=states.device)
+        for i, x in enumerate(batch):
+            states[i, :x[position].shape[0]] = x[position]
+            masks[i, :x[position].shape[0]] = True
+        return states, masks
+
+    robot_states, actions, values, rewards, next_robot_states = default_collate([x[0:1] + x[2:6] for x in batch])
+    human_states, human_masks = pad_states(1)
+    next_human_states, next_human_masks = pad_states(6)
+
+    return robot_states, human_states, actions, values, rewards, next_robot_states, next_human_states, \
+        human_masks, next_human_masks
+
+
+def sync_target_model(target_model, model, tau=None):
+    """
+    Update the parameters of target_model in place, copied from model or with tau averaged as
+    (1 - tau) * target + tau * model. Buffers are always copied
+    """
+    target_params = list(target_model.parameters())
+    params = list(model.parameters())
+    with torch.no_grad():
+        if tau is None:
+            torch._foreach_copy_(target_params, params)
+        else:
+            torch._foreach_mul_(target_params, 1 - tau)
+            torch._foreach_add_(target_params, params, alpha=tau)
+        for target_buffer, buffer in zip(target_model.buffers(), model.buffers()):
+            target_buffer.copy_(buffer)
+
+
+def concat_states(*states):
+    """ Concatenate state tuples along the batch, they have to be padded to the same number of humans """
+    return tuple(torch.cat(tensors, dim=0) for tensors in zip(*states))
+
+
+def compute_gradients(optimizer, loss, retain_graph=False):
+    params = [param for group in optimizer.param_groups for param in group['params']]
+    return torch.autograd.grad(loss, params, retain_graph=retain_graph, allow_unused=True)
+
+
+def step_with_gradients(optimizer, gradients):
+    params = [param for group in optimizer.param_groups for param in group['params']]
+    for param, gradient in zip(params, gradients):
+        param.grad = gradient
+    average_gradients(optimizer)
+    optimizer.step()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def count_updates(num_batches, loader_size, batch_num=0):
+    """
+    Number of updates in optimize_batch, num_batches + 1 but at most one pass over the memory. Replicas may hold
+    memories of different sizes, they all take the fewest updates of any replica so that every gradient is reduced
+    """
+    num_updates = min(num_batches + 1, loader_size, batch_num if batch_num > 0 else loader_size)
+    if is_distributed():
+        num_updates = torch.tensor(num_updates)
+        dist.all_reduce(num_updates, op=dist.ReduceOp.MIN)
+        num_updates = int(num_updates)
+    return num_updates
+
+
+def average_gradients(optimizer):
+    """ Average the gradients of the parameters of optimizer over all replicas in one all-reduce """
+    if not is_distributed():
+        return
+    params = [param for group in optimizer.param_groups for param in group['params'] if param.grad is not None]
+    if not params:
+        return
+    gradients = torch.cat([param.grad.reshape(-1) for param in params])
+    dist.all_reduce(gradients)
+    gradients /= dist.get_world_size()
+    for param, gradient in zip(params, torch.split(gradients, [param.numel() for param in params])):
+        param.grad = gradient.view_as(param)
+
+
+def broadcast_state_dict(state_dict):
+    """ Overwrite the tensors of the (nested) state dict in place with the ones of rank 0 """
+    if not is_distributed():
+        return
+    for value in state_dict.values():
+        if isinstance(value, dict):
+            broadcast_state_dict(value)
+        else:
+            dist.broadcast(value, 0)
+
+
+def padded_state(robot_states, human_states, human_masks):
+    if human_masks is None:
+        return robot_states, human_states
+    return robot_states, human_states, human_masks
+
+
+def merge_masks(human_masks, next_human_masks):
+    if human_masks is None:
+        return next_human_masks
+    if next_human_masks is None:
+        return human_masks
+    return human_masks & next_human_masks
@@ -1,6 +1,7 @@
 import logging
 import random
 import math
+from collections import deque
 
 import gym
 import matplotlib.lines as mlines
@@ -10,10 +11,10 @@ from numpy.linalg import norm
 
 from crowd_sim.envs.policy.policy_factory import policy_factory
 from crowd_sim.envs.utils.state import tensor_to_joint_state, JointState
-from crowd_sim.envs.utils.action import ActionRot
+from crowd_sim.envs.utils.action import ActionRot, ActionXY
 from crowd_sim.envs.utils.human import Human
 from crowd_sim.envs.utils.info import *
-from crowd_sim.envs.utils.utils import point_to_segment_dist
+from crowd_sim.envs.utils.utils import point_to_segment_dist, SpatialHash
 
 
 class CrowdSim(gym.Env):
@@ -33,6 +34,11 @@ class CrowdSim(gym.Env):
         self.humans = None
         self.global_time = None
         self.robot_sensor_range = None
+        # 'all' observes every human, 'knn' the robot_sensor_k nearest humans within robot_sensor_range
+        self.robot_sensor_mode = 'all'
+        self.robot_sensor_k = None
+        # 'object' returns lists of ObservableState, 'array' float32 arrays (robot (9,), humans (# of humans, 5))
+        self.obs_mode = 'object'
         # reward function
         self.success_reward = None
         self.collision_penalty = None
@@ -53,8 +59,24 @@ class CrowdSim(gym.Env):
         self.nonstop_human = None
         self.centralized_planning = None
         self.centralized_planner = None
-
-        # for visualization
+        # human actions of the current time step shared by onestep_lookahead and step
+        self.human_actions_key = None
+        self.human_actions = None
+        self.next_human_observable_states = None
+        # uniform grids over the positions and the goals of all agents for neighborhood queries
+        self.spatial_hash_cell_size = 1.0
+        self.position_hash = None
+        self.goal_hash = None
+        # precomputed initial conditions of the cases, per phase
+        self.scenario_banks = dict()
+        # random streams of the environment and of the human policies, reseeded for every case
+        self.rng = np.random.default_rng()
+        self.human_seeds = np.random.SeedSequence()
+
+        # for visualization, per phase 'off', 'states' (agent states, actions and rewards) or 'full' (also the
+        # attention weights, matrices and planned trajectories of the policy), kept in ring buffers of record_length
+        self.record = {'train': 'off', 'val': 'states', 'test': 'full'}
+        self.record_length = None
         self.states = None
         self.action_values = None
         self.attention_weights = None
@@ -81,6 +103,30 @@ class CrowdSim(gym.Env):
         self.time_step = config.env.time_step
         self.randomize_attributes = config.env.randomize_attributes
         self.robot_sensor_range = config.env.robot_sensor_range
+        if hasattr(config.env, 'robot_sensor_mode'):
+            self.robot_sensor_mode = config.env.robot_sensor_mode
+        if hasattr(config.env, 'robot_sensor_k'):
+            self.robot_sensor_k = config.env.robot_sensor_k
+        if self.robot_sensor_mode not in ['all', 'knn']:
+            raise NotImplementedError
+        if self.robot_sensor_mode == 'knn' and self.robot_sensor_k is None:
+            raise ValueError('robot_sensor_k has to be set for knn sensing')
+        if hasattr(config.env, 'obs_mode'):
+            self.obs_mode = config.env.obs_mode
+        if self.obs_mode not in ['object', 'array']:
+            raise NotImplementedError
+        if hasattr(config.env, 'record'):
+            # either one mode for all phases or a dict of modes per phase
+            if isinstance(config.env.record, str):
+                self.record = {phase: config.env.record for phase in self.record}
+            else:
+                self.record.update(config.env.record)
+        if any(mode not in ['off', 'states', 'full'] for mode in self.record.values()):
+            raise NotImplementedError
+        # an episode never has more steps than time_limit allows
+        self.record_length = int(np.ceil(self.time_limit / self.time_step)) + 1
+        if hasattr(config.env, 'record_length') and config.env.record_length is not None:
+            self.record_length = config.env.record_length
         self.success_reward = config.reward.success_reward
         self.collision_penalty = config.reward.collision_penalty
         self.discomfort_dist = config.reward.discomfort_dist
@@ -93,9 +139,16 @@ class CrowdSim(gym.Env):
         self.square_width = config.sim.square_width
         self.circle_radius = config.sim.circle_radius
         self.human_num = config.sim.human_num
+        if hasattr(config.sim, 'dynamic_human_num') and config.sim.dynamic_human_num:
+            # candidate crowd sizes, one is drawn for every case
+            self.dynamic_human_num = list(config.sim.dynamic_human_num)
 
         self.nonstop_human = config.sim.nonstop_human
         self.centralized_planning = config.sim.centralized_planning
+        if hasattr(config.sim, 'spatial_hash_cell_size'):
+            self.spatial_hash_cell_size = config.sim.spatial_hash_cell_size
+        self.position_hash = SpatialHash(self.spatial_hash_cell_size)
+        self.goal_hash = SpatialHash(self.spatial_hash_cell_size)
         self.case_counter = {'train': 0, 'test': 0, 'val': 0}
 
         human_policy = config.humans.policy
@@ -105,6 +158,11 @@ class CrowdSim(gym.Env):
             self.centralized_planner = policy_factory['centralized_' + human_policy]()
 
         logging.info('human number: {}'.format(self.human_num))
+        if self.robot_sensor_mode == 'knn':
+            logging.info('Robot senses the {} nearest humans within {}m'.format(self.robot_sensor_k,
+                                                                                self.robot_sensor_range))
+        if self.dynamic_human_num:
+            logging.info('dynamic human number: {}'.format(self.dynamic_human_num))
         if self.randomize_attributes:
             logging.info("Randomize human's radius and preferred speed")
         else:
@@ -119,78 +177,55 @@ class CrowdSim(gym.Env):
         if human is None:
             human = Human(self.config, 'humans')
         if self.randomize_attributes:
-            human.sample_random_attributes()
+            human.sample_random_attributes(self.rng)
         if square is False and non_stop is False:
             while True:
-                angle = np.random.random() * np.pi * 2
+                angle = self.rng.random() * np.pi * 2
                 # add some noise to simulate all the possible cases robot could meet with human
-                px_noise = (np.random.random() - 0.5) * human.v_pref
-                py_noise = (np.random.random() - 0.5) * human.v_pref
+                px_noise = (self.rng.random() - 0.5) * human.v_pref
+                py_noise = (self.rng.random() - 0.5) * human.v_pref
                 px = self.circle_radius * np.cos(angle) + px_noise
                 py = self.circle_radius * np.sin(angle) + py_noise
-                collide = False
-                for agent in [self.robot] + self.humans:
-                    min_dist = human.radius + agent.radius + self.discomfort_dist
-                    if norm((px - agent.px, py - agent.py)) < min_dist or \
-                            norm((px - agent.gx, py - agent.gy)) < min_dist:
-                        collide = True
-                        break
-                if not collide:
+                min_dist = human.radius + self.discomfort_dist
+                if not self.position_hash.occupied(px, py, min_dist) and \
+                        not self.goal_hash.occupied(px, py, min_dist):
                     break
             human.start_pos.append((px, py))
             human.set(px, py, -px, -py, 0, 0, 0)
         elif square is False and non_stop is True:
             while True:
-                angle = np.random.random() * np.pi * 2
+                angle = self.rng.random() * np.pi * 2
                 # add some noise to simulate all the possible cases robot could meet with human
                 px = human.px
                 py = human.py
-                gx_noise = (np.random.random() - 0.5) * human.v_pref
-                gy_noise = (np.random.random() - 0.5) * human.v_pref
+                gx_noise = (self.rng.random() - 0.5) * human.v_pref
+                gy_noise = (self.rng.random() - 0.5) * human.v_pref
                 gx = self.circle_radius * np.cos(angle) + gx_noise
                 gy = self.circle_radius * np.sin(angle) + gy_noise
-                collide = False
-                for agent in [self.robot] + self.humans:
-                    min_dist = human.radius + agent.radius + self.discomfort_dist
-                    # if norm((px - agent.px, py - agent.py)) == 0.0:
-                    #     continue
-                    if norm((gx - agent.gx, gy - agent.gy)) < min_dist:
-                        collide = True
-                        break
-                if not collide:
+                if not self.goal_hash.occupied(gx, gy, human.radius + self.discomfort_dist):
                     break
             human.start_pos.append((px, py))
             human.set(px, py, gx, gy, 0, 0, 0)
 
         elif square is True and non_stop is False:
-            if np.random.random() > 0.5:
+            if self.rng.random() > 0.5:
                 sign = -1
             else:
                 sign = 1
             while True:
-                px = np.random.random() * self.square_width * 0.5 * sign
-                py = (np.random.random() - 0.5) * self.square_width
-                collide = False
-                for agent in [self.robot] + self.humans:
-                    if norm((px - agent.px, py - agent.py)) < human.radius + agent.radius + self.discomfort_dist:
-                        collide = True
-                        break
-                if not collide:
+                px = self.rng.random() * self.square_width * 0.5 * sign
+                py = (self.rng.random() - 0.5) * self.square_width
+                if not self.position_hash.occupied(px, py, human.radius + self.discomfort_dist):
                     break
             while True:
-                gx = np.random.random() * self.square_width * 0.5 * (- sign)
-                gy = (np.random.random() - 0.5) * self.square_width
-                collide = False
-                for agent in [self.robot] + self.humans:
-                    if norm((gx - agent.gx, gy - agent.gy)) < human.radius + agent.radius + self.discomfort_dist:
-                        collide = True
-                        break
-                if not collide:
+                gx = self.rng.random() * self.square_width * 0.5 * (- sign)
+                gy = (self.rng.random() - 0.5) * self.square_width
+                if not self.goal_hash.occupied(gx, gy, human.radius + self.discomfort_dist):
                     break
             human.start_pos.append((px, py))
             human.set(px, py, gx, gy, 0, 0, 0)
         elif square is True and non_stop is True:
-            if np.random.random() > 0.5:
+            if self.rng.random() > 0.5:
                 sign = -1
             else:
                 sign = 1
@@ -199,22 +234,78 @@ class CrowdSim(gym.Env):
                 goal_count = goal_count + 1
                 px = human.px
                 py = human.py
-                gx = np.random.random() * self.square_width * 0.5 * (- sign)
-                gy = (np.random.random() - 0.5) * self.square_width
-                collide = False
-                for agent in [self.robot] + self.humans:
-                    min_dist = human.radius + agent.radius + self.discomfort_dist
-                    # if norm((px - agent.px, py - agent.py)) == 0.0:
-                    #     break
-                    if norm((gx - agent.gx, gy - agent.gy))<min_dist:
-                        collide = True
-                        break
-                if not collide:
+                gx = self.rng.random() * self.square_width * 0.5 * (- sign)
+                gy = (self.rng.random() - 0.5) * self.square_width
+                if not self.goal_hash.occupied(gx, gy, human.radius + self.discomfort_dist):
                     break
             human.start_pos.append((px, py))
             human.set(px, py, gx, gy, 0, 0, 0)
+        self.insert_agent(human)
         return human
 
+    def set_random_streams(self, seed):
+        """
+        The environment, the robot policy and the human policies draw from their own generators derived from the
+        case seed instead of the global np.random, so a case plays out the same no matter what else runs in the
+        process. Human policies are seeded once the humans of the case exist
+        """
+        env_seed, robot_seed, planner_seed, self.human_seeds = np.random.SeedSequence(seed).spawn(4)
+        self.rng = np.random.default_rng(env_seed)
+        if self.robot.policy is not None:
+            self.robot.policy.set_rng(np.random.default_rng(robot_seed))
+        if self.centralized_planner is not None:
+            self.centralized_planner.set_rng(np.random.default_rng(planner_seed))
+
+    def get_base_seed(self, phase):
+        train_seed_begin = [0, 10, 100, 1000, 10000]
+        val_seed_begin = [0, 10, 100, 1000, 10000]
+        test_seed_begin = [0, 10, 100, 1000, 10000]
+        base_seed = {'train': self.case_capacity['val'] + self.case_capacity['test'] + train_seed_begin[1],
+                     'val': 0 + val_seed_begin[1], 'test': self.case_capacity['val']+test_seed_begin[2]+1000}
+        return base_seed[phase]
+
+    def set_scenario_bank(self, phase, bank):
+        """ Read the initial conditions of the cases of phase from a scenario bank instead of generating them """
+        if bank is not None and (bank['circle_radius'] != self.circle_radius or
+                                 bank['square_width'] != self.square_width or
+                                 bank['discomfort_dist'] != self.discomfort_dist or
+                                 bank['randomize_attributes'] != self.randomize_attributes):
+            raise ValueError('Scenario bank does not match the scenario parameters of the environment')
+        # reset only reads the bank for cases of its scenario and number of humans
+        if bank is not None:
+            policy = self.robot.policy if self.robot is not None else None
+            if policy is not None and not policy.multiagent_training and phase in ['train', 'val']:
+                logging.warning('Scenario bank is not used in {}, {} cases are single human circle crossing'.format(
+                    phase, policy.name))
+            elif self.dynamic_human_num:
+                logging.warning('Scenario bank of {} humans is only used for the {} cases with as many humans, the '
+                                'number of humans is sampled from {}'.format(bank['human_num'], phase,
+                                                                              self.dynamic_human_num))
+        self.scenario_banks[phase] = bank
+
+    def load_humans_from_bank(self, bank, index):
+        humans = []
+        for (px, py), (gx, gy), radius, v_pref in zip(bank['positions'][index], bank['goals'][index],
+                                                      bank['radii'][index], bank['v_prefs'][index]):
+            human = Human(self.config, 'humans')
+            human.radius = radius
+            human.v_pref = v_pref
+            human.start_pos.append((px, py))
+            human.set(px, py, gx, gy, 0, 0, 0)
+            humans.append(human)
+        return humans
+
+    def insert_agent(self, agent):
+        self.position_hash.insert(agent, agent.px, agent.py, agent.radius)
+        self.goal_hash.insert(agent, agent.gx, agent.gy, agent.radius)
+
+    def update_spatial_hash(self):
+        """ Rebuild the grids from the current positions and goals of all agents, O(# of agents) """
+        self.position_hash.clear()
+        self.goal_hash.clear()
+        for agent in [self.robot] + self.humans:
+            self.insert_agent(agent)
+
     def reset(self, phase='test', test_case=None):
         """
         Set px, py, gx, gy, vx, vy, theta for robot and humans
@@ -228,22 +319,20 @@ class CrowdSim(gym.Env):
         if test_case is not None:
             self.case_counter[phase] = test_case
         self.global_time = 0
-        train_seed_begin = [0, 10, 100, 1000, 10000]
-        val_seed_begin = [0, 10, 100, 1000, 10000]
-        test_seed_begin = [0, 10, 100, 1000, 10000]
-        base_seed = {'train': self.case_capacity['val'] + self.case_capacity['test'] + train_seed_begin[1],
-                     'val': 0 + val_seed_begin[1], 'test': self.case_capacity['val']+test_seed_begin[2]+1000}
+        self.clear_human_actions()
 
         self.robot.set(0, -self.circle_radius, 0, self.circle_radius, 0, 0, np.pi / 2)
-        self.random_seed = base_seed[phase] + self.case_counter[phase]
-        np.random.seed(self.random_seed)
+        self.humans = []
+        self.update_spatial_hash()
+        self.random_seed = self.get_base_seed(phase) + self.case_counter[phase]
+        self.set_random_streams(self.random_seed)
         if self.case_counter[phase] >= 0:
             # np.random.seed(base_seed[phase] + self.case_counter[phase])
             # random.seed(base_seed[phase] + self.case_counter[phase])
             # random.seed(2100)
 
             if phase == 'test':
-                logging.debug('current test seed is:{}'.format(base_seed[phase] + self.case_counter[phase]))
+                logging.debug('current test seed is:{}'.format(self.random_seed))
                 # print('current test seed is:{}'.format(base_seed[phase] + self.case_counter[phase]))
             if not self.robot.policy.multiagent_training and phase in ['train', 'val']:
                 human_num = 1
@@ -251,8 +340,13 @@ class CrowdSim(gym.Env):
             else:
                 self.current_scenario = self.test_scenario
                 human_num = self.human_num
-            self.humans = []
-            for i in range(human_num):
+                if self.dynamic_human_num:
+                    human_num = self.rng.choice(self.dynamic_human_num)
+            bank = self.scenario_banks.get(phase)
+            if bank is not None and bank['scenario'] == self.current_scenario and bank['human_num'] == human_num \
+                    and 0 <= self.random_seed - bank['seed_begin'] < bank['case_num']:
+                self.humans = self.load_humans_from_bank(bank, self.random_seed - bank['seed_begin'])
+            for i in range(len(self.humans), human_num):
                 if self.current_scenario == 'circle_crossing':
                     if human_num > 5 and i > 4:
                         self.humans.append(self.generate_human(square=True))
@@ -274,6 +368,10 @@ class CrowdSim(gym.Env):
                 self.humans[2].set(5, -5, 5, 5, 0, 0, np.pi / 2)
             else:
                 raise NotImplementedError
+        self.update_spatial_hash()
+        for human, human_seed in zip(self.humans, self.human_seeds.spawn(len(self.humans))):
+            if human.policy is not None:
+                human.policy.set_rng(np.random.default_rng(human_seed))
         for agent in [self.robot] + self.humans:
             agent.time_step = self.time_step
             agent.policy.time_step = self.time_step
@@ -281,63 +379,103 @@ class CrowdSim(gym.Env):
         if self.centralized_planning:
             self.centralized_planner.time_step = self.time_step
 
-        self.states = list()
-        self.robot_actions = list()
-        self.rewards = list()
+        self.states = deque(maxlen=self.record_length)
+        self.robot_actions = deque(maxlen=self.record_length)
+        self.rewards = deque(maxlen=self.record_length)
         if hasattr(self.robot.policy, 'action_values'):
-            self.action_values = list()
+            self.action_values = deque(maxlen=self.record_length)
         if hasattr(self.robot.policy, 'get_attention_weights'):
-            self.attention_weights = list()
+            self.attention_weights = deque(maxlen=self.record_length)
         if hasattr(self.robot.policy, 'get_matrix_A'):
-            self.As = list()
+            self.As = deque(maxlen=self.record_length)
         if hasattr(self.robot.policy, 'get_feat'):
-            self.feats = list()
+            self.feats = deque(maxlen=self.record_length)
         if hasattr(self.robot.policy, 'get_X'):
-            self.Xs = list()
+            self.Xs = deque(maxlen=self.record_length)
         if hasattr(self.robot.policy, 'traj'):
-            self.trajs = list()
+            self.trajs = deque(maxlen=self.record_length)
+        # models only copy out their attention for visualization when it is recorded
+        if hasattr(self.robot.policy, 'set_record_attention'):
+            self.robot.policy.set_record_attention(self.record[phase] == 'full')
 
         # get current observation
         if self.robot.sensor == 'coordinates':
-            ob = self.compute_observation_for(self.robot)
+            ob = self.compute_robot_observation()
         elif self.robot.sensor == 'RGB':
             raise NotImplementedError
 
         return ob
 
+    def get_human_actions(self):
+        """
+        Human actions only depend on the current state and not on the robot action, so they are computed once per
+        time step and reused by every onestep_lookahead and the following step. When the robot is visible humans
+        react to the robot state, which is part of the cache key
+        """
+        key = (self.global_time, self.robot.get_full_state().to_tuple() if self.robot.visible else None)
+        if self.human_actions is None or self.human_actions_key != key:
+            if self.centralized_planning:
+                agent_states = [human.get_full_state() for human in self.humans]
+                if self.robot.visible:
+                    agent_states.append(self.robot.get_full_state())
+                    human_actions = self.centralized_planner.predict(agent_states)[:-1]
+                else:
+                    human_actions = self.centralized_planner.predict(agent_states)
+            else:
+                human_actions = []
+                for human in self.humans:
+                    ob = self.compute_observation_for(human)
+                    human_actions.append(human.act(ob))
+            self.human_actions_key = key
+            self.human_actions = human_actions
+            self.next_human_observable_states = None
+        return self.human_actions
+
+    def get_next_human_observable_states(self):
+        if self.next_human_observable_states is None:
+            self.next_human_observable_states = [human.get_next_observable_state(action) for human, action
+                                                 in zip(self.humans, self.get_human_actions())]
+        return self.next_human_observable_states
+
+    def clear_human_actions(self):
+        self.human_actions_key = None
+        self.human_actions = None
+        self.next_human_observable_states = None
+
     def onestep_lookahead(self, action):
+        """ Always returns ObservableState objects, the policies querying it build their states from objects """
         return self.step(action, update=False)
 
     def step(self, action, update=True):
         """
         Compute actions for all agents, detect collision, update environment and return (ob, reward, done, info)
         """
-        if self.centralized_planning:
-            agent_states = [human.get_full_state() for human in self.humans]
-            if self.robot.visible:
-                agent_states.append(self.robot.get_full_state())
-                human_actions = self.centralized_planner.predict(agent_states)[:-1]
-            else:
-                human_actions = self.centralized_planner.predict(agent_states)
-        else:
-            human_actions = []
-            for human in self.humans:
-                ob = self.compute_observation_for(human)
-                human_actions.append(human.act(ob))
+        human_actions = self.get_human_actions()
 
-        # collision detection
+        # collision detection, only humans that can get within the discomfort distance in this step are checked
         dmin = float('inf')
         collision = False
         collision_penalty = 0.0
+        if self.robot.kinematics == 'holonomic':
+            robot_velocity = action.vx, action.vy
+        else:
+            robot_velocity = action.v * np.cos(action.r + self.robot.theta), action.v * np.sin(action.r + self.robot.theta)
+        # humans move holonomically whatever the kinematics of the robot
+        human_velocities = [(human_action.vx, human_action.vy) if isinstance(human_action, ActionXY) else
+                            (human_action.v * np.cos(human_action.r + human.theta),
+                             human_action.v * np.sin(human_action.r + human.theta))
+                            for human, human_action in zip(self.humans, human_actions)]
+        robot_speed = np.hypot(*robot_velocity)
+        human_speed = max([np.hypot(vx, vy) for vx, vy in human_velocities], default=0)
+        reach = max(self.discomfort_dist, 0.2) + self.robot.radius + (robot_speed + human_speed) * self.time_step
+        nearby_humans = set(self.position_hash.query(self.robot.px, self.robot.py, reach))
         for i, human in enumerate(self.humans):
+            if human not in nearby_humans:
+                continue
             px = human.px - self.robot.px
             py = human.py - self.robot.py
-            if self.robot.kinematics == 'holonomic':
-                vx = human_actions[i].vx - action.vx
-                vy = human_actions[i].vy - action.vy
-            else:
-                vx = human_actions[i].v * np.cos(human_actions[i].r + self.robot.theta) - action.v * np.cos(action.r + self.robot.theta)
-                vy = human_actions[i].v * np.sin(human_actions[i].r + self.robot.theta) - action.v * np.sin(action.r + self.robot.theta)
+            vx = human_velocities[i][0] - robot_velocity[0]
+            vy = human_velocities[i][1] - robot_velocity[1]
             ex = px + vx * self.time_step
             ey = py + vy * self.time_step
             # closest distance between boundaries of two agents
@@ -350,16 +488,15 @@ class CrowdSim(gym.Env):
             if closest_dist < 0.2:
                 collision_penalty = collision_penalty + (closest_dist - self.discomfort_dist) * 0.25 * 0.5
 
-        # collision detection between humans
-        human_num = len(self.humans)
-        for i in range(human_num):
-            for j in range(i + 1, human_num):
-                dx = self.humans[i].px - self.humans[j].px
-                dy = self.humans[i].py - self.humans[j].py
-                dist = (dx ** 2 + dy ** 2) ** (1 / 2) - self.humans[i].radius - self.humans[j].radius
-                if dist < 0:
-                    # detect collision but don't take humans' collision into account
-                    logging.debug('Collision happens between humans in step()')
+        # collision detection between humans, only logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            checked_humans = set()
+            for human in self.humans:
+                checked_humans.add(human)
+                for other in self.position_hash.query(human.px, human.py, human.radius):
+                    if other is not self.robot and other not in checked_humans:
+                        # detect collision but don't take humans' collision into account
+                        logging.debug('Collision happens between humans in step()')
 
         # check if reaching the goal
         end_position = np.array(self.robot.compute_position(action, self.time_step))
@@ -367,7 +504,7 @@ class CrowdSim(gym.Env):
         goal_position = np.array(self.robot.get_goal_position())
         reward_goal = 0.01 * (norm(cur_position - goal_position) - norm(end_position - goal_position))
         reaching_goal = norm(end_position - goal_position) < self.robot.radius
-        action_vel_length = np.sqrt(action.vx*action.vx + action.vy*action.vy)
+        action_vel_length = np.hypot(*robot_velocity)
         robot_vel_length = np.sqrt(self.robot.vx*self.robot.vx + self.robot.vy*self.robot.vy)
         # delta_w = (self.robot.vx*action.vx + self.robot.vy*action.vy)/action_vel_length/robot_vel_length
         delta_w = 0.0
@@ -397,19 +534,20 @@ class CrowdSim(gym.Env):
         reward = reward * 10
 
         if update:
-            # store state, action value and attention weights
-            if hasattr(self.robot.policy, 'action_values'):
-                self.action_values.append(self.robot.policy.action_values)
-            if hasattr(self.robot.policy, 'get_attention_weights'):
-                self.attention_weights.append(self.robot.policy.get_attention_weights())
-            if hasattr(self.robot.policy, 'get_matrix_A'):
-                self.As.append(self.robot.policy.get_matrix_A())
-            if hasattr(self.robot.policy, 'get_feat'):
-                self.feats.append(self.robot.policy.get_feat())
-            if hasattr(self.robot.policy, 'get_X'):
-                self.Xs.append(self.robot.policy.get_X())
-            if hasattr(self.robot.policy, 'traj'):
-                self.trajs.append(self.robot.policy.get_traj())
+            # store action value and attention weights
+            if self.record[self.phase] == 'full':
+                if hasattr(self.robot.policy, 'action_values'):
+                    self.action_values.append(self.robot.policy.action_values)
+                if hasattr(self.robot.policy, 'get_attention_weights'):
+                    self.attention_weights.append(self.robot.policy.get_attention_weights())
+                if hasattr(self.robot.policy, 'get_matrix_A'):
+                    self.As.append(self.robot.policy.get_matrix_A())
+                if hasattr(self.robot.policy, 'get_feat'):
+                    self.feats.append(self.robot.policy.get_feat())
+                if hasattr(self.robot.policy, 'get_X'):
+                    self.Xs.append(self.robot.policy.get_X())
+                if hasattr(self.robot.policy, 'traj'):
+                    self.trajs.append(self.robot.policy.get_traj())
 
             # update all agents
             self.robot.step(action)
@@ -426,28 +564,68 @@ class CrowdSim(gym.Env):
                             human.reach_count = 0
 
             self.global_time += self.time_step
-            self.states.append([self.robot.get_full_state(), [human.get_full_state() for human in self.humans],
-                                [human.id for human in self.humans]])
-            self.robot_actions.append(action)
-            self.rewards.append(reward)
+            self.clear_human_actions()
+            self.update_spatial_hash()
+            if self.record[self.phase] != 'off':
+                self.states.append([self.robot.get_full_state(), [human.get_full_state() for human in self.humans],
+                                    [human.id for human in self.humans]])
+                self.robot_actions.append(action)
+                self.rewards.append(reward)
 
             # compute the observation
             if self.robot.sensor == 'coordinates':
-                ob = self.compute_observation_for(self.robot)
+                ob = self.compute_robot_observation()
             elif self.robot.sensor == 'RGB':
                 raise NotImplementedError
         else:
             if self.robot.sensor == 'coordinates':
-                ob = [human.get_next_observable_state(action) for human, action in zip(self.humans, human_actions)]
+                ob = list(self.get_next_human_observable_states())
+                if self.robot_sensor_mode != 'all':
+                    next_robot_position = self.robot.compute_position(action, self.time_step)
+                    sensed = self.sense_humans(next_robot_position, np.array([(o.px, o.py) for o in ob]))
+                    ob = [ob[i] for i in sensed]
             elif self.robot.sensor == 'RGB':
                 raise NotImplementedError
 
         return ob, reward, done, info
 
+    def sense_humans(self, robot_position, human_positions):
+        """
+        Indices of the humans observed by the robot given their positions as an array of shape (# of humans, 2).
+        Sensed humans keep their original order so that rows match between consecutive observations
+        as long as the same humans are in sight.
+        """
+        if self.robot_sensor_mode == 'all' or len(human_positions) == 0:
+            return np.arange(len(human_positions))
+        dists = np.linalg.norm(human_positions - np.asarray(robot_position), axis=1)
+        sensed = np.flatnonzero(dists <= self.robot_sensor_range)
+        if len(sensed) > self.robot_sensor_k:
+            sensed = sensed[np.argpartition(dists[sensed], self.robot_sensor_k - 1)[:self.robot_sensor_k]]
+        return np.sort(sensed)
+
+    def compute_robot_observation(self):
+        """
+        Observation returned by reset and step. With obs_mode 'array' it is the tuple of the robot full state (9,)
+        and the sensed human observable states (# of humans, 5) as float32 arrays, without building state objects
+        """
+        if self.obs_mode == 'object':
+            return self.compute_observation_for(self.robot)
+
+        human_states = np.array([(human.px, human.py, human.vx, human.vy, human.radius) for human in self.humans],
+                                dtype=float).reshape(-1, 5)
+        if self.robot_sensor_mode != 'all':
+            human_states = human_states[self.sense_humans(self.robot.get_position(), human_states[:, :2])]
+        return self.robot.get_full_state_array(), human_states.astype(np.float32)
+
     def compute_observation_for(self, agent):
         if agent == self.robot:
             ob = []
-            for human in self.humans:
+            if self.robot_sensor_mode == 'all':
+                humans = self.humans
+            else:
+                human_positions = np.array([human.get_position() for human in self.humans])
+                humans = [self.humans[i] for i in self.sense_humans(agent.get_position(), human_positions)]
+            for human in humans:
                 ob.append(human.get_observable_state())
         else:
             ob = [other_human.get_observable_state() for other_human in self.humans if other_human != agent]
@@ -458,6 +636,8 @@ class CrowdSim(gym.Env):
     def render(self, mode='video', output_file=None):
         from matplotlib import animation
         import matplotlib.pyplot as plt
+        if mode in ['traj', 'video'] and not self.states:
+            raise ValueError('No states recorded in phase {}, set env.record to render it'.format(self.phase))
         # plt.rcParams['animation.ffmpeg_path'] = '/usr/bin/ffmpeg'
         x_offset = 0.3
         y_offset = 0.4
@@ -518,7 +698,7 @@ class CrowdSim(gym.Env):
                     agents = humans + [robot]
                     times = [plt.text(agents[i].center[0]+0.1, agents[i].center[1]+0.1,
                                       '{:.1f}'.format(global_time),
-                                      color='black', fontsize=12) for i in range(self.human_num + 1)]
+                                      color='black', fontsize=12) for i in range(len(self.humans) + 1)]
                     for time in times:
                        ax.add_artist(time)
                 if k != 0:
@@ -528,7 +708,7 @@ class CrowdSim(gym.Env):
                     human_directions = [plt.Line2D((self.states[k - 1][1][i].px, self.states[k][1][i].px),
                                                    (self.states[k - 1][1][i].py, self.states[k][1][i].py),
                                                    color=human_colors[i], ls='solid')
-                                        for i in range(self.human_num)]
+                                        for i in range(len(self.humans))]
                     ax.add_artist(nav_direction)
                     for human_direction in human_directions:
                         ax.add_artist(human_direction)
@@ -605,7 +785,7 @@ class CrowdSim(gym.Env):
             # compute orientation in each step and use arrow to show the direction
             radius = self.robot.radius
             orientations = []
-            for i in range(self.human_num + 1):
+            for i in range(len(self.humans) + 1):
                 orientation = []
                 for state in self.states:
                     agent_state = state[0] if i == 0 else state[1][i - 1]
@@ -676,7 +856,7 @@ class CrowdSim(gym.Env):
                 for arrow in arrows:
                     arrow.remove()
 
-                for i in range(self.human_num + 1):
+                for i in range(len(self.humans) + 1):
                     orientation = orientations[i]
                     if i == 0:
                         arrows = [patches.FancyArrowPatch(*orientation[frame_num], color=robot_arrow_color,
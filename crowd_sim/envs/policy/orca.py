@@ -3,6 +3,10 @@ import rvo2
 from crowd_sim.envs.policy.policy import Policy
 from crowd_sim.envs.utils.action import ActionXY
 
+# slots of the simulator without agent are parked far away from the crowd and further apart than neighbor_dist
+PARKING_POSITION = 1e5
+PARKING_INTERVAL = 100
+
 
 class ORCA(Policy):
     def __init__(self):
@@ -65,6 +69,11 @@ class ORCA(Policy):
         self.radius = 0.3
         self.max_speed = 1
         self.sim = None
+        # persistent simulator, agents are assigned to pooled slots and the rest of the slots are parked
+        self.active_slots = np.zeros(0, dtype=bool)
+        self.slot_radii = np.zeros(0)
+        self.slot_max_speeds = np.zeros(0)
+        self.sim_time_step = None
         self.speed_samples = 5
         self.rotation_samples = 16
         self.sampling = None
@@ -95,23 +104,10 @@ class ORCA(Policy):
         :return:
         """
         robot_state = state.robot_state
-        params = self.neighbor_dist, self.max_neighbors, self.time_horizon, self.time_horizon_obst
-        if self.sim is not None and self.sim.getNumAgents() != len(state.human_states) + 1:
-            del self.sim
-            self.sim = None
-        if self.sim is None:
-            self.sim = rvo2.PyRVOSimulator(self.time_step, *params, self.radius, self.max_speed)
-            self.sim.addAgent(robot_state.position, *params, robot_state.radius + 0.01, #+ self.safety_space,
-                              robot_state.v_pref, robot_state.velocity)
-            for human_state in state.human_states:
-                self.sim.addAgent(human_state.position, *params, human_state.radius + 0.01 + self.safety_space,
-                                  self.max_speed, human_state.velocity)
-        else:
-            self.sim.setAgentPosition(0, robot_state.position)
-            self.sim.setAgentVelocity(0, robot_state.velocity)
-            for i, human_state in enumerate(state.human_states):
-                self.sim.setAgentPosition(i + 1, human_state.position)
-                self.sim.setAgentVelocity(i + 1, human_state.velocity)
+        radii = [robot_state.radius + 0.01] + [human_state.radius + 0.01 + self.safety_space
+                                              for human_state in state.human_states]
+        max_speeds = [robot_state.v_pref] + [self.max_speed] * len(state.human_states)
+        self.update_simulator([robot_state] + list(state.human_states), radii, max_speeds)
 
         # Set the preferred velocity to be a vector of unit magnitude (speed) in the direction of the goal.
         velocity = np.array((robot_state.gx - robot_state.px, robot_state.gy - robot_state.py))
@@ -152,6 +148,49 @@ class ORCA(Policy):
 
         return action, action_index
 
+    def update_simulator(self, agent_states, radii, max_speeds):
+        """
+        Write the agents into the first slots of the persistent simulator, instead of rebuilding it when the number
+        of agents changes. Slots are added when there are more agents than ever before, and slots that lose their
+        agent are parked out of the neighborhood of every other agent with zero velocity
+        """
+        params = self.neighbor_dist, self.max_neighbors, self.time_horizon, self.time_horizon_obst
+        if self.sim is None:
+            self.sim = rvo2.PyRVOSimulator(self.time_step, *params, self.radius, self.max_speed)
+            self.sim_time_step = self.time_step
+        elif self.sim_time_step != self.time_step:
+            self.sim.setTimeStep(self.time_step)
+            self.sim_time_step = self.time_step
+
+        agent_num = len(agent_states)
+        slot_num = self.sim.getNumAgents()
+        for i in range(slot_num, agent_num):
+            self.sim.addAgent(self.parking_position(i), *params, radii[i], max_speeds[i], (0, 0))
+        if agent_num > slot_num:
+            self.active_slots = np.concatenate([self.active_slots, np.zeros(agent_num - slot_num, dtype=bool)])
+            self.slot_radii = np.concatenate([self.slot_radii, radii[slot_num:]])
+            self.slot_max_speeds = np.concatenate([self.slot_max_speeds, max_speeds[slot_num:]])
+
+        for i, agent_state in enumerate(agent_states):
+            self.sim.setAgentPosition(i, agent_state.position)
+            self.sim.setAgentVelocity(i, agent_state.velocity)
+            if self.slot_radii[i] != radii[i]:
+                self.sim.setAgentRadius(i, radii[i])
+                self.slot_radii[i] = radii[i]
+            if self.slot_max_speeds[i] != max_speeds[i]:
+                self.sim.setAgentMaxSpeed(i, max_speeds[i])
+                self.slot_max_speeds[i] = max_speeds[i]
+        for i in np.flatnonzero(self.active_slots[agent_num:]) + agent_num:
+            self.sim.setAgentPosition(i, self.parking_position(i))
+            self.sim.setAgentVelocity(i, (0, 0))
+            self.sim.setAgentPrefVelocity(i, (0, 0))
+        self.active_slots[:agent_num] = True
+        self.active_slots[agent_num:] = False
+
+    @staticmethod
+    def parking_position(slot):
+        return PARKING_POSITION + PARKING_INTERVAL * slot, PARKING_POSITION
+
 
 class CentralizedORCA(ORCA):
     def __init__(self):
@@ -159,20 +198,8 @@ class CentralizedORCA(ORCA):
 
     def predict(self, state):
         """ Centralized planning for all agents """
-        params = self.neighbor_dist, self.max_neighbors, self.time_horizon, self.time_horizon_obst
-        if self.sim is not None and self.sim.getNumAgents() != len(state):
-            del self.sim
-            self.sim = None
-
-        if self.sim is None:
-            self.sim = rvo2.PyRVOSimulator(self.time_step, *params, self.radius, self.max_speed)
-            for agent_state in state:
-                self.sim.addAgent(agent_state.position, *params, agent_state.radius + 0.01 + self.safety_space,
-                                  self.max_speed, agent_state.velocity)
-        else:
-            for i, agent_state in enumerate(state):
-                self.sim.setAgentPosition(i, agent_state.position)
-                self.sim.setAgentVelocity(i, agent_state.velocity)
+        radii = [agent_state.radius + 0.01 + self.safety_space for agent_state in state]
+        self.update_simulator(state, radii, [self.max_speed] * len(state))
 
         # Set the preferred velocity to be a vector of unit magnitude (speed) in the direction of the goal.
         for i, agent_state in enumerate(state):
@@ -0,0 +1,283 @@
+import numpy as np
+from crowd_sim.envs.policy.policy import Policy
+from crowd_sim.envs.utils.action import ActionXY
+
+RVO_EPSILON = 0.00001
+
+
+def det(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def dot(a, b):
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1]
+
+
+def linear_program1(points, directions, line_no, radius, opt_velocity, direction_opt):
+    """
+    Optimize on the line line_no subject to the previous lines and the max speed circle, for all agents at once
+    points and directions are of shape (# of agents, # of lines, 2)
+    """
+    point = points[:, line_no]
+    direction = directions[:, line_no]
+    dot_product = dot(point, direction)
+    discriminant = dot_product ** 2 + radius ** 2 - dot(point, point)
+    feasible = discriminant >= 0
+    sqrt_discriminant = np.sqrt(np.maximum(discriminant, 0))
+    t_left = -dot_product - sqrt_discriminant
+    t_right = -dot_product + sqrt_discriminant
+
+    for i in range(line_no):
+        denominator = det(direction, directions[:, i])
+        numerator = det(directions[:, i], point - points[:, i])
+        parallel = np.abs(denominator) <= RVO_EPSILON
+        feasible &= ~(parallel & (numerator < 0))
+        t = numerator / np.where(parallel, 1, denominator)
+        t_right = np.where(~parallel & (denominator >= 0), np.minimum(t_right, t), t_right)
+        t_left = np.where(~parallel & (denominator < 0), np.maximum(t_left, t), t_left)
+        feasible &= t_left <= t_right
+
+    if direction_opt:
+        t = np.where(dot(opt_velocity, direction) > 0, t_right, t_left)
+    else:
+        t = np.minimum(np.maximum(dot(direction, opt_velocity - point), t_left), t_right)
+    return feasible, point + t[:, None] * direction
+
+
+def linear_program2(points, directions, line_num, radius, opt_velocity, direction_opt):
+    """
+    Closest velocity to opt_velocity inside the max speed circle satisfying the first line_num lines of each agent
+    Returns the index of the first line that fails for each agent (line_num if none) and the velocities
+    """
+    if direction_opt:
+        result = opt_velocity * radius[:, None]
+    else:
+        speed = np.linalg.norm(opt_velocity, axis=1)
+        scale = np.where(speed > radius, radius / np.where(speed > 0, speed, 1), 1)
+        result = opt_velocity * scale[:, None]
+
+    fail = line_num.copy()
+    active = np.ones(len(result), dtype=bool)
+    for i in range(points.shape[1]):
+        violated = active & (i < line_num) & (det(directions[:, i], points[:, i] - result) > 0)
+        if not violated.any():
+            continue
+        feasible, new_result = linear_program1(points, directions, i, radius, opt_velocity, direction_opt)
+        failed = violated & ~feasible
+        fail[failed] = i
+        active &= ~failed
+        result = np.where((violated & feasible)[:, None], new_result, result)
+    return fail, result
+
+
+def linear_program3(points, directions, line_num, begin, radius, result):
+    """ Velocities that minimize the maximum violation of the lines from begin on, when linear_program2 fails """
+    distance = np.zeros(len(result))
+    for i in range(points.shape[1]):
+        point = points[:, i]
+        direction = directions[:, i]
+        violated = (i >= begin) & (i < line_num) & (det(direction, point - result) > distance)
+        if not violated.any():
+            continue
+        # project the previous lines on line i, parallel lines in the same direction are dropped
+        previous_points = points[:, :i]
+        previous_directions = directions[:, :i]
+        determinant = det(direction[:, None], previous_directions)
+        parallel = np.abs(determinant) <= RVO_EPSILON
+        dropped = parallel & (dot(direction[:, None], previous_directions) > 0)
+        t = det(previous_directions, point[:, None] - previous_points) / np.where(parallel, 1, determinant)
+        projected_points = np.where(parallel[..., None], 0.5 * (point[:, None] + previous_points),
+                                    point[:, None] + t[..., None] * direction[:, None])
+        projected_directions = previous_directions - direction[:, None]
+        norms = np.linalg.norm(projected_directions, axis=2, keepdims=True)
+        projected_directions = projected_directions / np.where(norms > 0, norms, 1)
+        # move the kept lines to the front, in their original order
+        order = np.argsort(dropped, axis=1, kind='stable')
+        projected_points = np.take_along_axis(projected_points, order[..., None], axis=1)
+        projected_directions = np.take_along_axis(projected_directions, order[..., None], axis=1)
+        projected_num = i - dropped.sum(axis=1)
+
+        opt_direction = np.stack([-direction[:, 1], direction[:, 0]], axis=1)
+        fail, new_result = linear_program2(projected_points, projected_directions, projected_num, radius,
+                                           opt_direction, True)
+        result = np.where((violated & (fail >= projected_num))[:, None], new_result, result)
+        distance = np.where(violated, det(direction, point - result), distance)
+    return result
+
+
+def compute_orca_lines(positions, velocities, radii, neighbors, neighbor_mask, time_step, time_horizon):
+    """
+    ORCA half-planes (point, direction) induced by the neighbors of every agent, of shape (..., # of neighbors, 2)
+    """
+    neighbor_positions = np.take_along_axis(positions[..., None, :, :], neighbors[..., None], axis=-2)
+    neighbor_velocities = np.take_along_axis(velocities[..., None, :, :], neighbors[..., None], axis=-2)
+    neighbor_radii = np.take_along_axis(radii[..., None, :], neighbors, axis=-1)
+    relative_position = neighbor_positions - positions[..., None, :]
+    relative_velocity = velocities[..., None, :] - neighbor_velocities
+    dist_sq = dot(relative_position, relative_position)
+    combined_radius = radii[..., None] + neighbor_radii
+    combined_radius_sq = combined_radius ** 2
+    colliding = dist_sq <= combined_radius_sq
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # no collision, project on the cut-off circle or on one of the legs of the velocity obstacle
+        inv_time_horizon = 1.0 / time_horizon
+        w = relative_velocity - inv_time_horizon * relative_position
+        w_length_sq = dot(w, w)
+        dot_product1 = dot(w, relative_position)
+        on_circle = (dot_product1 < 0) & (dot_product1 ** 2 > combined_radius_sq * w_length_sq)
+        w_length = np.sqrt(w_length_sq)
+        unit_w = w / w_length[..., None]
+        circle_direction = np.stack([unit_w[..., 1], -unit_w[..., 0]], axis=-1)
+        circle_u = (combined_radius * inv_time_horizon - w_length)[..., None] * unit_w
+
+        leg = np.sqrt(dist_sq - combined_radius_sq)
+        rx, ry = relative_position[..., 0], relative_position[..., 1]
+        left_leg = np.stack([rx * leg - ry * combined_radius, rx * combined_radius + ry * leg], axis=-1)
+        right_leg = -np.stack([rx * leg + ry * combined_radius, -rx * combined_radius + ry * leg], axis=-1)
+        leg_direction = np.where((det(relative_position, w) > 0)[..., None], left_leg, right_leg) / dist_sq[..., None]
+        leg_u = dot(relative_velocity, leg_direction)[..., None] * leg_direction - relative_velocity
+
+        # collision, project on the cut-off circle of the time step
+        inv_time_step = 1.0 / time_step
+        w = relative_velocity - inv_time_step * relative_position
+        w_length = np.sqrt(dot(w, w))
+        unit_w = w / w_length[..., None]
+        collision_direction = np.stack([unit_w[..., 1], -unit_w[..., 0]], axis=-1)
+        collision_u = (combined_radius * inv_time_step - w_length)[..., None] * unit_w
+
+    direction = np.where(colliding[..., None], collision_direction,
+                         np.where(on_circle[..., None], circle_direction, leg_direction))
+    u = np.where(colliding[..., None], collision_u, np.where(on_circle[..., None], circle_u, leg_u))
+    point = velocities[..., None, :] + 0.5 * u
+    # invalid neighbors never get checked, they only need finite values
+    direction = np.where(neighbor_mask[..., None], direction, 0)
+    point = np.where(neighbor_mask[..., None], point, 0)
+    return point, direction
+
+
+def compute_orca_velocities(positions, velocities, pref_velocities, radii, max_speeds, time_step, neighbor_dist,
+                            max_neighbors, time_horizon, agent_mask=None):
+    """
+    One ORCA step for all agents of a batch of simulations, the same as doStep of RVO2 without obstacles
+    positions, velocities and pref_velocities are of shape (..., # of agents, 2), radii and max_speeds of shape
+    (..., # of agents), e.g. with a leading dimension for environments. agent_mask of shape (..., # of agents)
+    marks padded agents when the simulations have different numbers of agents.
+    Returns the new velocities of shape (..., # of agents, 2), zero for padded agents
+    """
+    positions = np.asarray(positions, dtype=float)
+    velocities = np.asarray(velocities, dtype=float)
+    pref_velocities = np.asarray(pref_velocities, dtype=float)
+    batch_shape, agent_num = positions.shape[:-2], positions.shape[-2]
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), batch_shape + (agent_num,))
+    max_speeds = np.broadcast_to(np.asarray(max_speeds, dtype=float), batch_shape + (agent_num,))
+    if agent_mask is None:
+        agent_mask = np.ones(batch_shape + (agent_num,), dtype=bool)
+
+    # the max_neighbors nearest agents strictly within neighbor_dist, ordered by distance
+    offsets = positions[..., None, :, :] - positions[..., :, None, :]
+    dist_sq = dot(offsets, offsets)
+    invalid = ~agent_mask[..., None, :] | np.eye(agent_num, dtype=bool) | (dist_sq >= neighbor_dist ** 2)
+    dist_sq = np.where(invalid, np.inf, dist_sq)
+    neighbor_num = min(max_neighbors, agent_num - 1)
+    neighbors = np.argsort(dist_sq, axis=-1, kind='stable')[..., :max(neighbor_num, 0)]
+    neighbor_mask = np.isfinite(np.take_along_axis(dist_sq, neighbors, axis=-1)) & agent_mask[..., None]
+    points, directions = compute_orca_lines(positions, velocities, radii, neighbors, neighbor_mask, time_step,
+                                            time_horizon)
+
+    # solve the linear programs of all agents together
+    line_shape = (int(np.prod(batch_shape + (agent_num,))), neighbors.shape[-1], 2)
+    points, directions = points.reshape(line_shape), directions.reshape(line_shape)
+    line_num = neighbor_mask.reshape(line_shape[:2]).sum(axis=1)
+    radius = max_speeds.reshape(-1)
+    fail, new_velocities = linear_program2(points, directions, line_num, radius,
+                                           pref_velocities.reshape(-1, 2), False)
+    infeasible = fail < line_num
+    if infeasible.any():
+        new_velocities[infeasible] = linear_program3(points[infeasible], directions[infeasible],
+                                                     line_num[infeasible], fail[infeasible], radius[infeasible],
+                                                     new_velocities[infeasible])
+    new_velocities = new_velocities.reshape(positions.shape)
+    return np.where(agent_mask[..., None], new_velocities, 0)
+
+
+class ORCAVec(Policy):
+    def __init__(self):
+        """
+        Pure numpy ORCA with the same parameters and outputs as the rvo2 based ORCA policy, see ORCA for the meaning
+        of the parameters. Agents are solved all at once instead of through a rvo2 simulator
+        """
+        super().__init__()
+        self.name = 'ORCAVec'
+        self.trainable = False
+        self.multiagent_training = True
+        self.kinematics = 'holonomic'
+        self.safety_space = 0
+        self.neighbor_dist = 10
+        self.max_neighbors = 10
+        self.time_horizon = 5
+        self.time_horizon_obst = 5
+        self.radius = 0.3
+        self.max_speed = 1
+
+    def configure(self, config, device='cpu'):
+        return
+
+    def set_phase(self, phase):
+        return
+
+    @staticmethod
+    def compute_pref_velocities(goals, positions):
+        # unit speed towards the goal, slowing down within the last meter
+        velocities = goals - positions
+        speeds = np.linalg.norm(velocities, axis=-1, keepdims=True)
+        return np.where(speeds > 1, velocities / np.where(speeds > 0, speeds, 1), velocities)
+
+    def compute_velocities(self, positions, velocities, pref_velocities, radii, max_speeds, agent_mask=None):
+        return compute_orca_velocities(positions, velocities, pref_velocities, radii, max_speeds, self.time_step,
+                                       self.neighbor_dist, self.max_neighbors, self.time_horizon, agent_mask)
+
+    def predict(self, state):
+        """ The robot moves to its goal and the humans, whose goals are unknown, are simulated with zero speed """
+        robot_state = state.robot_state
+        agent_states = [robot_state] + list(state.human_states)
+        positions = np.array([agent_state.position for agent_state in agent_states])
+        velocities = np.array([agent_state.velocity for agent_state in agent_states])
+        radii = np.array([agent_state.radius + 0.01 for agent_state in agent_states])
+        radii[1:] += self.safety_space
+        max_speeds = np.full(len(agent_states), self.max_speed, dtype=float)
+        max_speeds[0] = robot_state.v_pref
+        pref_velocities = np.zeros_like(positions)
+        pref_velocities[0] = self.compute_pref_velocities(np.array(robot_state.goal_position), positions[0])
+
+        new_velocities = self.compute_velocities(positions, velocities, pref_velocities, radii, max_speeds)
+        self.last_state = state
+
+        return ActionXY(*new_velocities[0]), -1
+
+
+class CentralizedORCAVec(ORCAVec):
+    def __init__(self):
+        super().__init__()
+
+    def predict(self, state):
+        """ Centralized planning for all agents """
+        return self.predict_batch([state])[0]
+
+    def predict_batch(self, states):
+        """
+        Centralized planning for the agents of several simulations in one solve, simulations with fewer agents
+        are padded. states is a list of lists of full states, returns a list of lists of actions
+        """
+        agent_nums = [len(state) for state in states]
+        agent_mask = np.arange(max(agent_nums))[None, :] < np.array(agent_nums)[:, None]
+        agent_features = np.zeros(agent_mask.shape + (7,))
+        for i, state in enumerate(states):
+            agent_features[i, :len(state)] = [(s.px, s.py, s.vx, s.vy, s.gx, s.gy, s.radius) for s in state]
+        positions = agent_features[..., 0:2]
+        pref_velocities = self.compute_pref_velocities(agent_features[..., 4:6], positions)
+        radii = agent_features[..., 6] + 0.01 + self.safety_space
+
+        new_velocities = self.compute_velocities(positions, agent_features[..., 2:4], pref_velocities, radii,
+                                                 self.max_speed, agent_mask)
+        return [[ActionXY(*new_velocities[i, j]) for j in range(agent_num)] for i, agent_num in enumerate(agent_nums)]
@@ -16,6 +16,8 @@ class Policy(object):
         self.time_step = None
         # if agent is assumed to know the dynamics of real world
         self.env = None
+        # own random stream, seeded per case by the environment
+        self.rng = np.random.default_rng()
 
     @abc.abstractmethod
     def configure(self, config):
@@ -33,6 +35,18 @@ class Policy(object):
     def set_time_step(self, time_step):
         self.time_step = time_step
 
+    def set_rng(self, rng):
+        self.rng = rng
+
+    def set_record_attention(self, record_attention):
+        """ Let the models copy out their attention weights for visualization, skipped when nothing is recorded """
+        models = self.model if isinstance(self.model, list) else [self.model]
+        for model in models:
+            if isinstance(model, torch.nn.Module):
+                for module in model.modules():
+                    if hasattr(module, 'record_attention'):
+                        module.record_attention = record_attention
+
     def get_model(self):
         return self.model
 
@@ -1,6 +1,8 @@
 from crowd_sim.envs.policy.linear import Linear
 from crowd_sim.envs.policy.orca import ORCA, CentralizedORCA
+from crowd_sim.envs.policy.orca_vec import ORCAVec, CentralizedORCAVec
 from crowd_sim.envs.policy.socialforce import SocialForce, CentralizedSocialForce
+from crowd_sim.envs.policy.socialforce_vec import SocialForceVec, CentralizedSocialForceVec
 
 
 def none_policy():
@@ -12,5 +14,9 @@ policy_factory['linear'] = Linear
 policy_factory['orca'] = ORCA
 policy_factory['socialforce'] = SocialForce
 policy_factory['centralized_orca'] = CentralizedORCA
+policy_factory['orca_vec'] = ORCAVec
+policy_factory['centralized_orca_vec'] = CentralizedORCAVec
 policy_factory['centralized_socialforce'] = CentralizedSocialForce
+policy_factory['socialforce_vec'] = SocialForceVec
+policy_factory['centralized_socialforce_vec'] = CentralizedSocialForceVec
 policy_factory['none'] = none_policy
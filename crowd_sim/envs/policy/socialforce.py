@@ -3,6 +3,10 @@ import socialforce
 from crowd_sim.envs.policy.policy import Policy
 from crowd_sim.envs.utils.action import ActionXY
 
+# slots of the simulator without agent are parked far away from the crowd, where their forces vanish
+PARKING_POSITION = 1e5
+PARKING_INTERVAL = 100
+
 
 class SocialForce(Policy):
     def __init__(self):
@@ -15,6 +19,9 @@ class SocialForce(Policy):
         self.v0 = 10
         self.sigma = 0.3
         self.sim = None
+        # persistent simulator, agents are written into pooled slots and the rest of the slots are parked
+        self.parked_state = None
+        self.sim_time_step = None
 
     def configure(self, config):
         return
@@ -34,14 +41,13 @@ class SocialForce(Policy):
         for human_state in state.human_states:
             # approximate desired direction with current velocity
             if human_state.vx == 0 and human_state.vy == 0:
-                gx = np.random.random()
-                gy = np.random.random()
+                gx = self.rng.random()
+                gy = self.rng.random()
             else:
                 gx = human_state.px + human_state.vx
                 gy = human_state.py + human_state.vy
             sf_state.append((human_state.px, human_state.py, human_state.vx, human_state.vy, gx, gy))
-        sim = socialforce.Simulator(np.array(sf_state), delta_t=self.time_step, initial_speed=self.initial_speed,
-                                    v0=self.v0, sigma=self.sigma)
+        sim = self.update_simulator(np.array(sf_state))
         sim.step()
         action = ActionXY(sim.state[0, 2], sim.state[0, 3])
 
@@ -49,6 +55,27 @@ class SocialForce(Policy):
 
         return action
 
+    def update_simulator(self, sf_state):
+        """
+        Write the agents into the first slots of the persistent simulator and park the remaining slots, the simulator
+        is only rebuilt when there are more agents than slots. Desired speeds are fixed by initial_speed, so the
+        simulator does not depend on the state it was built with
+        """
+        agent_num = len(sf_state)
+        if self.sim is None or len(self.sim.state) < agent_num or self.sim_time_step != self.time_step:
+            slots = np.arange(agent_num)
+            self.parked_state = np.zeros((agent_num, 6))
+            self.parked_state[:, 0] = PARKING_POSITION + PARKING_INTERVAL * slots
+            self.parked_state[:, 1] = PARKING_POSITION
+            self.parked_state[:, 4] = self.parked_state[:, 0] + 1
+            self.parked_state[:, 5] = PARKING_POSITION
+            self.sim = socialforce.Simulator(self.parked_state.copy(), delta_t=self.time_step,
+                                             initial_speed=self.initial_speed, v0=self.v0, sigma=self.sigma)
+            self.sim_time_step = self.time_step
+        self.sim.state[:agent_num, :6] = sf_state
+        self.sim.state[agent_num:, :6] = self.parked_state[agent_num:]
+        return self.sim
+
 
 class CentralizedSocialForce(SocialForce):
     """
@@ -64,10 +91,8 @@ class CentralizedSocialForce(SocialForce):
             sf_state.append((agent_state.px, agent_state.py, agent_state.vx, agent_state.vy,
                              agent_state.gx, agent_state.gy))
 
-        sim = socialforce.Simulator(np.array(sf_state), delta_t=self.time_step, initial_speed=self.initial_speed,
-                                    v0=self.v0, sigma=self.sigma)
+        sim = self.update_simulator(np.array(sf_state))
         sim.step()
         actions = [ActionXY(sim.state[i, 2], sim.state[i, 3]) for i in range(len(state))]
-        del sim
 
         return actions
@@ -0,0 +1,134 @@
+import numpy as np
+from crowd_sim.envs.policy.policy import Policy
+from crowd_sim.envs.utils.action import ActionXY
+
+# same constants as socialforce.Simulator
+MAX_SPEED_MULTIPLIER = 1.3
+FIELD_OF_VIEW = 200.0 / 180.0 * np.pi
+OUT_OF_VIEW_FACTOR = 0.5
+GRADIENT_DELTA = 1e-3
+
+
+def desired_directions(state):
+    """ Unit vectors from the positions to the goals of state (..., # of agents, 6), zero at the goal """
+    destination_vectors = state[..., 4:6] - state[..., 0:2]
+    norms = np.linalg.norm(destination_vectors, axis=-1, keepdims=True)
+    return destination_vectors / np.where(norms > 0, norms, 1)
+
+
+def pedestrian_potential(r_ab, speeds, directions, delta_t, v0, sigma):
+    """ Repulsive potential v0 * exp(-b / sigma) of every pair (a, b), b being the semi-minor axis of the ellipse
+    that b walks on within delta_t
+    """
+    step = (delta_t * speeds)[..., None, :, None] * directions[..., None, :, :]
+    in_sum = np.linalg.norm(r_ab, axis=-1) + np.linalg.norm(r_ab - step, axis=-1)
+    b = 0.5 * np.sqrt(np.maximum(in_sum ** 2 - (delta_t * speeds)[..., None, :] ** 2, 0))
+    return v0 * np.exp(-b / sigma)
+
+
+def compute_social_forces(state, delta_t, v0, sigma, initial_speed, tau=0.5, agent_mask=None):
+    """
+    Goal attraction plus pairwise repulsion of the agents in state (..., # of agents, 6) with columns
+    (px, py, vx, vy, gx, gy), e.g. of shape (batch_size, # of agents, 6), as in socialforce.Simulator.
+    agent_mask of shape (..., # of agents) marks padded agents, which neither exert nor feel forces
+    """
+    agent_num = state.shape[-2]
+    velocities = state[..., 2:4]
+    directions = desired_directions(state)
+    speeds = np.linalg.norm(velocities, axis=-1)
+    attraction = (initial_speed * directions - velocities) / tau
+
+    # repulsion is minus the gradient of the potential w.r.t. r_ab, by finite differences as in socialforce
+    r_ab = state[..., :, None, 0:2] - state[..., None, :, 0:2]
+    potential = pedestrian_potential(r_ab, speeds, directions, delta_t, v0, sigma)
+    gradient = np.stack([
+        pedestrian_potential(r_ab + np.array([GRADIENT_DELTA, 0]), speeds, directions, delta_t, v0, sigma) - potential,
+        pedestrian_potential(r_ab + np.array([0, GRADIENT_DELTA]), speeds, directions, delta_t, v0, sigma) - potential
+    ], axis=-1) / GRADIENT_DELTA
+    repulsion = -gradient
+
+    # forces from outside the field of view are weakened
+    in_sight = np.einsum('...aj,...abj->...ab', directions, -repulsion) > \
+        np.linalg.norm(repulsion, axis=-1) * np.cos(FIELD_OF_VIEW / 2)
+    weights = np.where(in_sight, 1.0, OUT_OF_VIEW_FACTOR)
+    pair_mask = ~np.eye(agent_num, dtype=bool)
+    if agent_mask is not None:
+        pair_mask = pair_mask & agent_mask[..., :, None] & agent_mask[..., None, :]
+    weights = weights * pair_mask
+
+    forces = attraction + np.sum(weights[..., None] * repulsion, axis=-2)
+    if agent_mask is not None:
+        forces = forces * agent_mask[..., None]
+    return forces
+
+
+def socialforce_step(state, delta_t, v0, sigma, initial_speed, tau=0.5, agent_mask=None):
+    """ One step of the social force model for all agents of state (..., # of agents, 6), returns the new state """
+    state = np.array(state, dtype=float)
+    forces = compute_social_forces(state, delta_t, v0, sigma, initial_speed, tau, agent_mask)
+    velocities = state[..., 2:4] + delta_t * forces
+    speeds = np.linalg.norm(velocities, axis=-1, keepdims=True)
+    max_speed = MAX_SPEED_MULTIPLIER * initial_speed
+    state[..., 2:4] = velocities * np.minimum(1.0, max_speed / np.where(speeds > 0, speeds, max_speed))
+    state[..., 0:2] += state[..., 2:4] * delta_t
+    return state
+
+
+class SocialForceVec(Policy):
+    def __init__(self):
+        """ Numpy social force model with the parameters of SocialForce, without building a socialforce.Simulator """
+        super().__init__()
+        self.name = 'SocialForceVec'
+        self.trainable = False
+        self.multiagent_training = None
+        self.kinematics = 'holonomic'
+        self.initial_speed = 1
+        self.v0 = 10
+        self.sigma = 0.3
+
+    def configure(self, config):
+        return
+
+    def set_phase(self, phase):
+        return
+
+    def step(self, state, agent_mask=None):
+        return socialforce_step(state, self.time_step, self.v0, self.sigma, self.initial_speed, agent_mask=agent_mask)
+
+    def predict(self, state):
+        """ The goals of other agents are unknown and approximated with their current velocity """
+        self_state = state.robot_state
+        sf_state = [(self_state.px, self_state.py, self_state.vx, self_state.vy, self_state.gx, self_state.gy)]
+        for human_state in state.human_states:
+            if human_state.vx == 0 and human_state.vy == 0:
+                gx = self.rng.random()
+                gy = self.rng.random()
+            else:
+                gx = human_state.px + human_state.vx
+                gy = human_state.py + human_state.vy
+            sf_state.append((human_state.px, human_state.py, human_state.vx, human_state.vy, gx, gy))
+        new_state = self.step(np.array(sf_state))
+        self.last_state = state
+
+        return ActionXY(new_state[0, 2], new_state[0, 3])
+
+
+class CentralizedSocialForceVec(SocialForceVec):
+    """
+    Centralized numpy social force, all agents of one or several simulations are stepped together
+    """
+    def __init__(self):
+        super().__init__()
+
+    def predict(self, state):
+        return self.predict_batch([state])[0]
+
+    def predict_batch(self, states):
+        """ states is a list of lists of full states, simulations with fewer agents are padded """
+        agent_nums = [len(state) for state in states]
+        agent_mask = np.arange(max(agent_nums))[None, :] < np.array(agent_nums)[:, None]
+        sf_state = np.zeros(agent_mask.shape + (6,))
+        for i, state in enumerate(states):
+            sf_state[i, :len(state)] = [(s.px, s.py, s.vx, s.vy, s.gx, s.gy) for s in state]
+        new_state = self.step(sf_state, agent_mask)
+        return [[ActionXY(*new_state[i, j, 2:4]) for j in range(agent_num)] for i, agent_num in enumerate(agent_nums)]
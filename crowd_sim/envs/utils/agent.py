@@ -39,13 +39,13 @@ class Agent(object):
         self.policy = policy
         self.kinematics = policy.kinematics
 
-    def sample_random_attributes(self):
+    def sample_random_attributes(self, rng=np.random):
         """
         Sample agent radius and v_pref attribute from certain distribution
         :return:
         """
-        self.v_pref = np.random.uniform(0.5, 1.5)
-        self.radius = np.random.uniform(0.3, 0.5)
+        self.v_pref = rng.uniform(0.5, 1.5)
+        self.radius = rng.uniform(0.3, 0.5)
 
     def set(self, px, py, gx, gy, vx, vy, theta, radius=None, v_pref=None):
         self.px = px
@@ -80,6 +80,10 @@ class Agent(object):
     def get_full_state(self):
         return FullState(self.px, self.py, self.vx, self.vy, self.radius, self.gx, self.gy, self.v_pref, self.theta)
 
+    def get_full_state_array(self):
+        return np.array((self.px, self.py, self.vx, self.vy, self.radius, self.gx, self.gy, self.v_pref, self.theta),
+                        dtype=np.float32)
+
     def get_position(self):
         return self.px, self.py
 
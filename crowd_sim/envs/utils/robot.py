@@ -1,5 +1,5 @@
 from crowd_sim.envs.utils.agent import Agent
-from crowd_sim.envs.utils.state import JointState
+from crowd_sim.envs.utils.state import JointState, ArrayJointState
 
 
 class Robot(Agent):
@@ -10,6 +10,10 @@ class Robot(Agent):
         if self.policy is None:
             raise AttributeError('Policy attribute has to be set!')
 
-        state = JointState(self.get_full_state(), ob)
+        if isinstance(ob, tuple):
+            # obs_mode 'array', the robot full state comes with the observation
+            state = ArrayJointState(*ob)
+        else:
+            state = JointState(self.get_full_state(), ob)
         action, action_index = self.policy.predict(state)
         return action, action_index
@@ -0,0 +1,131 @@
+import os
+import logging
+import numpy as np
+
+# candidates drawn at once for every pending case in the rejection sampling
+CANDIDATE_NUM = 16
+MAX_ATTEMPTS = 1000
+
+
+def scenario_bank_file(directory, scenario, human_num, seed_begin, case_num, circle_radius, square_width,
+                       discomfort_dist, robot_radius, human_radius, human_v_pref, randomize_attributes):
+    """ File of the scenario bank with the given key, every parameter of generate_scenarios is part of it """
+    name = '{}_{}humans_seed{}-{}_radius{}_width{}_discomfort{}_robot{}_human{}-{}{}.npz'
+    return os.path.join(directory, name.format(
+        scenario, human_num, seed_begin, seed_begin + case_num, circle_radius, square_width, discomfort_dist,
+        robot_radius, human_radius, human_v_pref, '_randomized' if randomize_attributes else ''))
+
+
+def sample_valid(rng, sample, valid, case_num):
+    """
+    Vectorized rejection sampling, sample(rng, cases) draws (len(cases), CANDIDATE_NUM, 2) candidates and
+    valid(candidates, cases) tells which of them are accepted. Returns the first accepted candidate of every case
+    """
+    result = np.zeros((case_num, 2))
+    pending = np.arange(case_num)
+    for _ in range(MAX_ATTEMPTS):
+        if len(pending) == 0:
+            return result
+        candidates = sample(rng, pending)
+        accepted = valid(candidates, pending)
+        found = accepted.any(axis=1)
+        first = accepted.argmax(axis=1)
+        result[pending[found]] = candidates[found, first[found]]
+        pending = pending[~found]
+    raise ValueError('Can not place all humans, the scenario is too crowded')
+
+
+def generate_scenarios(scenario, human_num, case_num, seed, circle_radius, square_width, discomfort_dist,
+                       robot_radius, human_radius, human_v_pref, randomize_attributes=False):
+    """
+    Initial conditions of case_num cases at once, with the same distributions as CrowdSim.generate_human: the
+    robot goes from (0, -circle_radius) to (0, circle_radius), humans are placed one after another and keep
+    discomfort_dist to the positions and goals of the agents placed before them.
+    Returns a dict of arrays positions, goals (case_num, human_num, 2), radii and v_prefs (case_num, human_num)
+    """
+    rng = np.random.default_rng(seed)
+    if randomize_attributes:
+        v_prefs = rng.uniform(0.5, 1.5, (case_num, human_num))
+        radii = rng.uniform(0.3, 0.5, (case_num, human_num))
+    else:
+        v_prefs = np.full((case_num, human_num), float(human_v_pref))
+        radii = np.full((case_num, human_num), float(human_radius))
+    # the robot is the first agent of every case
+    positions = np.zeros((case_num, human_num + 1, 2))
+    goals = np.zeros((case_num, human_num + 1, 2))
+    agent_radii = np.concatenate([np.full((case_num, 1), float(robot_radius)), radii], axis=1)
+    positions[:, 0] = 0, -circle_radius
+    goals[:, 0] = 0, circle_radius
+
+    for i in range(1, human_num + 1):
+        min_dists = agent_radii[:, i:i + 1] + agent_radii[:, :i] + discomfort_dist
+
+        def keeps_distance(points, cases, others=None):
+            others = others if others is not None else positions
+            dists = np.linalg.norm(points[:, :, None, :] - others[cases, None, :i, :], axis=-1)
+            return np.all(dists >= min_dists[cases, None, :], axis=-1)
+
+        if scenario == 'circle_crossing' and not (human_num > 5 and i > 5):
+            def sample_start(rng, cases):
+                angles = rng.random((len(cases), CANDIDATE_NUM)) * np.pi * 2
+                noises = (rng.random((len(cases), CANDIDATE_NUM, 2)) - 0.5) * v_prefs[cases, i - 1, None, None]
+                return circle_radius * np.stack([np.cos(angles), np.sin(angles)], axis=-1) + noises
+
+            positions[:, i] = sample_valid(rng, sample_start, lambda points, cases: keeps_distance(
+                points, cases) & keeps_distance(points, cases, goals), case_num)
+            goals[:, i] = -positions[:, i]
+        elif scenario in ['circle_crossing', 'square_crossing']:
+            signs = np.where(rng.random(case_num) > 0.5, -1, 1)
+
+            def sample_square(rng, cases, side):
+                x = rng.random((len(cases), CANDIDATE_NUM)) * square_width * 0.5 * side[cases, None]
+                y = (rng.random((len(cases), CANDIDATE_NUM)) - 0.5) * square_width
+                return np.stack([x, y], axis=-1)
+
+            positions[:, i] = sample_valid(rng, lambda rng, cases: sample_square(rng, cases, signs),
+                                           lambda points, cases: keeps_distance(points, cases), case_num)
+            goals[:, i] = sample_valid(rng, lambda rng, cases: sample_square(rng, cases, -signs),
+                                       lambda points, cases: keeps_distance(points, cases, goals), case_num)
+        else:
+            raise NotImplementedError
+
+    return {'positions': positions[:, 1:], 'goals': goals[:, 1:], 'radii': radii, 'v_prefs': v_prefs}
+
+
+def build_scenario_bank(env, phase, directory):
+    """
+    Generate the cases of phase for env and save them in directory, keyed by scenario, number of humans,
+    seed range, circle radius / square width, discomfort distance, agent radii, human v_pref and whether the
+    human attributes are randomized. An existing bank with the same key is loaded instead
+    """
+    scenario = env.test_scenario
+    case_num = env.case_size[phase]
+    seed_begin = env.get_base_seed(phase)
+    parameters = dict(circle_radius=env.circle_radius, square_width=env.square_width,
+                      discomfort_dist=env.discomfort_dist, robot_radius=env.robot.radius,
+                      human_radius=env.config.humans.radius, human_v_pref=env.config.humans.v_pref,
+                      randomize_attributes=env.randomize_attributes)
+    file = scenario_bank_file(directory, scenario, env.human_num, seed_begin, case_num, **parameters)
+    if os.path.exists(file):
+        return load_scenario_bank(file)
+
+    scenarios = generate_scenarios(scenario, env.human_num, case_num, seed_begin, **parameters)
+    bank = dict(scenarios, scenario=scenario, human_num=env.human_num, seed_begin=seed_begin, case_num=case_num,
+                **parameters)
+    os.makedirs(directory, exist_ok=True)
+    np.savez_compressed(file, **bank)
+    logging.info('Saved {} {} cases to {}'.format(case_num, phase, file))
+    return bank
+
+
+def load_scenario_bank(file):
+    with np.load(file) as data:
+        bank = {key: data[key] for key in data.files}
+    bank['scenario'] = str(bank['scenario'])
+    for key in ['human_num', 'seed_begin', 'case_num']:
+        bank[key] = int(bank[key])
+    for key in ['circle_radius', 'square_width', 'discomfort_dist', 'robot_radius', 'human_radius',
+                'human_v_pref']:
+        bank[key] = float(bank[key])
+    bank['randomize_attributes'] = bool(bank['randomize_attributes'])
+    return bank
@@ -1,7 +1,11 @@
+import numpy as np
 import torch
 
 
 class FullState(object):
+    # states are created for every agent at every step and kept in recorded episodes, slots keep them small
+    __slots__ = ('px', 'py', 'vx', 'vy', 'radius', 'gx', 'gy', 'v_pref', 'theta')
+
     def __init__(self, px, py, vx, vy, radius, gx, gy, v_pref, theta):
         self.px = px
         self.py = py
@@ -13,9 +17,17 @@ class FullState(object):
         self.v_pref = v_pref
         self.theta = theta
 
-        self.position = (self.px, self.py)
-        self.goal_position = (self.gx, self.gy)
-        self.velocity = (self.vx, self.vy)
+    @property
+    def position(self):
+        return self.px, self.py
+
+    @property
+    def goal_position(self):
+        return self.gx, self.gy
+
+    @property
+    def velocity(self):
+        return self.vx, self.vy
 
     def __add__(self, other):
         return other + (self.px, self.py, self.vx, self.vy, self.radius, self.gx, self.gy, self.v_pref, self.theta)
@@ -32,6 +44,8 @@ class FullState(object):
 
 
 class ObservableState(object):
+    __slots__ = ('px', 'py', 'vx', 'vy', 'radius')
+
     def __init__(self, px, py, vx, vy, radius):
         self.px = px
         self.py = py
@@ -39,8 +53,13 @@ class ObservableState(object):
         self.vy = vy
         self.radius = radius
 
-        self.position = (self.px, self.py)
-        self.velocity = (self.vx, self.vy)
+    @property
+    def position(self):
+        return self.px, self.py
+
+    @property
+    def velocity(self):
+        return self.vx, self.vy
 
     def __add__(self, other):
         return other + (self.px, self.py, self.vx, self.vy, self.radius)
@@ -53,6 +72,8 @@ class ObservableState(object):
 
 
 class JointState(object):
+    __slots__ = ('robot_state', 'human_states')
+
     def __init__(self, robot_state, human_states):
         assert isinstance(robot_state, FullState)
         for human_state in human_states:
@@ -79,13 +100,135 @@ class JointState(object):
         return robot_state_tensor, human_states_tensor
 
 
+class ArrayJointState(object):
+    __slots__ = ('robot_array', 'human_array', '_robot_state', '_human_states')
+
+    def __init__(self, robot_state, human_states):
+        """
+        Joint state backed by float32 arrays, the robot full state of shape (9,) and the human observable states
+        of shape (# of humans, 5), as returned by CrowdSim with obs_mode 'array'. The object attributes are only
+        built when a policy asks for them, tensors share memory with the arrays
+        """
+        self.robot_array = np.asarray(robot_state, dtype=np.float32)
+        self.human_array = np.asarray(human_states, dtype=np.float32).reshape(-1, 5)
+        self._robot_state = None
+        self._human_states = None
+
+    @property
+    def robot_state(self):
+        if self._robot_state is None:
+            self._robot_state = FullState(*self.robot_array.tolist())
+        return self._robot_state
+
+    @property
+    def human_states(self):
+        if self._human_states is None:
+            self._human_states = [ObservableState(*human_state) for human_state in self.human_array.tolist()]
+        return self._human_states
+
+    @human_states.setter
+    def human_states(self, human_states):
+        self._human_states = list(human_states)
+        self.human_array = np.array([human_state.to_tuple() for human_state in self._human_states],
+                                    dtype=np.float32).reshape(-1, 5)
+
+    def to_tensor(self, add_batch_size=False, device=None):
+        robot_state_tensor = torch.from_numpy(self.robot_array).unsqueeze(0)
+        human_states_tensor = torch.from_numpy(self.human_array)
+
+        if add_batch_size:
+            robot_state_tensor = robot_state_tensor.unsqueeze(0)
+            human_states_tensor = human_states_tensor.unsqueeze(0)
+
+        if device is not None and device.type != 'cpu':
+            robot_state_tensor = robot_state_tensor.to(device)
+            human_states_tensor = human_states_tensor.to(device)
+
+        return robot_state_tensor, human_states_tensor
+
+
+class JointStateBuffer(object):
+    def __init__(self, robot_state_dim=9, human_state_dim=5):
+        """
+        Preallocated input buffers for turning a JointState into tensors, reused across steps so that
+        planning does not allocate new tensors every call. The human buffer grows with the crowd size.
+        Tensors returned on cpu share memory with the buffer and are overwritten by the next call.
+        """
+        self.robot_buffer = np.zeros((1, robot_state_dim), dtype=np.float32)
+        self.human_buffer = np.zeros((0, human_state_dim), dtype=np.float32)
+        self.mask_buffer = np.zeros(0, dtype=bool)
+        self.robot_tensor = torch.from_numpy(self.robot_buffer)
+        self.human_tensor = torch.from_numpy(self.human_buffer)
+        self.mask_tensor = torch.from_numpy(self.mask_buffer)
+
+    def fill(self, state, pad_to=None):
+        if isinstance(state, ArrayJointState):
+            return self.fill_arrays(state, pad_to)
+        human_num = len(state.human_states)
+        if pad_to is not None and human_num > pad_to:
+            raise ValueError('Observation has {} humans, more than the padded size {}'.format(human_num, pad_to))
+        rows = human_num if pad_to is None else pad_to
+        if rows > self.human_buffer.shape[0]:
+            self.human_buffer = np.zeros((rows, self.human_buffer.shape[1]), dtype=np.float32)
+            self.mask_buffer = np.zeros(rows, dtype=bool)
+            self.human_tensor = torch.from_numpy(self.human_buffer)
+            self.mask_tensor = torch.from_numpy(self.mask_buffer)
+        self.robot_buffer[0] = state.robot_state.to_tuple()
+        for i, human_state in enumerate(state.human_states):
+            self.human_buffer[i] = human_state.to_tuple()
+        if pad_to is None:
+            return self.robot_tensor, self.human_tensor[:human_num]
+
+        self.human_buffer[human_num:rows] = 0
+        self.mask_buffer[:human_num] = True
+        self.mask_buffer[human_num:rows] = False
+        return self.robot_tensor, self.human_tensor[:rows], self.mask_tensor[:rows]
+
+    def fill_arrays(self, state, pad_to=None):
+        """ Array states are used as they are, only padding copies them into the buffer """
+        human_num = state.human_array.shape[0]
+        if pad_to is None:
+            return state.to_tensor()
+        if human_num > pad_to:
+            raise ValueError('Observation has {} humans, more than the padded size {}'.format(human_num, pad_to))
+        if pad_to > self.human_buffer.shape[0]:
+            self.human_buffer = np.zeros((pad_to, self.human_buffer.shape[1]), dtype=np.float32)
+            self.mask_buffer = np.zeros(pad_to, dtype=bool)
+            self.human_tensor = torch.from_numpy(self.human_buffer)
+            self.mask_tensor = torch.from_numpy(self.mask_buffer)
+        self.robot_buffer[0] = state.robot_array
+        self.human_buffer[:human_num] = state.human_array
+        self.human_buffer[human_num:pad_to] = 0
+        self.mask_buffer[:human_num] = True
+        self.mask_buffer[human_num:pad_to] = False
+        return self.robot_tensor, self.human_tensor[:pad_to], self.mask_tensor[:pad_to]
+
+    def to_tensor(self, state, add_batch_size=False, device=None, copy=False, pad_to=None):
+        """
+        Set copy to get tensors that do not alias the buffer, e.g. states kept in the replay memory.
+        With pad_to the humans are zero padded to that number and a mask of real humans is returned as third element.
+        """
+        tensors = self.fill(state, pad_to)
+        if add_batch_size:
+            tensors = tuple(tensor.unsqueeze(0) for tensor in tensors)
+        if device is not None and device.type != 'cpu':
+            tensors = tuple(tensor.to(device) for tensor in tensors)
+        elif copy:
+            tensors = tuple(tensor.clone() for tensor in tensors)
+
+        return tensors
+
+
 def tensor_to_joint_state(state):
-    robot_state, human_states = state
+    robot_state, human_states = state[:2]
 
     robot_state = robot_state.cpu().squeeze().data.numpy()
     robot_state = FullState(robot_state[0], robot_state[1], robot_state[2], robot_state[3], robot_state[4],
                             robot_state[5], robot_state[6], robot_state[7], robot_state[8])
     human_states = human_states.cpu().squeeze(0).data.numpy()
+    if len(state) > 2:
+        # drop padded humans
+        human_states = human_states[state[2].cpu().reshape(-1).numpy().astype(bool)]
     human_states = [ObservableState(human_state[0], human_state[1], human_state[2], human_state[3],
                                     human_state[4]) for human_state in human_states]
 
@@ -24,3 +24,66 @@ def point_to_segment_dist(x1, y1, x2, y2, x3, y3):
     y = y1 + u * py
 
     return np.linalg.norm((x - x3, y-y3))
+
+
+class SpatialHash(object):
+    def __init__(self, cell_size):
+        """
+        Uniform grid over the plane. Every item is a disc (point and radius) stored in the cell of its point, so
+        neighborhood queries only visit the cells around the query point instead of all items
+        """
+        self.cell_size = cell_size
+        self.cells = dict()
+        self.items = dict()
+        self.max_radius = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get_cell(self, x, y):
+        return int(np.floor(x / self.cell_size)), int(np.floor(y / self.cell_size))
+
+    def insert(self, item, x, y, radius=0):
+        self.remove(item)
+        cell = self.get_cell(x, y)
+        # dicts keep the insertion order, so queries are deterministic
+        self.cells.setdefault(cell, dict())[item] = (x, y, radius)
+        self.items[item] = cell
+        self.max_radius = max(self.max_radius, radius)
+
+    def remove(self, item):
+        cell = self.items.pop(item, None)
+        if cell is not None:
+            del self.cells[cell][item]
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells = dict()
+        self.items = dict()
+        self.max_radius = 0
+
+    def query(self, x, y, distance):
+        """ Items whose disc comes closer than distance to the point (x, y) """
+        reach = distance + self.max_radius
+        min_cell = self.get_cell(x - reach, y - reach)
+        max_cell = self.get_cell(x + reach, y + reach)
+        neighbors = []
+        for i in range(min_cell[0], max_cell[0] + 1):
+            for j in range(min_cell[1], max_cell[1] + 1):
+                for item, (item_x, item_y, item_radius) in self.cells.get((i, j), dict()).items():
+                    if np.hypot(x - item_x, y - item_y) < distance + item_radius:
+                        neighbors.append(item)
+        return neighbors
+
+    def occupied(self, x, y, distance):
+        """ Whether any item comes closer than distance to the point (x, y) """
+        reach = distance + self.max_radius
+        min_cell = self.get_cell(x - reach, y - reach)
+        max_cell = self.get_cell(x + reach, y + reach)
+        for i in range(min_cell[0], max_cell[0] + 1):
+            for j in range(min_cell[1], max_cell[1] + 1):
+                for item_x, item_y, item_radius in self.cells.get((i, j), dict()).values():
+                    if np.hypot(x - item_x, y - item_y) < distance + item_radius:
+                        return True
+        return False